@@ -107,7 +107,22 @@ class MFRC522:
     
   serNum = []
   
-  def __init__(self, dev='/dev/spidev0.0', spd=1000000):
+  # Registers only the driver writes to: the last value written stands in for a read
+  # in SetBitMask and ClearBitMask
+  SHADOWED = (BitFramingReg, TxControlReg)
+  
+  # Longest wait for a command to complete in MFRC522_ToCard, in seconds. The chip's own
+  # timer (see MFRC522_Init) gives up on a silent card after about 15 ms.
+  TIMEOUT = 0.05
+  
+  def __init__(self, dev='/dev/spidev0.0', spd=1000000, timeout=TIMEOUT, poll_sleep=0):
+    # poll_sleep: seconds to sleep between two reads of CommIrqReg while waiting, 0 to
+    # poll as fast as the SPI bus allows
+    self.timeout = timeout
+    self.poll_sleep = poll_sleep
+    self.transactions = 0 # SPI transactions so far, to measure the cost of a command
+    self.stats = {} # command -> [calls, timeouts, total seconds, max seconds], see MFRC522_ToCard
+    self.shadows = {}
     spi.openSPI(device=dev,speed=spd)
     GPIO.setmode(GPIO.BOARD)
     GPIO.setup(22, GPIO.OUT)
@@ -116,20 +131,49 @@ class MFRC522:
   
   def MFRC522_Reset(self):
     self.Write_MFRC522(self.CommandReg, self.PCD_RESETPHASE)
+    # Every register is back to its reset value
+    self.shadows = {}
   
   def Write_MFRC522(self, addr, val):
+    self.transactions += 1
     spi.transfer(((addr<<1)&0x7E,val))
+    if addr in self.SHADOWED:
+      self.shadows[addr] = val & 0xFF
   
   def Read_MFRC522(self, addr):
+    self.transactions += 1
     val = spi.transfer((((addr<<1)&0x7E) | 0x80,0))
     return val[1]
   
+  def Write_MFRC522_Burst(self, addr, vals):
+    # Every data byte following the address goes to the same register, e.g. the FIFO
+    if len(vals) == 0:
+      return
+    self.transactions += 1
+    spi.transfer(tuple([(addr<<1)&0x7E] + list(vals)))
+  
+  def Read_MFRC522_Burst(self, addr, n):
+    # Each byte sent is a read address, the answer to one comes with the next
+    if n == 0:
+      return []
+    self.transactions += 1
+    val = spi.transfer(tuple([((addr<<1)&0x7E) | 0x80] * n + [0]))
+    return list(val[1:])
+  
+  def Read_Shadow(self, reg):
+    if reg in self.shadows:
+      return self.shadows[reg]
+    val = self.Read_MFRC522(reg)
+    if reg in self.SHADOWED:
+      self.shadows[reg] = val
+    return val
+  
   def SetBitMask(self, reg, mask):
-    tmp = self.Read_MFRC522(reg)
+    tmp = self.Read_Shadow(reg)
     self.Write_MFRC522(reg, tmp | mask)
     
   def ClearBitMask(self, reg, mask):
-    tmp = self.Read_MFRC522(reg);
+    tmp = self.Read_Shadow(reg);
     self.Write_MFRC522(reg, tmp & (~mask))
   
   def AntennaOn(self):
@@ -148,7 +192,6 @@ class MFRC522:
     waitIRq = 0x00
     lastBits = None
     n = 0
-    i = 0
     
     if command == self.PCD_AUTHENT:
       irqEn = 0x12
@@ -158,30 +201,44 @@ class MFRC522:
       waitIRq = 0x30
     
     self.Write_MFRC522(self.CommIEnReg, irqEn|0x80)
-    self.ClearBitMask(self.CommIrqReg, 0x80)
-    self.SetBitMask(self.FIFOLevelReg, 0x80)
+    # Writing 0 in Set1 clears the marked interrupt bits: all of them
+    self.Write_MFRC522(self.CommIrqReg, 0x7F)
+    # Flush the FIFO, the other bits of FIFOLevelReg are read only
+    self.Write_MFRC522(self.FIFOLevelReg, 0x80)
     
     self.Write_MFRC522(self.CommandReg, self.PCD_IDLE);  
     
-    while(i<len(sendData)):
-      self.Write_MFRC522(self.FIFODataReg, sendData[i])
-      i = i+1
+    self.Write_MFRC522_Burst(self.FIFODataReg, sendData)
     
     self.Write_MFRC522(self.CommandReg, command)
       
     if command == self.PCD_TRANSCEIVE:
       self.SetBitMask(self.BitFramingReg, 0x80)
     
-    i = 2000
+    # Wait for the command to complete (waitIRq) or the chip's timer to run out (TimerIRq)
+    start = time.perf_counter()
+    deadline = start + self.timeout
+    timedOut = False
     while True:
       n = self.Read_MFRC522(self.CommIrqReg)
-      i = i - 1
-      if ~((i!=0) and ~(n&0x01) and ~(n&waitIRq)):
+      if n & (0x01 | waitIRq):
+        break
+      if time.perf_counter() >= deadline:
+        timedOut = True
         break
+      if self.poll_sleep:
+        time.sleep(self.poll_sleep)
+    elapsed = time.perf_counter() - start
+    
+    stats = self.stats.setdefault(command, [0, 0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += timedOut
+    stats[2] += elapsed
+    stats[3] = max(stats[3], elapsed)
     
     self.ClearBitMask(self.BitFramingReg, 0x80)
   
-    if i != 0:
+    if not timedOut:
       if (self.Read_MFRC522(self.ErrorReg) & 0x1B)==0x00:
         status = self.MI_OK
 
@@ -201,16 +258,37 @@ class MFRC522:
           if n > self.MAX_LEN:
             n = self.MAX_LEN
     
-          i = 0
-          while i<n:
-            backData.append(self.Read_MFRC522(self.FIFODataReg))
-            i = i + 1;
+          backData = self.Read_MFRC522_Burst(self.FIFODataReg, n)
       else:
         status = self.MI_ERR
 
     return (status,backData,backLen)
   
   
+  def MFRC522_Stats(self):
+    # Number of calls, timeouts, mean and worst wait in ms of each MFRC522_ToCard command
+    result = {}
+    for command, (calls, timeouts, total, worst) in self.stats.items():
+      result[command] = {'calls': calls, 'timeouts': timeouts,
+                         'mean_ms': total / calls * 1000, 'max_ms': worst * 1000}
+    return result
+  
+  def MFRC522_ArmIRQ(self):
+    # Only RxIRq drives the IRQ pin, which goes low (IRqInv) when a card answers
+    self.Write_MFRC522(self.CommIEnReg, 0xA0)
+  
+  def MFRC522_ClearIRQ(self):
+    self.Write_MFRC522(self.CommIrqReg, 0x7F)
+  
+  def MFRC522_StartRequest(self, reqMode):
+    # Send a request without waiting for the answer: with MFRC522_ArmIRQ the IRQ pin
+    # tells when a card answered, then MFRC522_Request and MFRC522_Anticoll read it
+    self.Write_MFRC522(self.CommandReg, self.PCD_IDLE)
+    self.Write_MFRC522(self.FIFOLevelReg, 0x80)
+    self.Write_MFRC522(self.FIFODataReg, reqMode)
+    self.Write_MFRC522(self.CommandReg, self.PCD_TRANSCEIVE)
+    self.Write_MFRC522(self.BitFramingReg, 0x87)
+  
   def MFRC522_Request(self, reqMode):
     status = None
     backBits = None
@@ -255,11 +333,8 @@ class MFRC522:
   
   def CalulateCRC(self, pIndata):
     self.ClearBitMask(self.DivIrqReg, 0x04)
-    self.SetBitMask(self.FIFOLevelReg, 0x80);
-    i = 0
-    while i<len(pIndata):
-      self.Write_MFRC522(self.FIFODataReg, pIndata[i])
-      i = i + 1
+    self.Write_MFRC522(self.FIFOLevelReg, 0x80)
+    self.Write_MFRC522_Burst(self.FIFODataReg, pIndata)
     self.Write_MFRC522(self.CommandReg, self.PCD_CALCCRC)
     i = 0xFF
     while True:
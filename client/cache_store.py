@@ -0,0 +1,143 @@
+"""
+Cache store
+
+The Gatekeeper's local memory of the access info of every ID it has seen, kept in a single
+SQLite file indexed by uid instead of one db/<uid>.json file per card.
+
+Each entry is the JSON schedule the server sent for the ID (by weekly_access or in the
+access snapshot) and the time it was stored, so that stale entries can be ignored.
+Recently used entries are also kept in memory (least recently used ones are dropped
+first), which makes a cache hit a dict lookup instead of a file read.
+
+The first time a store file is created, the db/*.json files left by older versions of
+the client are imported, with their modification time as the time they were stored.
+"""
+import glob
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheStore():
+    """
+    Thread safe uid -> (data, stored time) store
+    """
+
+    SCHEMA_VERSION = 1
+    LRU_SIZE = 256
+
+    def __init__(self, path, lru_size=LRU_SIZE, import_dir=None):
+        """
+        path -- the SQLite file, created if needed
+        lru_size -- number of entries kept in memory
+        import_dir -- directory of <uid>.json files to import when the file is created
+        """
+        self.lru_size = lru_size
+        self.lru = OrderedDict() # uid -> (data, stored) or None when not in the store
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        #fewer and smaller writes to the SD card, a crash may only lose the last entries
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version < self.SCHEMA_VERSION:
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                                "uid TEXT PRIMARY KEY, data TEXT NOT NULL, stored REAL NOT NULL)")
+                if import_dir is not None:
+                    self.import_json(import_dir)
+                self.db.execute("PRAGMA user_version = {}".format(self.SCHEMA_VERSION))
+
+    def import_json(self, directory):
+        """Add the <uid>.json files of a directory, returns the number of entries added"""
+        count = 0
+        for fname in glob.glob(os.path.join(directory, '*.json')):
+            uid = os.path.basename(fname)[:-len('.json')]
+            try:
+                with open(fname, 'r') as db_file:
+                    data = db_file.read()
+                stored = os.path.getmtime(fname)
+            except OSError as err:
+                print("Could not import [{}]: {}".format(fname, err))
+                continue
+            self.db.execute("INSERT OR REPLACE INTO entries (uid, data, stored) VALUES (?, ?, ?)",
+                            (uid, data, stored))
+            count += 1
+        if count:
+            print("Imported {} cache files from [{}]".format(count, directory))
+        return count
+
+    def get(self, uid):
+        """Returns (data, stored time) for a uid, or None if it is not in the store"""
+        with self.lock:
+            if uid in self.lru:
+                self.lru.move_to_end(uid)
+                return self.lru[uid]
+
+            row = self.db.execute("SELECT data, stored FROM entries WHERE uid = ?",
+                                  (uid,)).fetchone()
+            entry = tuple(row) if row is not None else None
+            self._remember(uid, entry)
+            return entry
+
+    def put(self, uid, data, stored=None):
+        """Store the data of a uid, stamped with the current time unless stored is given"""
+        if stored is None:
+            stored = time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO entries (uid, data, stored) "
+                                "VALUES (?, ?, ?)", (uid, data, stored))
+            self._remember(uid, (data, stored))
+
+    def delete(self, uid):
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM entries WHERE uid = ?", (uid,))
+            self._remember(uid, None)
+
+    def put_many(self, entries, stored=None):
+        """Store a dict of uid -> data in one transaction"""
+        if stored is None:
+            stored = time.time()
+        with self.lock:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO entries (uid, data, stored) "
+                                    "VALUES (?, ?, ?)",
+                                    ((uid, data, stored) for uid, data in entries.items()))
+            #read back on the next get rather than pushing everything else out
+            for uid in entries:
+                self.lru.pop(uid, None)
+
+    def delete_many(self, uids):
+        with self.lock:
+            with self.db:
+                self.db.executemany("DELETE FROM entries WHERE uid = ?",
+                                    ((uid,) for uid in uids))
+            for uid in uids:
+                self.lru.pop(uid, None)
+
+    def uids(self):
+        """Every uid in the store"""
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT uid FROM entries")]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+            self.lru.clear()
+
+    def _remember(self, uid, entry):
+        #called with the lock held
+        self.lru[uid] = entry
+        self.lru.move_to_end(uid)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
@@ -7,11 +7,20 @@ import sys
 import signal
 import json
 import os
+import threading
 from time import sleep
 from gatekeeper import Gatekeeper
+from door_timer import DoorTimer
 
 CONFIG_DOOR_OPEN_TIME = 2
 CONFIG_BASE_URL = 'http://morg.123core.net/members/'
+CONFIG_SPECULATIVE = False
+CONFIG_SYNC_INTERVAL = Gatekeeper.SYNC_INTERVAL # 0 to only cache the cards swiped here
+CONFIG_WATCH_CHANGES = False # sync as soon as the rules change, see Gatekeeper.start_sync
+CONFIG_IRQ_PIN = None # board pin wired to the reader's IRQ output, None to poll instead
+CONFIG_IRQ_INTERVAL = 0.1 # seconds between two requests for cards in IRQ mode
+CONFIG_DECISION_WINDOW = Gatekeeper.DECISION_WINDOW
+CONFIG_DOOR_ID = '' # name of the door in the server's access log
 
 def unlock():
     GPIO.output(11, 1)
@@ -21,7 +30,7 @@ def lock():
     
 def cleanup(signal, frame):
     print("cleaning up...")
-    lock()
+    door_timer.close()
     GPIO.cleanup()
     print("done!")
     sys.exit(0)
@@ -49,12 +58,34 @@ try:
         CONFIG_DOOR_OPEN_TIME = data['door_open_time']
     if 'base_url' in data:
         CONFIG_BASE_URL = data['base_url']
+    if 'speculative' in data:
+        CONFIG_SPECULATIVE = data['speculative']
+    if 'sync_interval' in data:
+        CONFIG_SYNC_INTERVAL = data['sync_interval']
+    if 'watch_changes' in data:
+        CONFIG_WATCH_CHANGES = data['watch_changes']
+    if 'irq_pin' in data:
+        CONFIG_IRQ_PIN = data['irq_pin']
+    if 'irq_interval' in data:
+        CONFIG_IRQ_INTERVAL = data['irq_interval']
+    if 'decision_window' in data:
+        CONFIG_DECISION_WINDOW = data['decision_window']
+    if 'door_id' in data:
+        CONFIG_DOOR_ID = data['door_id']
 except FileNotFoundError as e:
     print("error opening file: [{}]".format(e))
     print("using default settings")
 
 
-door = Gatekeeper(CONFIG_BASE_URL)
+door = Gatekeeper(CONFIG_BASE_URL, speculative=CONFIG_SPECULATIVE,
+                  decision_window=CONFIG_DECISION_WINDOW, door_id=CONFIG_DOOR_ID)
+#locks the door in the background, so that cards can be read while it is open
+door_timer = DoorTimer(unlock, lock)
+door.start_keep_warm()
+if CONFIG_SYNC_INTERVAL:
+    door.start_sync(CONFIG_SYNC_INTERVAL, watch=CONFIG_WATCH_CHANGES)
+#every decision goes to the server's access log from here, even those made offline
+door.start_uploads()
 
 """
 Something is weird about this library or maybe I'm not getting something.
@@ -74,27 +105,71 @@ def request_access(uid):
     TODO: write something useful
     """
     
+    #a card held on the reader: the door answers from its recent decisions
+    repeat = door.recent_decision(uid) is not None
+
     if door.authenticate(uid):
-        #first open the door
-        unlock()
-        sleep(CONFIG_DOOR_OPEN_TIME)
-        lock()
-        #then update the cache
-        door.update_cache(uid)
+        #first open the door, or keep it open a little longer
+        door_timer.open_for(CONFIG_DOOR_OPEN_TIME)
+        #then update the cache, unless the sync takes care of it
+        if door.sync_version is None and not repeat:
+            door.refresh_later(uid)
         
     else:
         #we might want to inform the user that they were rejected
         print('ID does not have access now')
         pass
 
+#set by the edge detection thread of RPi.GPIO when the IRQ pin goes low
+card_answered = threading.Event()
+
+def wait_for_card():
+    """
+    Sleep on the reader's IRQ line until a card answers a request
+
+    The reader can not notice a card by itself: a request is sent every
+    CONFIG_IRQ_INTERVAL, which costs a few register writes, and the IRQ pin only goes
+    low when a card answers it. The card is then ready for the anticollision.
+
+    The edge is detected from before the request is sent (see add_event_detect below):
+    the answer comes within a millisecond, often before a wait could be set up. In case
+    the edge was missed anyway, CommIrqReg is checked before giving up.
+
+    Returns True when a card answered, False after CONFIG_IRQ_INTERVAL without one.
+    """
+    card_answered.clear()
+    MIFAREReader.MFRC522_ArmIRQ()
+    MIFAREReader.MFRC522_ClearIRQ()
+    MIFAREReader.MFRC522_StartRequest(MIFAREReader.PICC_REQIDL)
+    if card_answered.wait(CONFIG_IRQ_INTERVAL):
+        return True
+    #RxIRq: something was received
+    return bool(MIFAREReader.Read_MFRC522(MIFAREReader.CommIrqReg) & 0x20)
+
+irq_mode = CONFIG_IRQ_PIN is not None
+if irq_mode:
+    try:
+        GPIO.setup(CONFIG_IRQ_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(CONFIG_IRQ_PIN, GPIO.FALLING,
+                              callback=lambda channel: card_answered.set())
+    except (RuntimeError, ValueError) as e:
+        print("can not use IRQ pin {}: [{}], polling instead".format(CONFIG_IRQ_PIN, e))
+        irq_mode = False
+
 while True:
-    (status, data) = MIFAREReader.MFRC522_Request(MIFAREReader.PICC_REQIDL) 
-    if status == MIFAREReader.MI_OK:
-        pass
+    if irq_mode:
+        #the card answered the request of wait_for_card and is ready: a second request
+        #would send it back to idle and make the anticollision fail
+        if not wait_for_card():
+            continue
     else:
-        #print("PICC_REQIDL error: {}".format(status))
-        #break
-        pass #Need to look in to why an error is returned before being able to read the uid...
+        (status, data) = MIFAREReader.MFRC522_Request(MIFAREReader.PICC_REQIDL) 
+        if status == MIFAREReader.MI_OK:
+            pass
+        else:
+            #print("PICC_REQIDL error: {}".format(status))
+            #break
+            pass #Need to look in to why an error is returned before being able to read the uid...
 
 
 
@@ -111,5 +186,6 @@ while True:
         #break
         pass
     
-    sleep(1)
+    if not irq_mode:
+        sleep(1)
     
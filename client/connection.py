@@ -0,0 +1,131 @@
+"""
+Connection
+
+A persistent HTTP/1.1 connection to the MSYS server.
+
+Opening a TCP (and eventually TLS) connection for every swipe costs more than the
+request itself on a Raspberry Pi. ServerConnection keeps one keep-alive connection open
+and transparently opens a new one when the server has closed it. A background thread can
+keep it warm by sending a cheap request whenever it has been idle for a while, so that the
+next swipe does not pay the connect.
+
+Requests on one ServerConnection are sent one after the other, the Gatekeeper uses a
+second one for its background work so that a swipe never waits behind it.
+"""
+import http.client
+import socket
+import threading
+import urllib.parse
+from time import monotonic
+
+
+class ServerConnection():
+    """
+    Thread safe wrapper around a single http.client connection to the server
+    """
+
+    def __init__(self, server_url, timeout):
+        parts = urllib.parse.urlsplit(server_url)
+        if parts.scheme == 'https':
+            self.conn_class = http.client.HTTPSConnection
+        else:
+            self.conn_class = http.client.HTTPConnection
+        self.host = parts.netloc
+        self.base_path = parts.path if parts.path.endswith('/') else parts.path + '/'
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.conn = None
+        self.last_used = 0
+        self.connects = 0
+        self.warm_thread = None
+        self.warm_stop = threading.Event()
+
+    def request(self, method, path, fields=None, headers=None, body=None):
+        """
+        Send a request to base_url + path and read the whole answer
+
+        fields is a dict sent url encoded in the body, like a form; or body is sent as
+        it is (set its Content-Type in headers). Returns (status, headers, body). Raises
+        OSError or http.client.HTTPException when the server can not be reached.
+        """
+        all_headers = {'Connection': 'keep-alive'}
+        if fields is not None:
+            body = urllib.parse.urlencode(fields).encode('utf-8')
+            all_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if headers:
+            all_headers.update(headers)
+
+        with self.lock:
+            return self._request(method, path, body, all_headers)
+
+    def close(self):
+        """Close the connection. The next request opens a new one."""
+        with self.lock:
+            self._close()
+
+    def start_keep_warm(self, interval, path):
+        """Send a GET for path every time the connection has been idle for interval seconds"""
+        if self.warm_thread is not None:
+            return
+        self.warm_stop.clear()
+        self.warm_thread = threading.Thread(target=self._keep_warm, args=(interval, path),
+                                            name="keep-warm", daemon=True)
+        self.warm_thread.start()
+
+    def stop_keep_warm(self):
+        if self.warm_thread is not None:
+            self.warm_stop.set()
+            self.warm_thread.join()
+            self.warm_thread = None
+
+    def _keep_warm(self, interval, path):
+        while not self.warm_stop.wait(interval / 2):
+            if monotonic() - self.last_used < interval:
+                continue
+            #a request in progress keeps the connection warm anyway, never queue behind it
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                self._request('GET', path, None, {'Connection': 'keep-alive'})
+            except (OSError, http.client.HTTPException) as err:
+                print("keep-warm: server unreachable: {}".format(err))
+            finally:
+                self.lock.release()
+
+    def _request(self, method, path, body, headers):
+        #called with the lock held
+        #a reused connection may have been closed by the server in the meantime,
+        #in which case we find out only now: try once more on a fresh one
+        reused = self.conn is not None
+        try:
+            return self._send(method, path, body, headers)
+        except socket.timeout:
+            #the server is there but slow, asking again would only double the wait
+            self._close()
+            raise
+        except (OSError, http.client.HTTPException):
+            self._close()
+            if not reused:
+                raise
+        return self._send(method, path, body, headers)
+
+    def _send(self, method, path, body, headers):
+        #called with the lock held
+        if self.conn is None:
+            self.conn = self.conn_class(self.host, timeout=self.timeout)
+            self.connects += 1
+
+        self.conn.request(method, self.base_path + path, body=body, headers=headers)
+        resp = self.conn.getresponse()
+        data = resp.read()
+        if resp.will_close:
+            self._close()
+        self.last_used = monotonic()
+        return resp.status, resp.headers, data
+
+    def _close(self):
+        #called with the lock held
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
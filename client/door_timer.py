@@ -0,0 +1,65 @@
+"""
+Door timer
+
+Keeps the door unlocked for a while without holding up the reader loop. Instead of
+unlock(), sleep(), lock(), the loop calls open_for() and goes back to reading cards; a
+background thread locks the door when the deadline passes. Opening the door again while
+it is still unlocked pushes the deadline back instead of locking it in between.
+"""
+import threading
+from time import monotonic
+
+
+class DoorTimer():
+    """
+    Drives the door relay through the given unlock and lock functions
+    """
+
+    def __init__(self, unlock, lock):
+        self.unlock = unlock
+        self.lock = lock
+        self.cond = threading.Condition()
+        self.deadline = None # monotonic time to lock the door at, None when locked
+        self.thread = None
+
+    def open_for(self, seconds):
+        """Unlock the door, or keep it unlocked, until at least seconds from now"""
+        deadline = monotonic() + seconds
+        with self.cond:
+            if self.deadline is None:
+                self.unlock()
+                self.deadline = deadline
+            elif deadline > self.deadline:
+                self.deadline = deadline
+            else:
+                return
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="door-timer",
+                                               daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def is_open(self):
+        with self.cond:
+            return self.deadline is not None
+
+    def close(self):
+        """Lock the door now"""
+        with self.cond:
+            self.lock()
+            self.deadline = None
+            self.cond.notify()
+
+    def _run(self):
+        with self.cond:
+            while True:
+                if self.deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = self.deadline - monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                self.lock()
+                self.deadline = None
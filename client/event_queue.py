@@ -0,0 +1,56 @@
+"""
+Event queue
+
+Every access decision the Gatekeeper makes, kept on disk until the server has it.
+
+When the server can not be reached the door decides from its cache and, without this
+queue, the swipe would never be recorded anywhere. Events are appended to a SQLite file
+as they happen and uploaded in batches (see Gatekeeper.upload_events) once the server is
+back; a batch is only removed after the server acknowledged it. Each event carries an id
+made here, so a batch sent twice is stored once.
+"""
+import json
+import sqlite3
+import threading
+
+
+class EventQueue():
+    """
+    Thread safe, durable first in first out queue of events (dicts)
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        #a swipe must survive a power cut, it is a small write
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS events ("
+                            "seq INTEGER PRIMARY KEY AUTOINCREMENT, event TEXT NOT NULL)")
+
+    def append(self, event):
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT INTO events (event) VALUES (?)", (json.dumps(event),))
+
+    def peek(self, limit):
+        """The oldest events, as a list of (seq, event), at most limit of them"""
+        with self.lock:
+            rows = self.db.execute("SELECT seq, event FROM events ORDER BY seq LIMIT ?",
+                                   (limit,)).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+    def ack(self, seq):
+        """Remove the events up to and including seq"""
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM events WHERE seq <= ?", (seq,))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
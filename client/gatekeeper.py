@@ -6,16 +6,23 @@ lock controlled by RFID card. Gatekeeper is a client of MSYS that primarily reli
 server for making authentication decisions. However sometimes the server may be unavailable
 and just like a friendly castle guard, will be able to remember people that have been seen before.
 
-Gatekeeper will cache the results of the recent authentications.
+Gatekeeper will cache the results of the recent authentications, in a CacheStore.
 """
 import json
-import urllib.parse
-import urllib.request
-from urllib.error import URLError
+import http.client
+import math
 from time import perf_counter
 import os
 import datetime
+import queue
+import threading
 import time
+import urllib.parse
+import uuid
+
+from cache_store import CacheStore
+from connection import ServerConnection
+from event_queue import EventQueue
 
 
 class Gatekeeper():
@@ -24,19 +31,85 @@ class Gatekeeper():
     """
 
     REQUEST_TIMEOUT = 2
+    BACKGROUND_TIMEOUT = 30 # nobody waits for the background requests, see self.background
     CACHE_STALE_T = 604800 # number of seconds in 7 days
+    KEEP_WARM_INTERVAL = 30 # seconds, below the usual server keep-alive timeouts
+    SPECULATIVE_FRESH_T = 86400 # cache entries younger than this are trusted in speculative mode
+    SYNC_INTERVAL = 300 # longest time between two syncs of the whole cache with the server
+    SYNC_WAIT = 25 # seconds a long poll for changes (access/wait/) is left open
+    SYNC_PAGE_SIZE = 1000 # cards per page of the access snapshot
+    REFRESH_QUEUE_SIZE = 64 # IDs waiting for update_cache, more are dropped
+    DECISION_WINDOW = 3 # seconds during which a repeat read of an ID reuses the decision
+    EVENT_UPLOAD_INTERVAL = 10 # seconds between two uploads of the queued decisions
+    EVENT_BATCH_SIZE = 500 # decisions per upload request
 
-    def __init__(self, server_url):
+    def __init__(self, server_url, speculative=False, cache_dir=None,
+                 decision_window=DECISION_WINDOW, door_id=''):
+        """
+        speculative -- grant access straight from a fresh cache entry and confirm with
+                       the server in the background (see authenticate)
+        cache_dir -- where the cache is kept, db/ next to this file by default. Any
+                     <uid>.json files found there are imported the first time.
+        decision_window -- seconds during which the same ID read again gets the same
+                           answer without asking anyone, 0 to always ask
+        door_id -- name of this door in the server's access log
+        """
         self.request_timeout = self.REQUEST_TIMEOUT
+        self.door_id = door_id
+        self.speculative = speculative
+        self.decision_window = decision_window
+        self.decisions = {} # rfid -> (monotonic time, granted) of the recent decisions
+        self.discrepancies = [] # (time, rfid) of speculative grants the server denied
         if server_url[-1] != '/':
             server_url += '/'
         self.auth_url = server_url + "auth/"
         self.weekly_url = server_url + "weekly_access/"
 
+        #one keep-alive connection for the swipes, and one for everything done in the
+        #background (sync, refresh, uploads, confirmations) so that a swipe never waits
+        #for a snapshot page or an upload to finish
+        self.server = ServerConnection(server_url, self.request_timeout)
+        self.background = ServerConnection(server_url, self.BACKGROUND_TIMEOUT)
+        #and one held open by the sync thread waiting for the access rules to change
+        self.watch = ServerConnection(server_url, self.SYNC_WAIT + self.BACKGROUND_TIMEOUT)
+
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db')
+        self.cache = CacheStore(os.path.join(cache_dir, 'cache.sqlite3'), import_dir=cache_dir)
+
+        #see sync()
+        self.sync_version = None
+        self.synced_at = 0
+        self.sync_thread = None
+        self.sync_stop = threading.Event()
+
+        #see refresh_later()
+        self.refresh_queue = queue.Queue(self.REFRESH_QUEUE_SIZE)
+        self.refresh_pending = set()
+        self.refresh_lock = threading.Lock()
+        self.refresh_thread = None
+
+        #every decision, until the server has it, see record_event()
+        self.events = EventQueue(os.path.join(cache_dir, 'events.sqlite3'))
+        self.upload_thread = None
+        self.upload_stop = threading.Event()
+
+    def start_keep_warm(self, interval=KEEP_WARM_INTERVAL):
+        """
+        Keep the connection to the server open while no cards are swiped
+
+        A GET of weekly_access/ (answered without touching the database) is sent
+        whenever the connection has been idle for interval seconds.
+        """
+        self.server.start_keep_warm(interval, "weekly_access/")
+
     def json_has_access_now(self, json_str):
         """
         Check the data in provided json string to see if it should have access now
 
+        The data is either the answer of weekly_access, {day: {"start": ..., "end": ...}},
+        or a schedule of the access snapshot, {day: [[start, end], ...]}.
+
         Returns True if the data indicates that access should be provided at the current
         time. Returns False if the current time is outside of start and end times for
         the current day. Returns False if there is a formatting error.
@@ -59,11 +132,14 @@ class Gatekeeper():
             for day, times in data.items():
                 print("day = [{}] day2day: [{}]".format(today, day2day[day]))
                 if today == day2day[day]:
-                    start_t = datetime.datetime.strptime(times['start'], '%H:%M:%S').time()
-                    end_t = datetime.datetime.strptime(times['end'], '%H:%M:%S').time()
-                    print("{} <= {} and {} >= {}".format(start_t, cur_time, end_t, cur_time))
-                    if start_t <= cur_time and end_t >= cur_time:
-                        return True
+                    if isinstance(times, dict):
+                        times = [[times['start'], times['end']]]
+                    for start, end in times:
+                        start_t = datetime.datetime.strptime(start, '%H:%M:%S').time()
+                        end_t = datetime.datetime.strptime(end, '%H:%M:%S').time()
+                        print("{} <= {} and {} >= {}".format(start_t, cur_time, end_t, cur_time))
+                        if start_t <= cur_time and end_t >= cur_time:
+                            return True
 
         except ValueError:
             print("ValueError!!!one1! \njson_str = {}".format(json_str))
@@ -78,96 +154,391 @@ class Gatekeeper():
         Asks the server for the most up to date access info. Overwrites the previous stored data.
         """
 
-        values = {'id' : rfid}
-        data = urllib.parse.urlencode(values)
-        data = data.encode('utf-8')
-        req = urllib.request.Request(self.weekly_url, data)
-
         try:
-            resp = urllib.request.urlopen(req, timeout=self.request_timeout)
-        except URLError:
-            print("Weekly TODO: log that the connection was rejected...")
+            status, headers, text = self.background.request('POST', "weekly_access/",
+                                                            {'id' : rfid})
+        except (OSError, http.client.HTTPException) as err:
+            print("Weekly TODO: log that the connection was rejected... ({})".format(err))
             return
 
-        except timeout as err:
-            print("Timeout (weekly): ", err)
+        if status != 200:
+            print("Weekly: server answered {}".format(status))
             return
 
-        text = resp.read()
-        
-        #save the file
-        base = os.path.dirname(os.path.abspath(__file__))
-        db_path = "{}/db/{}.json".format(base, rfid)
-        
-        try:
-            db_file = open(db_path, 'wb')
-        except:
-            print("error opening db file: ", db_path)
-            return
-            
-        db_file.write(text)
-        db_file.close()
+        self.cache.put(rfid, text.decode('utf-8'))
+
+    def refresh_later(self, rfid):
+        """
+        Have update_cache called for an ID by a background thread
+
+        Returns at once, so that the reader loop does not wait for the server. An ID
+        already waiting is not queued twice. Returns False if the queue is full and the
+        ID was dropped.
+        """
+        with self.refresh_lock:
+            if rfid in self.refresh_pending:
+                return True
+            if self.refresh_thread is None:
+                self.refresh_thread = threading.Thread(target=self._refresh_loop,
+                                                       name="refresh", daemon=True)
+                self.refresh_thread.start()
+            try:
+                self.refresh_queue.put_nowait(rfid)
+            except queue.Full:
+                print("Refresh queue full, dropping [{}]".format(rfid))
+                return False
+            self.refresh_pending.add(rfid)
+        return True
+
+    def stop_refresh(self):
+        """Stop the refresh thread once it has emptied the queue"""
+        with self.refresh_lock:
+            thread = self.refresh_thread
+            self.refresh_thread = None
+        if thread is not None:
+            self.refresh_queue.put(None)
+            thread.join()
 
-    def auth_from_cache(self, rfid):
+    def _refresh_loop(self):
+        while True:
+            rfid = self.refresh_queue.get()
+            if rfid is None:
+                return
+            #a swipe from now on needs a new refresh, this one may already be too old
+            with self.refresh_lock:
+                self.refresh_pending.discard(rfid)
+            try:
+                self.update_cache(rfid)
+            except Exception as err:
+                #keep the thread alive for the next ones
+                print("Refresh of [{}] failed: {}".format(rfid, err))
+
+    def auth_from_cache(self, rfid, max_age=None):
         """
         Check the local cache to see if we remember past access info
         
         Returns True if the id has access at this day/time according to the chached info
+        and the info is no older than max_age seconds (CACHE_STALE_T by default)
         """
-        
-        #can we open the file
-        base = os.path.dirname(os.path.abspath(__file__))
-        fname = "{}/db/{}.json".format(base, rfid)
-        
-        try:
-            mtime = os.path.getmtime(fname)
-            delta_t = time.time() - mtime
-            if delta_t > self.CACHE_STALE_T:
+        if max_age is None:
+            max_age = self.CACHE_STALE_T
+
+        entry = self.cache.get(rfid)
+        if entry is None:
+            print('[{}] is not in the cache'.format(rfid))
+            return False
+
+        #a sync vouches for every entry, even those that did not change
+        data, stored = entry
+        if time.time() - max(stored, self.synced_at) > max_age:
+            return False
+        return self.json_has_access_now(data)
+
+    def revoke_cache(self, rfid):
+        """Forget what we know about an ID"""
+        self.cache.delete(rfid)
+
+    def start_sync(self, interval=SYNC_INTERVAL, watch=False):
+        """
+        Sync the cache with the server now, then every interval seconds, in the background
+
+        Once synced, the cache knows every card the server knows, not only the ones
+        swiped at this door before, and update_cache is no longer needed.
+
+        With watch, the thread also waits for the server to report a change between two
+        syncs (see wait_for_changes) and syncs right away. Every door then keeps a
+        request open on the server at all times: only use it with a server that can
+        hold that many on top of the swipes (threaded or asynchronous workers), or the
+        swipes queue behind them.
+        """
+        if self.sync_thread is not None:
+            return
+        self.sync_stop.clear()
+        self.sync_thread = threading.Thread(target=self._sync_loop,
+                                            args=(interval, watch), name="sync",
+                                            daemon=True)
+        self.sync_thread.start()
+
+    def stop_sync(self):
+        """Stop the sync thread, which may take until its current long poll returns"""
+        if self.sync_thread is not None:
+            self.sync_stop.set()
+            self.sync_thread.join()
+            self.sync_thread = None
+
+    def _sync_loop(self, interval, watch):
+        while True:
+            if not (self.sync() and watch and self.wait_for_changes(interval)):
+                if self.sync_stop.wait(interval):
+                    return
+            if self.sync_stop.is_set():
+                return
+
+    def wait_for_changes(self, interval):
+        """
+        Wait until the access rules change past sync_version, or interval seconds pass
+
+        The server holds each request to access/wait/ until a change or for SYNC_WAIT
+        seconds, so a revoked card is known here within seconds instead of at the next
+        sync. Returns False if the server could not be asked.
+        """
+        deadline = time.monotonic() + interval
+        while not self.sync_stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            timeout = math.ceil(min(remaining, self.SYNC_WAIT))
+            path = "access/wait/?" + urllib.parse.urlencode(
+                {'since': self.sync_version, 'timeout': timeout})
+            try:
+                if self.get_json(path, self.watch)['changed']:
+                    return True
+            except (OSError, http.client.HTTPException, ValueError, KeyError) as err:
+                print("Waiting for changes failed: {}".format(err))
                 return False
-        
-            db_file = open(fname, 'r')
-            print('Opened file in cache [{}]'.format(fname))
-            data = db_file.read()
-            db_file.close()
-            return self.json_has_access_now(data)
-        except FileNotFoundError:
-            print('Could not open [{}]'.format(fname))
+        return True
+
+    def sync(self):
+        """
+        Bring the access info of every card in the cache up to date
+
+        The first sync reads the whole access snapshot, a page at a time so that swipes
+        are not held up behind one long request, and replaces the cache with it. The
+        next ones only fetch the cards changed since (access/changes/).
+
+        Returns True if the cache is now current, False if the server could not be reached.
+        """
+        started = time.time()
+        try:
+            if self.sync_version is None:
+                version = self.sync_snapshot()
+            else:
+                version = self.sync_changes(self.sync_version)
+        except (OSError, http.client.HTTPException, ValueError, KeyError) as err:
+            print("Sync failed: {}".format(err))
             return False
-        
 
-    def authenticate(self, rfid):
+        self.sync_version = version
+        self.synced_at = started
+        return True
+
+    def sync_snapshot(self):
+        """Replace the cache with the access snapshot, returns its version"""
+        entries = {}
+        version = None
+        after = ''
+        while True:
+            page = self.get_json("access/snapshot/?" + urllib.parse.urlencode(
+                {'after': after, 'limit': self.SYNC_PAGE_SIZE}))
+            if version is None:
+                version = page['version']
+            entries.update(self.snapshot_entries(page))
+            after = page['next']
+            if after is None:
+                break
+
+        self.replace_cache(entries)
+        print("Sync: {} cards at version {}".format(len(entries), page['version']))
+
+        if page['version'] != version:
+            #the rules changed while we were reading the pages
+            return self.sync_changes(version)
+        return version
+
+    def sync_changes(self, since):
+        """Apply the changes made since a version, returns the new version"""
+        data = self.get_json("access/changes/?since={}".format(since))
+        entries = self.snapshot_entries(data)
+        if data['full']:
+            self.replace_cache(entries)
+        else:
+            self.cache.put_many(entries)
+            self.cache.delete_many(data['removed'])
+        if entries or data['removed']:
+            print("Sync: {} cards changed, {} removed".format(len(entries), len(data['removed'])))
+        return data['version']
+
+    def snapshot_entries(self, data):
+        """Turn a snapshot document into a dict of uid -> schedule JSON to cache"""
+        schedules = [json.dumps(schedule) for schedule in data['schedules']]
+        return {uid: schedules[n] for uid, n in data['cards'].items()}
+
+    def replace_cache(self, entries):
+        stale = set(self.cache.uids()).difference(entries)
+        self.cache.put_many(entries)
+        self.cache.delete_many(stale)
+
+    def get_json(self, path, server=None):
         """
-        Authenticate an ID
+        GET a JSON document from the server, raises ValueError unless it answers 200
 
-        Returns True if the server allows access for the ID or if the server is unavailable,
-        will return True if the cache indicates the ID had recent access
+        server is the ServerConnection to use, self.background by default.
         """
-        print("Auth id: [{}]".format(rfid))
+        if server is None:
+            server = self.background
+        status, headers, body = server.request('GET', path)
+        if status != 200:
+            raise ValueError("{} answered {}".format(path, status))
+        return json.loads(body.decode('utf-8'))
 
-        values = {'id' : rfid}
-        data = urllib.parse.urlencode(values)
-        data = data.encode('utf-8')
+    def ask_server(self, rfid, event_id=None, server=None):
+        """
+        Ask the server whether an ID has access
 
+        The server logs the decision under event_id, so that the copy sent by
+        upload_events is not stored twice (see record_event). server is the ServerConnection to use, self.server by default.
+        Returns True or False, or None if the server could not be reached.
+        """
+        if server is None:
+            server = self.server
         t1 = perf_counter()
 
-        req = urllib.request.Request(self.auth_url, data)
+        fields = {'id' : rfid}
+        if event_id is not None:
+            fields['event'] = event_id
+        if self.door_id:
+            fields['door'] = self.door_id
+
         try:
-            resp = urllib.request.urlopen(req, timeout=self.request_timeout)
-        except URLError as err:
-            print("URLError: auth_url:[{}]".format(self.auth_url))
-            print("URLError: {}".format(err))
-            print("Falling back to local cache")
-            cached = self.auth_from_cache(rfid)
-            return cached
-        except timeout as err:
-            cached = self.auth_from_cache(rfid)
-            return cached
+            status, headers, text = server.request('POST', "auth/", fields)
+        except (OSError, http.client.HTTPException) as err:
+            print("Error: auth_url:[{}]".format(self.auth_url))
+            print("Error: {}".format(err))
+            return None
 
-        text = resp.read()
+        if status != 200:
+            print("Auth: server answered {}".format(status))
+            return None
 
         t2 = perf_counter()
 
         print("Auth got [{}] in {} sec".format(text, t2-t1))
 
-        if text == b'Granted':
+        return text == b'Granted'
+
+    def authenticate(self, rfid):
+        """
+        Authenticate an ID
+
+        Returns True if the server allows access for the ID or if the server is unavailable,
+        will return True if the cache indicates the ID had recent access
+
+        In speculative mode, an ID granted by a cache entry younger than
+        SPECULATIVE_FRESH_T is let in without waiting for the server. The server is
+        still asked, in the background, so the swipe is logged; if it denies the ID the
+        cache entry is revoked and the discrepancy recorded.
+
+        A card held on the reader is read over and over: within decision_window seconds
+        of a decision, the same ID gets the same answer without a request or a log row.
+
+        Every other decision is queued for the server's access log, whoever made it.
+        """
+        granted = self.recent_decision(rfid)
+        if granted is not None:
+            return granted
+
+        print("Auth id: [{}]".format(rfid))
+        event_id = uuid.uuid4().hex
+
+        if self.speculative and self.auth_from_cache(rfid, self.SPECULATIVE_FRESH_T):
+            #remembered before the confirmation has a chance to take it back
+            self.remember_decision(rfid, True)
+            self.record_event(event_id, rfid, True)
+            threading.Thread(target=self.confirm, args=(rfid, event_id), daemon=True).start()
             return True
+
+        granted = self.ask_server(rfid, event_id)
+        if granted is None:
+            print("Falling back to local cache")
+            granted = self.auth_from_cache(rfid)
+
+        self.remember_decision(rfid, granted)
+        self.record_event(event_id, rfid, granted)
+        return granted
+
+    def recent_decision(self, rfid):
+        """The decision made for an ID less than decision_window seconds ago, or None"""
+        decision = self.decisions.get(rfid)
+        if decision is None:
+            return None
+        when, granted = decision
+        if time.monotonic() - when >= self.decision_window:
+            return None
+        return granted
+
+    def remember_decision(self, rfid, granted):
+        now = time.monotonic()
+        for old, (when, _) in list(self.decisions.items()):
+            if now - when >= self.decision_window:
+                self.decisions.pop(old, None)
+        if self.decision_window > 0:
+            self.decisions[rfid] = (now, granted)
+
+    def confirm(self, rfid, event_id=None):
+        """Check a speculative grant with the server"""
+        granted = self.ask_server(rfid, event_id, self.background)
+        if granted is False:
+            print("DISCREPANCY: [{}] was let in from the cache but the server denies it".format(
+                rfid))
+            self.revoke_cache(rfid)
+            self.decisions.pop(rfid, None)
+            self.discrepancies.append((datetime.datetime.now(), rfid))
+            #fetch what access it still has, at other times for example, instead of
+            #knowing nothing about it until the next sync
+            self.refresh_later(rfid)
+
+    def record_event(self, event_id, rfid, granted):
+        """Queue a decision for upload_events"""
+        self.events.append({'event_id': event_id, 'uid': rfid, 'timestamp': time.time(),
+                            'granted': granted, 'door': self.door_id})
+
+    def upload_events(self):
+        """
+        Send the queued decisions to the server's access log
+
+        They are sent EVENT_BATCH_SIZE at a time and only removed from the queue once the
+        server has stored them. The server ignores the ones it already has, so nothing is
+        logged twice if an answer gets lost. Returns the number of events sent.
+        """
+        sent = 0
+        while True:
+            batch = self.events.peek(self.EVENT_BATCH_SIZE)
+            if not batch:
+                return sent
+
+            body = json.dumps([event for seq, event in batch]).encode('utf-8')
+            try:
+                status, headers, text = self.background.request(
+                    'POST', "access/events/", headers={'Content-Type': 'application/json'},
+                    body=body)
+            except (OSError, http.client.HTTPException) as err:
+                print("Upload of {} events failed: {}".format(len(batch), err))
+                return sent
+
+            if status != 200:
+                print("Upload: server answered {}".format(status))
+                return sent
+
+            self.events.ack(batch[-1][0])
+            sent += len(batch)
+
+    def start_uploads(self, interval=EVENT_UPLOAD_INTERVAL):
+        """Call upload_events every interval seconds, in the background"""
+        if self.upload_thread is not None:
+            return
+        self.upload_stop.clear()
+        self.upload_thread = threading.Thread(target=self._upload_loop, args=(interval,),
+                                              name="uploads", daemon=True)
+        self.upload_thread.start()
+
+    def stop_uploads(self):
+        if self.upload_thread is not None:
+            self.upload_stop.set()
+            self.upload_thread.join()
+            self.upload_thread = None
+
+    def _upload_loop(self, interval):
+        while True:
+            self.upload_events()
+            if self.upload_stop.wait(interval):
+                return
@@ -0,0 +1,197 @@
+"""
+Load test for the MSYS device endpoints
+
+Fires concurrent POSTs at auth/ and weekly_access/ from a pool of threads, the same way
+the doors do (see post.py), and reports the throughput and latency percentiles.
+
+The uids are a mix of cards that have access right now, cards that exist but are out
+of schedule and uids the server does not know. The first two are taken from the
+server's access snapshot (access/snapshot/), or from a file with one uid per line and
+the "known" or "out" label, e.g. "deadbeef known". Like the doors, the snapshot is read in local time;
+use --utc-offset when the server runs in another time zone.
+
+Usage:
+    python loadtest.py [--url http://127.0.0.1:8000/members/] [--requests 2000]
+                       [--concurrency 16] [--mix known=70,out=20,unknown=10]
+                       [--endpoints auth=80,weekly=20] [--uids uids.txt] [--seed 1]
+                       [--utc-offset -5]
+"""
+import argparse
+import datetime
+import json
+import random
+import threading
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+
+ENDPOINTS = {'auth': 'auth/', 'weekly': 'weekly_access/'}
+
+DAY_CODES = ['mon', 'tues', 'wed', 'thurs', 'fri', 'sat', 'sun']
+
+
+def parse_mix(text):
+    """Parse "name=weight,..." into (names, weights)"""
+    names = []
+    weights = []
+    for item in text.split(','):
+        name, weight = item.split('=')
+        names.append(name.strip())
+        weights.append(float(weight))
+    return names, weights
+
+def percentile(samples, pct):
+    """pct percentile of an already sorted list"""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def schedule_allows_now(schedule, now):
+    """Check a snapshot schedule ({day: [[start, end], ...]}) against a datetime"""
+    cur_time = now.strftime('%H:%M:%S')
+    for start, end in schedule.get(DAY_CODES[now.weekday()], []):
+        if start <= cur_time <= end:
+            return True
+    return False
+
+def uids_from_snapshot(base_url, timeout, now):
+    """Split the cards of the server's access snapshot into ([known], [out of schedule])"""
+    resp = urllib.request.urlopen(base_url + 'access/snapshot/', timeout=timeout)
+    snapshot = json.loads(resp.read().decode('utf-8'))
+
+    allowed = [schedule_allows_now(schedule, now) for schedule in snapshot['schedules']]
+    known = []
+    out = []
+    for uid, schedule_id in snapshot['cards'].items():
+        (known if allowed[schedule_id] else out).append(uid)
+    return known, out
+
+def uids_from_file(fname):
+    """Read "uid label" lines into ([known], [out of schedule])"""
+    known = []
+    out = []
+    with open(fname) as uid_file:
+        for line in uid_file:
+            fields = line.split()
+            if len(fields) >= 2:
+                (known if fields[1] == 'known' else out).append(fields[0])
+    return known, out
+
+
+class LoadTest:
+    """Runs the requests and collects the results"""
+
+    def __init__(self, base_url, timeout):
+        if base_url[-1] != '/':
+            base_url += '/'
+        self.base_url = base_url
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.samples = {}   # endpoint -> [seconds]
+        self.answers = {}   # (endpoint, kind) -> Counter of answers
+        self.errors = Counter()
+
+    def request(self, endpoint, kind, uid):
+        """POST one uid to an endpoint, the way post.py does"""
+        data = urllib.parse.urlencode({'id': uid}).encode('utf-8')
+        req = urllib.request.Request(self.base_url + ENDPOINTS[endpoint], data)
+
+        t1 = perf_counter()
+        try:
+            resp = urllib.request.urlopen(req, timeout=self.timeout)
+            text = resp.read()
+        except Exception as err:
+            with self.lock:
+                self.errors[(endpoint, type(err).__name__)] += 1
+            return
+        t2 = perf_counter()
+
+        if endpoint == 'auth':
+            answer = text.decode('utf-8', 'replace')
+        else:
+            answer = 'schedule' if text.strip() not in (b'{}', b'') else 'empty'
+
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(t2 - t1)
+            self.answers.setdefault((endpoint, kind), Counter())[answer] += 1
+
+    def run(self, jobs, concurrency):
+        """Run (endpoint, kind, uid) jobs on concurrency threads, returns the wall time"""
+        t1 = perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for job in jobs:
+                pool.submit(self.request, *job)
+        return perf_counter() - t1
+
+    def report(self, elapsed):
+        total = sum(len(samples) for samples in self.samples.values())
+        print("{} requests in {:.2f} s = {:.0f} req/s, {} errors".format(
+            total, elapsed, total / elapsed if elapsed else 0, sum(self.errors.values())))
+
+        for endpoint, samples in sorted(self.samples.items()):
+            samples.sort()
+            print("{:>7}: n={} mean={:.1f} ms p50={:.1f} ms p90={:.1f} ms p99={:.1f} ms "
+                  "max={:.1f} ms".format(endpoint, len(samples),
+                                         sum(samples) / len(samples) * 1000,
+                                         percentile(samples, 50) * 1000,
+                                         percentile(samples, 90) * 1000,
+                                         percentile(samples, 99) * 1000,
+                                         samples[-1] * 1000))
+
+        for (endpoint, kind), answers in sorted(self.answers.items()):
+            print("{:>7} {:>8}: {}".format(endpoint, kind, dict(answers)))
+        for (endpoint, error), count in sorted(self.errors.items()):
+            print("{:>7} error {}: {}".format(endpoint, error, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the MSYS auth endpoints")
+    parser.add_argument('--url', default='http://127.0.0.1:8000/members/')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mix', default='known=70,out=20,unknown=10',
+                        help="weights of the known, out (of schedule) and unknown uids")
+    parser.add_argument('--endpoints', default='auth=80,weekly=20')
+    parser.add_argument('--uids', help="file of 'uid known|out' lines instead of the snapshot")
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--utc-offset', type=float,
+                        help="hours between UTC and the server time (default: local time)")
+    args = parser.parse_args()
+
+    if args.utc_offset is None:
+        now = datetime.datetime.now()
+    else:
+        now = datetime.datetime.utcnow() + datetime.timedelta(hours=args.utc_offset)
+
+    test = LoadTest(args.url, args.timeout)
+    if args.uids:
+        known, out = uids_from_file(args.uids)
+    else:
+        known, out = uids_from_snapshot(test.base_url, args.timeout, now)
+    print("{} cards with access now, {} out of schedule".format(len(known), len(out)))
+
+    rng = random.Random(args.seed)
+    pools = {'known': known, 'out': out}
+    kinds, kind_weights = parse_mix(args.mix)
+    endpoints, endpoint_weights = parse_mix(args.endpoints)
+
+    jobs = []
+    for n in range(args.requests):
+        endpoint = rng.choices(endpoints, endpoint_weights)[0]
+        kind = rng.choices(kinds, kind_weights)[0]
+        if pools.get(kind):
+            uid = rng.choice(pools[kind])
+        else:
+            kind = 'unknown'
+            uid = '{:016x}'.format(rng.getrandbits(64))
+        jobs.append((endpoint, kind, uid))
+
+    elapsed = test.run(jobs, args.concurrency)
+    test.report(elapsed)
+
+if __name__ == '__main__':
+    main()
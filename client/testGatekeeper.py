@@ -1,13 +1,23 @@
 import unittest
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 from multiprocessing import Process
 from time import sleep
 import json
 import os
+import queue
+import tempfile
+import threading
+import time
 
+from cache_store import CacheStore
+from door_timer import DoorTimer
+from event_queue import EventQueue
 from gatekeeper import Gatekeeper
 
+ALWAYS = {d: {"start": "00:00:00", "end": "23:59:59"} for d in
+          ["mon", "tues", "wed", "thurs", "fri", "sat", "sun"]}
+
 class dummyserver(BaseHTTPRequestHandler):
 
     reply = b"TEST"
@@ -40,7 +50,13 @@ class TestAuth(unittest.TestCase):
 
     def setUp(self):
         self.p = Process(target=doSrv)
-        self.g = Gatekeeper("http://127.0.0.1:4125")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.g = Gatekeeper("http://127.0.0.1:4125", cache_dir=self.tmp.name)
+
+    def tearDown(self):
+        self.g.cache.close()
+        self.g.events.close()
+        self.tmp.cleanup()
 
     def test_pos_auth(self):
         dummyserver.reply = b"Granted"
@@ -64,10 +80,379 @@ class TestAuth(unittest.TestCase):
         self.assertFalse(ret)
 
     def test_missing_srv(self):
-        g = Gatekeeper("http://240.0.0.0:4125")
+        g = Gatekeeper("http://240.0.0.0:4125", cache_dir=self.tmp.name)
         ret = g.authenticate("beefcafe")
         self.assertFalse(ret)
 
+class keepaliveserver(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    posts = 0
+    bodies = [] # (path, body) of every POST
+    reply = b"Granted"
+    documents = {} # path -> object sent as JSON to a GET
+    held = {} # path -> threading.Event set when the POST to it may be answered
+    replies = {} # path -> body answered to a POST instead of reply
+
+    def setup(self):
+        keepaliveserver.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(s):
+        if s.path in keepaliveserver.documents:
+            s.send_text(json.dumps(keepaliveserver.documents[s.path]).encode('utf-8'))
+        else:
+            s.send_text(b"Nope")
+
+    def do_POST(s):
+        body = s.rfile.read(int(s.headers['Content-Length']))
+        keepaliveserver.bodies.append((s.path, body))
+        keepaliveserver.posts += 1
+        if s.path in keepaliveserver.held:
+            keepaliveserver.held[s.path].wait(5)
+        s.send_text(keepaliveserver.replies.get(s.path, keepaliveserver.reply))
+
+    def send_text(s, text):
+        s.send_response(200)
+        s.send_header("Content-type", "text/plain")
+        s.send_header("Content-Length", str(len(text)))
+        s.end_headers()
+        s.wfile.write(text)
+
+    def log_message(self, *args):
+        pass
+
+class KeepAliveTestCase(unittest.TestCase):
+    """Runs keepaliveserver in a thread for the duration of each test"""
+
+    def setUp(self):
+        keepaliveserver.connections = 0
+        keepaliveserver.posts = 0
+        keepaliveserver.bodies = []
+        keepaliveserver.reply = b"Granted"
+        keepaliveserver.documents = {}
+        keepaliveserver.held = {}
+        keepaliveserver.replies = {}
+        #the Gatekeeper keeps two connections open, for the swipes and the background
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), keepaliveserver)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.g = Gatekeeper("http://127.0.0.1:{}".format(self.httpd.server_port),
+                            cache_dir=self.tmp.name)
+
+    def tearDown(self):
+        self.g.server.close()
+        self.g.background.close()
+        self.g.watch.close()
+        self.g.cache.close()
+        self.g.events.close()
+        self.tmp.cleanup()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+class TestConnection(KeepAliveTestCase):
+
+    def setUp(self):
+        KeepAliveTestCase.setUp(self)
+        #every authenticate() goes to the server
+        self.g.decision_window = 0
+
+    def test_reuse(self):
+        for n in range(3):
+            self.assertTrue(self.g.authenticate("beefcafe"))
+        self.assertEqual(self.g.server.connects, 1)
+
+    def test_reconnect(self):
+        self.assertTrue(self.g.authenticate("beefcafe"))
+        #the server drops idle connections
+        self.g.server.conn.sock.shutdown(2)
+        self.assertTrue(self.g.authenticate("beefcafe"))
+        self.assertEqual(self.g.server.connects, 2)
+
+    def test_keep_warm(self):
+        self.g.start_keep_warm(0.1)
+        sleep(0.5)
+        self.g.server.stop_keep_warm()
+        self.assertEqual(keepaliveserver.connections, 1)
+        self.assertGreater(self.g.server.last_used, 0)
+
+    def test_background(self):
+        self.g.record_event("e1", "beefcafe", True)
+        keepaliveserver.held["/access/events/"] = threading.Event()
+        upload = threading.Thread(target=self.g.upload_events)
+        upload.start()
+        for n in range(50):
+            if keepaliveserver.posts:
+                break
+            sleep(0.05)
+
+        #the swipe does not wait for the upload to be answered
+        started = time.monotonic()
+        self.assertTrue(self.g.authenticate("beefcafe"))
+        self.assertLess(time.monotonic() - started, 1)
+        keepaliveserver.held["/access/events/"].set()
+        upload.join()
+        self.assertEqual(self.g.server.connects, 1)
+        self.assertEqual(self.g.background.connects, 1)
+
+class TestSpeculative(KeepAliveTestCase):
+
+    def setUp(self):
+        KeepAliveTestCase.setUp(self)
+        self.g.speculative = True
+        self.g.cache.put("spec.test", json.dumps(ALWAYS))
+
+    def wait_for_server(self):
+        for n in range(50):
+            if keepaliveserver.connections:
+                sleep(0.1)
+                return
+            sleep(0.05)
+
+    def test_confirmed(self):
+        self.assertTrue(self.g.authenticate("spec.test"))
+        self.wait_for_server()
+        self.assertIsNotNone(self.g.cache.get("spec.test"))
+        self.assertEqual(self.g.discrepancies, [])
+
+    def test_revoked(self):
+        keepaliveserver.reply = b"Denied"
+        keepaliveserver.replies["/weekly_access/"] = b"{}"
+        self.assertTrue(self.g.authenticate("spec.test"))
+        self.wait_for_server()
+        self.assertEqual([rfid for t, rfid in self.g.discrepancies], ["spec.test"])
+        #refreshed with what the server says now
+        self.g.stop_refresh()
+        self.assertEqual(self.g.cache.get("spec.test")[0], "{}")
+        self.assertFalse(self.g.authenticate("spec.test"))
+
+    def test_stale(self):
+        old = time.time() - Gatekeeper.SPECULATIVE_FRESH_T - 1
+        self.g.cache.put("spec.test", json.dumps(ALWAYS), old)
+        keepaliveserver.reply = b"Denied"
+        self.assertFalse(self.g.authenticate("spec.test"))
+
+class TestSync(KeepAliveTestCase):
+
+    #the snapshot format, as opposed to the weekly_access one
+    always = {d: [["00:00:00", "23:59:59"]] for d in ALWAYS}
+
+    def setUp(self):
+        KeepAliveTestCase.setUp(self)
+        self.g.SYNC_PAGE_SIZE = 2
+        keepaliveserver.documents = {
+            "/access/snapshot/?after=&limit=2":
+                {"version": 5, "schedules": [self.always, {}], "cards": {"a": 0, "b": 1},
+                 "next": "b"},
+            "/access/snapshot/?after=b&limit=2":
+                {"version": 5, "schedules": [self.always], "cards": {"c": 0}, "next": None},
+            "/access/changes/?since=5":
+                {"version": 7, "full": False, "schedules": [self.always], "cards": {"b": 0},
+                 "removed": ["a"]},
+        }
+
+    def test_snapshot(self):
+        self.g.cache.put("old", json.dumps(ALWAYS))
+        self.assertTrue(self.g.sync())
+        self.assertEqual(self.g.sync_version, 5)
+        self.assertTrue(self.g.auth_from_cache("a"))
+        self.assertFalse(self.g.auth_from_cache("b"))
+        self.assertTrue(self.g.auth_from_cache("c"))
+        self.assertIsNone(self.g.cache.get("old"))
+
+    def test_changes(self):
+        self.g.sync()
+        self.assertTrue(self.g.sync())
+        self.assertEqual(self.g.sync_version, 7)
+        self.assertIsNone(self.g.cache.get("a"))
+        self.assertTrue(self.g.auth_from_cache("b"))
+
+    def test_changed_while_paging(self):
+        keepaliveserver.documents["/access/snapshot/?after=b&limit=2"]["version"] = 6
+        self.assertTrue(self.g.sync())
+        self.assertEqual(self.g.sync_version, 7)
+        self.assertEqual(sorted(self.g.cache.uids()), ["b", "c"])
+
+    def test_fresh_after_sync(self):
+        self.g.sync()
+        old = time.time() - Gatekeeper.CACHE_STALE_T - 1
+        self.g.cache.put("c", json.dumps(self.always), old)
+        self.assertTrue(self.g.auth_from_cache("c"))
+
+    def test_unreachable(self):
+        keepaliveserver.documents = {}
+        self.assertFalse(self.g.sync())
+        self.assertIsNone(self.g.sync_version)
+
+    def test_wait_for_changes(self):
+        self.g.SYNC_WAIT = 1
+        keepaliveserver.documents["/access/wait/?since=5&timeout=1"] = {"version": 7,
+                                                                        "changed": True}
+        self.g.start_sync(60, watch=True)
+        for n in range(100):
+            if self.g.sync_version == 7:
+                break
+            sleep(0.05)
+        #synced again as soon as the server reported the change, not 60 seconds later
+        self.g.stop_sync()
+        self.assertEqual(self.g.sync_version, 7)
+        self.assertTrue(self.g.auth_from_cache("b"))
+
+    def test_no_changes(self):
+        self.g.sync()
+        keepaliveserver.documents["/access/wait/?since=5&timeout=1"] = {"version": 5,
+                                                                        "changed": False}
+        self.assertTrue(self.g.wait_for_changes(0.5))
+        self.assertEqual(self.g.sync_version, 5)
+
+class TestDecisions(KeepAliveTestCase):
+
+    def test_repeat(self):
+        for n in range(3):
+            self.assertTrue(self.g.authenticate("beefcafe"))
+        self.assertEqual(keepaliveserver.posts, 1)
+        self.assertTrue(self.g.recent_decision("beefcafe"))
+        self.assertIsNone(self.g.recent_decision("cafebabe"))
+
+    def test_denied(self):
+        keepaliveserver.reply = b"Denied"
+        self.assertFalse(self.g.authenticate("beefcafe"))
+        keepaliveserver.reply = b"Granted"
+        self.assertFalse(self.g.authenticate("beefcafe"))
+        self.assertEqual(keepaliveserver.posts, 1)
+
+    def test_window(self):
+        self.g.decision_window = 0.1
+        self.assertTrue(self.g.authenticate("beefcafe"))
+        sleep(0.2)
+        self.assertIsNone(self.g.recent_decision("beefcafe"))
+        self.assertTrue(self.g.authenticate("beefcafe"))
+        self.assertEqual(keepaliveserver.posts, 2)
+        self.assertEqual(list(self.g.decisions), ["beefcafe"])
+
+class TestEvents(KeepAliveTestCase):
+
+    def test_recorded(self):
+        self.g.door_id = "front"
+        self.assertTrue(self.g.authenticate("beefcafe"))
+        [(seq, event)] = self.g.events.peek(10)
+        self.assertEqual(event['uid'], "beefcafe")
+        self.assertEqual(event['door'], "front")
+        self.assertTrue(event['granted'])
+
+        #the server logs it under the same id
+        path, body = keepaliveserver.bodies[-1]
+        self.assertEqual(path, "/auth/")
+        self.assertIn("event={}".format(event['event_id']), body.decode('utf-8'))
+
+    def test_upload(self):
+        self.g.EVENT_BATCH_SIZE = 1
+        self.g.authenticate("beefcafe")
+        self.g.authenticate("cafebabe")
+        keepaliveserver.reply = b'{"stored": 1, "duplicates": 0}'
+        self.assertEqual(self.g.upload_events(), 2)
+        self.assertEqual(len(self.g.events), 0)
+
+        path, body = keepaliveserver.bodies[-1]
+        self.assertEqual(path, "/access/events/")
+        self.assertEqual([event['uid'] for event in json.loads(body.decode('utf-8'))],
+                         ["cafebabe"])
+
+    def test_offline(self):
+        g = Gatekeeper("http://127.0.0.1:1", cache_dir=self.tmp.name)
+        g.cache.put("beefcafe", json.dumps(ALWAYS))
+        self.assertTrue(g.authenticate("beefcafe"))
+        self.assertEqual(g.upload_events(), 0)
+        g.cache.close()
+        g.events.close()
+
+        #still there for the next upload, even after a restart
+        self.assertEqual(len(self.g.events), 1)
+        self.assertEqual(self.g.upload_events(), 1)
+        self.assertEqual(len(self.g.events), 0)
+
+class TestEventQueue(unittest.TestCase):
+
+    def test_queue(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'events.sqlite3')
+            events = EventQueue(path)
+            for n in range(3):
+                events.append({'n': n})
+            batch = events.peek(2)
+            self.assertEqual([event for seq, event in batch], [{'n': 0}, {'n': 1}])
+            events.ack(batch[-1][0])
+            events.close()
+
+            events = EventQueue(path)
+            self.assertEqual([event for seq, event in events.peek(10)], [{'n': 2}])
+            events.close()
+
+class TestRefresh(KeepAliveTestCase):
+
+    def test_refresh(self):
+        keepaliveserver.reply = json.dumps(ALWAYS).encode('utf-8')
+        self.assertTrue(self.g.refresh_later("beefcafe"))
+        self.g.stop_refresh()
+        self.assertEqual(json.loads(self.g.cache.get("beefcafe")[0]), ALWAYS)
+        self.assertTrue(self.g.auth_from_cache("beefcafe"))
+
+    def test_coalesce(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def update_cache(rfid):
+            calls.append(rfid)
+            started.set()
+            release.wait(5)
+        self.g.update_cache = update_cache
+        self.g.refresh_queue = queue.Queue(1)
+
+        self.g.refresh_later("a")
+        started.wait(5)
+        #"a" is being refreshed, it can be queued again
+        for n in range(3):
+            self.assertTrue(self.g.refresh_later("a"))
+        self.assertFalse(self.g.refresh_later("b"))
+        release.set()
+        self.g.stop_refresh()
+        self.assertEqual(calls, ["a", "a"])
+
+class TestDoorTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.actions = []
+        self.timer = DoorTimer(lambda: self.actions.append("unlock"),
+                               lambda: self.actions.append("lock"))
+
+    def test_open(self):
+        self.timer.open_for(0.2)
+        self.assertTrue(self.timer.is_open())
+        self.assertEqual(self.actions, ["unlock"])
+        sleep(0.4)
+        self.assertFalse(self.timer.is_open())
+        self.assertEqual(self.actions, ["unlock", "lock"])
+
+    def test_extend(self):
+        self.timer.open_for(0.3)
+        sleep(0.2)
+        self.timer.open_for(0.3)
+        sleep(0.2)
+        #past the first deadline, still open
+        self.assertEqual(self.actions, ["unlock"])
+        sleep(0.3)
+        self.assertEqual(self.actions, ["unlock", "lock"])
+
+    def test_close(self):
+        self.timer.open_for(10)
+        self.timer.close()
+        self.assertFalse(self.timer.is_open())
+        self.assertEqual(self.actions, ["unlock", "lock"])
+
 class TestCache(unittest.TestCase):
 
     pos_data = {}
@@ -82,45 +467,89 @@ class TestCache(unittest.TestCase):
            cls.pos_data[d] = {"start": "00:00:00", "end":"23:59:59"}
            cls.neg_data[d] = {"start": "04:00:00", "end":"04:00:01"}
 
-        #now create the db test files
-        base = os.path.dirname(os.path.abspath(__file__))
-        db_good = "{}/db/{}.json".format(base, "good.test")
-        db_bad = "{}/db/{}.json".format(base, "bad.test")
-
-        try:
-            db_file = open(db_good, 'w')
-            #db_file.write(json.dumps(cls.pos_data))
-            json.dump(cls.pos_data, db_file)
-            db_file.close()
-
-            db_file = open(db_bad, 'w')
-            #db_file.write(json.dumps(cls.neg_data))
-            json.dump(cls.neg_data, db_file)
-            db_file.close()
-        except Exception as err:
-            print("Error writing test DB files")
-            print("err: [{}]".format(err))
-            raise
+    def setUp(self):
+        #old style cache files, imported when the store is created
+        self.tmp = tempfile.TemporaryDirectory()
+        for name, data in [("good.test", TestCache.pos_data), ("bad.test", TestCache.neg_data)]:
+            with open("{}/{}.json".format(self.tmp.name, name), 'w') as db_file:
+                json.dump(data, db_file)
+        self.g = Gatekeeper("http://127.0.0.1:4125", cache_dir=self.tmp.name)
+
+    def tearDown(self):
+        self.g.cache.close()
+        self.g.events.close()
+        self.tmp.cleanup()
 
     def test_json_pos(self):
-        g = Gatekeeper("http://127.0.0.1:4125")
-        ret = g.json_has_access_now(json.dumps(TestCache.pos_data))
+        ret = self.g.json_has_access_now(json.dumps(TestCache.pos_data))
         self.assertTrue(ret)
 
     def test_json_neg(self):
-        g = Gatekeeper("http://127.0.0.1:4125")
-        ret = g.json_has_access_now(json.dumps(TestCache.neg_data))
+        ret = self.g.json_has_access_now(json.dumps(TestCache.neg_data))
         self.assertFalse(ret)
 
     def test_cache_positive(self):
-        g = Gatekeeper("http://127.0.0.1:4125")
-        ret = g.auth_from_cache("good.test")
+        ret = self.g.auth_from_cache("good.test")
         self.assertTrue(ret)
 
     def test_cache_negative(self):
-        g = Gatekeeper("http://127.0.0.1:4125")
-        ret = g.auth_from_cache("bad.test")
+        ret = self.g.auth_from_cache("bad.test")
         self.assertFalse(ret)
-        
+
+    def test_cache_stale(self):
+        self.g.cache.put("good.test", json.dumps(TestCache.pos_data),
+                         time.time() - Gatekeeper.CACHE_STALE_T - 1)
+        self.assertFalse(self.g.auth_from_cache("good.test"))
+
+    def test_cache_missing(self):
+        self.assertFalse(self.g.auth_from_cache("missing.test"))
+
+class TestCacheStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'cache.sqlite3')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_persistent(self):
+        store = CacheStore(self.path)
+        store.put("beefcafe", "{}", 1234.5)
+        store.close()
+
+        store = CacheStore(self.path)
+        self.assertEqual(store.get("beefcafe"), ("{}", 1234.5))
+        store.delete("beefcafe")
+        self.assertIsNone(store.get("beefcafe"))
+        self.assertEqual(len(store), 0)
+        store.close()
+
+    def test_lru(self):
+        store = CacheStore(self.path, lru_size=2)
+        for uid in ["a", "b", "c"]:
+            store.put(uid, "{}")
+        self.assertEqual(list(store.lru), ["b", "c"])
+        store.get("b")
+        store.get("a")
+        self.assertEqual(list(store.lru), ["b", "a"])
+        self.assertEqual(len(store), 3)
+        store.close()
+
+    def test_import_once(self):
+        fname = os.path.join(self.tmp.name, "beefcafe.json")
+        with open(fname, 'w') as db_file:
+            db_file.write("{}")
+        os.utime(fname, (1000, 1000))
+        store = CacheStore(self.path, import_dir=self.tmp.name)
+        self.assertEqual(store.get("beefcafe"), ("{}", 1000))
+        store.delete("beefcafe")
+        store.close()
+
+        #not imported again
+        store = CacheStore(self.path, import_dir=self.tmp.name)
+        self.assertIsNone(store.get("beefcafe"))
+        store.close()
+
 if __name__ == '__main__':
     unittest.main()
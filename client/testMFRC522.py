@@ -0,0 +1,129 @@
+import unittest
+
+import sys
+import time
+import types
+
+
+class FakeBus():
+    """
+    Stands in for the spi module: answers reads from regs, or from fifo for FIFODataReg,
+    and keeps every transfer
+    """
+
+    FIFO = 0x09 # FIFODataReg
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.regs = {}
+        self.fifo = []
+        self.transfers = []
+
+    def openSPI(self, device, speed):
+        pass
+
+    def read(self, addr):
+        if addr == self.FIFO:
+            return self.fifo.pop(0) if self.fifo else 0
+        return self.regs.get(addr, 0)
+
+    def transfer(self, data):
+        self.transfers.append(data)
+        if not data[0] & 0x80:
+            return (0,) * len(data)
+        #the answer to each read address comes with the next byte
+        return (0,) + tuple(self.read((addr >> 1) & 0x3F) for addr in data[:-1])
+
+bus = FakeBus()
+
+#MFRC522 imports the hardware modules of the Raspberry Pi, give it these instead
+GPIO = types.ModuleType('RPi.GPIO')
+GPIO.BOARD = GPIO.OUT = GPIO.IN = 0
+GPIO.setmode = GPIO.setup = GPIO.output = lambda *args: None
+RPi = types.ModuleType('RPi')
+RPi.GPIO = GPIO
+sys.modules['RPi'] = RPi
+sys.modules['RPi.GPIO'] = GPIO
+sys.modules['spi'] = bus
+
+from MFRC522 import MFRC522
+
+
+class ReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        bus.reset()
+        self.reader = MFRC522(timeout=0.02)
+        bus.transfers = []
+        self.reader.transactions = 0
+
+class TestToCard(ReaderTestCase):
+
+    def test_no_tag(self):
+        #the chip's timer ran out (TimerIRq): nobody answered
+        bus.regs[MFRC522.CommIrqReg] = 0x01
+        status, data, bits = self.reader.MFRC522_ToCard(MFRC522.PCD_TRANSCEIVE, [0x26])
+        self.assertEqual(status, MFRC522.MI_NOTAGERR)
+
+    def test_answer(self):
+        bus.regs[MFRC522.CommIrqReg] = 0x30
+        bus.regs[MFRC522.FIFOLevelReg] = 2
+        bus.fifo = [0x04, 0x00]
+        status, data, bits = self.reader.MFRC522_ToCard(MFRC522.PCD_TRANSCEIVE, [0x26])
+        self.assertEqual(status, MFRC522.MI_OK)
+        self.assertEqual(data, [0x04, 0x00])
+        self.assertEqual(bits, 16)
+
+    def test_deadline(self):
+        #CommIrqReg never changes, the wait has to give up on its own
+        started = time.perf_counter()
+        status, data, bits = self.reader.MFRC522_ToCard(MFRC522.PCD_TRANSCEIVE, [0x26])
+        elapsed = time.perf_counter() - started
+        self.assertEqual(status, MFRC522.MI_ERR)
+        self.assertGreaterEqual(elapsed, 0.02)
+        self.assertLess(elapsed, 1)
+
+    def test_stats(self):
+        self.reader.MFRC522_ToCard(MFRC522.PCD_TRANSCEIVE, [0x26])
+        bus.regs[MFRC522.CommIrqReg] = 0x30
+        self.reader.MFRC522_ToCard(MFRC522.PCD_TRANSCEIVE, [0x26])
+
+        calls, timeouts, total, worst = self.reader.stats[MFRC522.PCD_TRANSCEIVE]
+        self.assertEqual((calls, timeouts), (2, 1))
+        self.assertGreaterEqual(worst, 0.02)
+        stats = self.reader.MFRC522_Stats()[MFRC522.PCD_TRANSCEIVE]
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['max_ms'], 20)
+
+class TestTransfers(ReaderTestCase):
+
+    def test_anticoll(self):
+        bus.regs[MFRC522.CommIrqReg] = 0x30
+        bus.regs[MFRC522.FIFOLevelReg] = 5
+        serial = [0xde, 0xad, 0xbe, 0xef]
+        bus.fifo = serial + [0xde ^ 0xad ^ 0xbe ^ 0xef]
+        status, data = self.reader.MFRC522_Anticoll()
+        self.assertEqual(status, MFRC522.MI_OK)
+        self.assertEqual(data[:4], serial)
+        #23 with one transfer per FIFO byte and a read before every bit mask change
+        self.assertEqual(self.reader.transactions, 14)
+        self.assertEqual(len(bus.transfers), 14)
+
+    def test_burst_read(self):
+        data = [0x11, 0x22, 0x33, 0x44, 0x55]
+        bus.fifo = list(data)
+        one_by_one = [self.reader.Read_MFRC522(MFRC522.FIFODataReg) for n in range(5)]
+        bus.fifo = list(data)
+        self.assertEqual(self.reader.Read_MFRC522_Burst(MFRC522.FIFODataReg, 5), one_by_one)
+        self.assertEqual(one_by_one, data)
+        self.assertEqual(self.reader.transactions, 6)
+
+    def test_burst_write(self):
+        self.reader.Write_MFRC522_Burst(MFRC522.FIFODataReg, [0x93, 0x20])
+        self.assertEqual(bus.transfers, [((MFRC522.FIFODataReg << 1) & 0x7E, 0x93, 0x20)])
+
+if __name__ == '__main__':
+    unittest.main()
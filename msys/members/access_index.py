@@ -0,0 +1,179 @@
+"""
+Access Index
+
+A process-wide, compiled view of who may open the door and when.
+
+Authenticating a swipe through the ORM costs one query for the card, one for its
+AccessGroups and one more per group for the TimeBlocks. Instead, the index loads every
+AccessCard, the AccessGroup memberships and the precompiled AccessGroup schedules in three
+queries and folds them into a dictionary of card key -> weekly mask (see schedule.py). A
+swipe is then a dictionary lookup plus a bit test.
+
+The index is rebuilt lazily: signal handlers (see signals.py) call invalidate() whenever
+cards, groups, members or blocks change and the next lookup compiles a fresh copy.
+Bulk operations that bypass signals (QuerySet.update(), bulk_create()...) must call
+signals.rules_changed() themselves.
+
+Each compiled copy remembers the AccessRulesVersion it was built from. Signals only reach
+the process that made the change, so other processes call refresh_if_stale() (one small
+query) where being current matters.
+"""
+import threading
+from collections import defaultdict, namedtuple
+
+from .schedule import mask_has_access, mask_from_bytes
+from .uid import uid_key, normalize_uid
+
+
+class CardEntry(namedtuple('CardEntry', ['pk', 'member_id', 'uid', 'label', 'mask'])):
+    """
+    Compiled information about a single AccessCard
+
+    label is the same text as str(AccessCard) so that logs do not need to hit the database.
+    """
+    __slots__ = ()
+
+    def has_access_at_time(self, date, time):
+        """Check if this card grants access at a given date and time"""
+        return mask_has_access(self.mask, date, time)
+
+    def __str__(self):
+        return self.label
+
+
+Compiled = namedtuple('Compiled', ['entries', 'version'])
+
+
+class AccessIndex:
+    """
+    Compiled mapping of card key (see uid.py) -> list of CardEntry
+
+    A list is kept per key because cards saved before AccessCard.key existed may share a uid.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._compiled = None
+        self._generation = 0
+        self._snapshot = None
+
+    def invalidate(self):
+        """Throw away the compiled data. The next lookup will rebuild it."""
+        self._generation += 1
+        self._compiled = None
+
+    def refresh_if_stale(self):
+        """
+        Invalidate the index if the access rules were changed by another process
+
+        Costs one query.
+        """
+        from .models import AccessRulesVersion
+
+        compiled = self._compiled
+        if compiled is not None and compiled.version != AccessRulesVersion.current():
+            self.invalidate()
+
+    def lookup(self, uid):
+        """
+        Get the CardEntry objects for a uid, in whatever form it was given
+
+        Returns an empty tuple if no card matches.
+        """
+        try:
+            key = uid_key(uid)
+        except ValueError:
+            return ()
+
+        return self._get().entries.get(key, ())
+
+    def has_access_at_time(self, uid, date, time):
+        """Check if any card with the given uid grants access at a given date and time"""
+        for entry in self.lookup(uid):
+            if entry.has_access_at_time(date, time):
+                return True
+        return False
+
+    def version(self):
+        """The AccessRulesVersion the compiled data was built from"""
+        return self._get().version
+
+    def snapshot(self):
+        """
+        Get the weekly mask of every card
+
+        Returns (version, masks) where masks is a dict of canonical uid -> weekly mask.
+        The result is kept until the index is rebuilt.
+        """
+        compiled = self._get()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] is not compiled:
+            masks = {}
+            for entries in compiled.entries.values():
+                for entry in entries:
+                    masks[entry.uid] = masks.get(entry.uid, 0) | entry.mask
+            snapshot = (compiled, masks)
+            self._snapshot = snapshot
+        return compiled.version, snapshot[1]
+
+    def _get(self):
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self._rebuild()
+        return compiled
+
+    def _rebuild(self):
+        with self._lock:
+            compiled = self._compiled
+            if compiled is not None:
+                #someone else rebuilt it while we were waiting for the lock
+                return compiled
+
+            generation = self._generation
+            compiled = self._build()
+
+            #only publish the result if nothing changed while we were compiling
+            if generation == self._generation:
+                self._compiled = compiled
+            return compiled
+
+    @staticmethod
+    def _build():
+        from .models import AccessCard, AccessGroup, AccessRulesVersion
+
+        #read the version first, the data read below can only be newer than it
+        version = AccessRulesVersion.current()
+
+        group_masks = {}
+        uncompiled = []
+        for group_id, schedule in AccessGroup.objects.values_list('pk', 'schedule'):
+            if schedule is None:
+                uncompiled.append(group_id)
+            else:
+                group_masks[group_id] = mask_from_bytes(schedule)
+        if uncompiled:
+            group_masks.update(AccessGroup.compile_schedules(uncompiled))
+
+        card_masks = defaultdict(int)
+        links = AccessGroup.card.through.objects.values_list('accesscard_id', 'accessgroup_id')
+        for card_id, group_id in links:
+            card_masks[card_id] |= group_masks.get(group_id, 0)
+
+        entries = {}
+        cards = AccessCard.objects.values_list('pk', 'unique_id', 'member_id',
+                                               'member__first_name', 'member__last_name')
+        for card_id, uid, member_id, first_name, last_name in cards:
+            #the key is computed here rather than read from AccessCard.key so that
+            #cards saved before the key column existed still open the door
+            try:
+                key = uid_key(uid)
+            except ValueError:
+                continue
+            label = '{} ({} {})'.format(uid, first_name, last_name)
+            entry = CardEntry(card_id, member_id, normalize_uid(uid), label, card_masks[card_id])
+            entries.setdefault(key, []).append(entry)
+
+        return Compiled(entries, version)
+
+
+index = AccessIndex()
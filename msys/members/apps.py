@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class MembersConfig(AppConfig):
+    name = 'members'
+
+    def ready(self):
+        #connect the signal receivers
+        from . import signals
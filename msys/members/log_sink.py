@@ -0,0 +1,146 @@
+"""
+Log Sink
+
+Takes log writes off the request path.
+
+Log rows (AccessEvent, LogEvent...) are built when the event happens
+but instead of being saved straight away they are queued in memory. A background thread
+writes them with one bulk_create() per model whenever enough rows have piled up or a few
+moments have passed, whichever comes first. Anything still queued is written when the
+process exits. When a batch can not be written its rows are saved one by one, and the ones
+that still fail are reported and dropped so that a single bad row can not hold up the rest.
+
+Set LOG_SINK_ASYNC = False in the settings to write every row immediately (the tests do
+this since they run inside a transaction).
+"""
+import atexit
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection, transaction
+
+
+class LogSink:
+    """
+    Queue of unsaved model instances that are written in batches by a worker thread
+    """
+
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 1.0 # seconds
+    MAX_PENDING = 10000
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+        self._stopping = False
+
+    def put(self, obj):
+        """Queue an unsaved model instance to be written"""
+        if not getattr(settings, 'LOG_SINK_ASYNC', True):
+            obj.save()
+            return
+
+        with self._cond:
+            if len(self._pending) >= self._max_pending():
+                #better to lose the oldest log line than run out of memory
+                print("LogSink: queue full, dropping [{}]".format(self._pending.pop(0)))
+            self._pending.append(obj)
+            self._start()
+            if len(self._pending) >= self._batch_size():
+                self._cond.notify()
+
+    def put_many(self, objs):
+        """Queue several unsaved model instances to be written"""
+        if not getattr(settings, 'LOG_SINK_ASYNC', True):
+            self._write(objs, raise_errors=True)
+            return
+
+        for obj in objs:
+            self.put(obj)
+
+    def flush(self):
+        """Write everything queued so far from the calling thread"""
+        with self._cond:
+            batch = self._pending
+            self._pending = []
+        self._write(batch)
+
+    def stop(self):
+        """Stop the worker thread and write whatever is left"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def pending(self):
+        """Number of rows waiting to be written"""
+        return len(self._pending)
+
+    def _batch_size(self):
+        return getattr(settings, 'LOG_SINK_BATCH_SIZE', self.BATCH_SIZE)
+
+    def _flush_interval(self):
+        return getattr(settings, 'LOG_SINK_FLUSH_INTERVAL', self.FLUSH_INTERVAL)
+
+    def _max_pending(self):
+        return getattr(settings, 'LOG_SINK_MAX_PENDING', self.MAX_PENDING)
+
+    def _start(self):
+        #called with the lock held
+        if self._thread is None and not self._stopping:
+            self._thread = threading.Thread(target=self._run, name="LogSink", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    if len(self._pending) < self._batch_size() and not self._stopping:
+                        self._cond.wait(self._flush_interval())
+                    batch = self._pending
+                    self._pending = []
+                    stopping = self._stopping
+
+                self._write(batch)
+                if stopping:
+                    return
+        finally:
+            connection.close()
+
+    def _write(self, batch, raise_errors=False):
+        if not batch:
+            return
+
+        by_model = OrderedDict()
+        for obj in batch:
+            by_model.setdefault(type(obj), []).append(obj)
+
+        for model, objs in by_model.items():
+            if raise_errors:
+                model.objects.bulk_create(objs)
+                continue
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create(objs)
+            except Exception as err:
+                print("LogSink: error writing {} {} rows: {}".format(len(objs),
+                                                                   model.__name__, err))
+                self._write_each(objs)
+
+    def _write_each(self, objs):
+        #find the rows that can not be written instead of losing (or retrying) them all
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save()
+            except Exception as err:
+                print("LogSink: dropping [{}]: {}".format(obj, err))
+
+
+sink = LogSink()
+atexit.register(sink.stop)
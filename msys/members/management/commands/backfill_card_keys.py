@@ -0,0 +1,47 @@
+"""
+Fill in AccessCard.key for cards saved before the column existed
+
+Also rewrites unique_id in its canonical form (see uid.py). Cards whose uid is invalid or
+already used by another card are reported and left alone; fix them through the card edit
+page and run the command again.
+
+Usage: python manage.py backfill_card_keys
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from members.models import AccessCard, AccessChange
+from members.signals import card_change, rules_changed
+from members.uid import normalize_uid, uid_key
+
+
+class Command(BaseCommand):
+    help = "Compute the integer key of every AccessCard that does not have one yet"
+
+    def handle(self, *args, **options):
+        taken = set(AccessCard.objects.exclude(key=None).values_list('key', flat=True))
+        updated = 0
+        changes = []
+
+        with transaction.atomic():
+            for card in AccessCard.objects.filter(key=None).order_by('pk'):
+                try:
+                    uid = normalize_uid(card.unique_id)
+                    key = uid_key(uid)
+                except ValueError as err:
+                    self.stdout.write("card {}: {}".format(card.pk, err))
+                    continue
+
+                if key in taken:
+                    self.stdout.write("card {}: uid [{}] is already used by another card".format(
+                        card.pk, uid))
+                    continue
+
+                #update() so that no signals are sent for every single card
+                AccessCard.objects.filter(pk=card.pk).update(unique_id=uid, key=key)
+                taken.add(key)
+                updated += 1
+                changes.append(card_change(AccessChange.ACTION_UPDATE, card.pk, uid))
+
+            rules_changed(changes)
+        self.stdout.write("{} cards updated".format(updated))
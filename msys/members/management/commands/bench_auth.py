@@ -0,0 +1,158 @@
+"""
+Benchmark the decision made by the auth view
+
+Populates a throw-away test database with a large number of cards and groups and compares
+the per-swipe latency of the ORM based check (what auth used to do) with the compiled
+access index.
+
+The auth batch endpoint is measured as well.
+
+Usage: python manage.py bench_auth [--cards 10000] [--groups 500] [--swipes 2000] [--batch 50]
+"""
+import datetime
+import json
+import random
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from members.access_index import index
+from members.log_sink import sink
+from members.models import Member, MemberType, AccessCard, AccessGroup, TimeBlock
+
+
+def percentile(samples, pct):
+    """Returns the pct-th percentile (0-100) of a sorted list of samples"""
+    pos = int(round((pct / 100.0) * (len(samples) - 1)))
+    return samples[pos]
+
+def populate(n_cards, n_groups, rng):
+    """Fill the (test) database with n_cards cards spread over n_groups groups"""
+    mtype = MemberType.objects.create(name="Member")
+    today = datetime.date.today()
+
+    Member.objects.bulk_create([
+        Member(number=n, type=mtype, first_name="Bench", last_name=str(n),
+               birth_date=today, first_seen_date=today, last_seen_date=today,
+               address="", city="", postal_code="", phone_number="", email="",
+               emergency_contact="", emergency_phone_number="")
+        for n in range(n_cards)])
+    member_ids = list(Member.objects.values_list('pk', flat=True))
+
+    AccessCard.objects.bulk_create([
+        AccessCard(member_id=member_ids[n], unique_id='{:08x}'.format(n), key=n)
+        for n in range(n_cards)])
+    card_ids = list(AccessCard.objects.values_list('pk', flat=True))
+
+    AccessGroup.objects.bulk_create([AccessGroup(name="group {}".format(n))
+                                     for n in range(n_groups)])
+    group_ids = list(AccessGroup.objects.values_list('pk', flat=True))
+
+    days = [code for code, _ in TimeBlock.DAY_CHOICES]
+    blocks = []
+    for group_id in group_ids:
+        for day in rng.sample(days, rng.randint(1, 7)):
+            start = rng.randint(0, 20)
+            end = rng.randint(start + 1, 23)
+            blocks.append(TimeBlock(group_id=group_id, day=day,
+                                    start=datetime.time(start), end=datetime.time(end, 59)))
+    TimeBlock.objects.bulk_create(blocks)
+
+    through = AccessGroup.card.through
+    links = []
+    for card_id in card_ids:
+        for group_id in rng.sample(group_ids, rng.randint(1, 4)):
+            links.append(through(accesscard_id=card_id, accessgroup_id=group_id))
+    through.objects.bulk_create(links)
+
+    #bulk_create does not send signals
+    index.invalidate()
+
+def orm_has_access_now(uid):
+    """The per-swipe decision as it was made before the access index existed"""
+    for card in AccessCard.objects.by_uid(uid):
+        if card.has_access_now():
+            return True
+    return False
+
+def index_has_access_now(uid):
+    """The per-swipe decision as made by the auth view"""
+    now = datetime.datetime.now()
+    return index.has_access_at_time(uid, now.date(), now.time())
+
+
+class Command(BaseCommand):
+    help = "Measure auth decision latency with and without the compiled access index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cards', type=int, default=10000)
+        parser.add_argument('--groups', type=int, default=500)
+        parser.add_argument('--swipes', type=int, default=2000)
+        parser.add_argument('--batch', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        #never touch the real database
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.stdout.write("Populating {} cards in {} groups...".format(options['cards'],
+                                                                          options['groups']))
+            populate(options['cards'], options['groups'], rng)
+
+            #a mix of known and unknown uids
+            uids = ['{:08x}'.format(rng.randrange(options['cards'] * 2))
+                    for n in range(options['swipes'])]
+
+            t1 = perf_counter()
+            index.lookup('0')
+            t2 = perf_counter()
+            self.stdout.write("Index compiled in {:.1f} ms".format((t2 - t1) * 1000))
+
+            self.run_case("orm", orm_has_access_now, uids)
+            self.run_case("index", index_has_access_now, uids)
+
+            client = Client()
+            def view(uid):
+                return client.post('/members/auth/', {'id': uid})
+            self.run_case("auth view", view, uids[:min(len(uids), 500)])
+
+            size = options['batch']
+            batches = [uids[n:n + size] for n in range(0, len(uids), size)]
+            def batch_view(chunk):
+                return client.post('/members/auth/batch/', json.dumps([[uid] for uid in chunk]),
+                                   content_type='application/json')
+            self.run_case("batch x{}".format(size), batch_view, batches, size)
+        finally:
+            #queued log rows belong to the test database
+            sink.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def run_case(self, name, func, items, swipes_per_item=1):
+        """Time func(item) for each item and print a summary"""
+        samples = []
+        with CaptureQueriesContext(connection) as queries:
+            for item in items:
+                t1 = perf_counter()
+                func(item)
+                t2 = perf_counter()
+                samples.append(t2 - t1)
+        samples.sort()
+
+        total = sum(samples)
+        self.stdout.write("{:>10}: n={} mean={:.3f} ms p50={:.3f} ms p99={:.3f} ms "
+                          "queries/call={:.2f} swipes/s={:.0f}".format(
+                              name, len(samples),
+                              total / len(samples) * 1000,
+                              percentile(samples, 50) * 1000,
+                              percentile(samples, 99) * 1000,
+                              len(queries) / len(samples),
+                              len(samples) * swipes_per_item / total))
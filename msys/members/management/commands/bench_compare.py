@@ -0,0 +1,58 @@
+"""
+Compare two microbench result files
+
+Flags every case whose median time per call grew by more than --threshold (a fraction,
+0.25 meaning 25%) or which now runs more SQL queries per call, and exits with an error
+if there is any. Cases missing from either file are listed but not counted.
+
+Usage: python manage.py bench_compare benchmarks/baseline.json results.json [--threshold 0.25]
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def compare(baseline, results, threshold):
+    """
+    Compare the cases of two microbench result dicts
+
+    Returns a list of (name, ratio, old queries, new queries, regressed) for the cases
+    found in both, ratio being new median / old median.
+    """
+    rows = []
+    for name, new in sorted(results['cases'].items()):
+        old = baseline['cases'].get(name)
+        if old is None:
+            continue
+        ratio = new['median_us'] / old['median_us'] if old['median_us'] else float('inf')
+        regressed = ratio > 1 + threshold or new['queries'] > old['queries']
+        rows.append((name, ratio, old['queries'], new['queries'], regressed))
+    return rows
+
+
+class Command(BaseCommand):
+    help = "Flag the microbench cases that got slower than a baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('baseline')
+        parser.add_argument('results')
+        parser.add_argument('--threshold', type=float, default=0.25)
+
+    def handle(self, *args, **options):
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+        with open(options['results']) as f:
+            results = json.load(f)
+
+        rows = compare(baseline, results, options['threshold'])
+        for name, ratio, old_queries, new_queries, regressed in rows:
+            self.stdout.write("{:>30}: {:6.2f}x  queries {:g} -> {:g}{}".format(
+                name, ratio, old_queries, new_queries, "  REGRESSION" if regressed else ""))
+
+        for name in sorted(set(baseline['cases']) ^ set(results['cases'])):
+            self.stdout.write("{:>30}: only in one of the files".format(name))
+
+        regressions = [row[0] for row in rows if row[4]]
+        if regressions:
+            raise CommandError("{} regression(s): {}".format(len(regressions),
+                                                             ", ".join(regressions)))
@@ -0,0 +1,105 @@
+"""
+Benchmark the auth view with synchronous and queued log writes
+
+Fires concurrent swipes at the auth view from several threads against a throw-away,
+file backed SQLite database (so that writers really compete for the database lock) and
+reports the throughput and latency with LOG_SINK_ASYNC off and on.
+
+Usage: python manage.py bench_log_sink [--threads 8] [--swipes 2000]
+"""
+import os
+import random
+import tempfile
+import threading
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from members.log_sink import sink
+from members.models import AccessEvent
+from members.management.commands.bench_auth import percentile, populate
+
+
+class Command(BaseCommand):
+    help = "Measure auth throughput with synchronous and queued access log writes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cards', type=int, default=1000)
+        parser.add_argument('--groups', type=int, default=50)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--swipes', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        setup_test_environment()
+        tmp_dir = tempfile.mkdtemp()
+        old_name = connection.settings_dict['NAME']
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tmp_dir, 'bench.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            populate(options['cards'], options['groups'], rng)
+            uids = ['{:08x}'.format(rng.randrange(options['cards'] * 2))
+                    for n in range(options['swipes'])]
+
+            with override_settings(LOG_SINK_ASYNC=False):
+                self.run_case("sync", uids, options['threads'])
+
+            with override_settings(LOG_SINK_ASYNC=True):
+                self.run_case("async", uids, options['threads'])
+                t1 = perf_counter()
+                sink.flush()
+                t2 = perf_counter()
+            self.stdout.write("final flush took {:.1f} ms".format((t2 - t1) * 1000))
+            self.stdout.write("log rows written: {}".format(AccessEvent.objects.count()))
+        finally:
+            #queued log rows belong to the test database
+            sink.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            os.rmdir(tmp_dir)
+
+    def run_case(self, name, uids, n_threads):
+        """Split the uids between n_threads threads posting to the auth view"""
+        samples = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker(chunk):
+            from django.db import connection as thread_connection
+            client = Client()
+            local = []
+            for uid in chunk:
+                t1 = perf_counter()
+                try:
+                    client.post('/members/auth/', {'id': uid})
+                except Exception as err:
+                    errors.append(err)
+                t2 = perf_counter()
+                local.append(t2 - t1)
+            thread_connection.close()
+            with lock:
+                samples.extend(local)
+
+        threads = [threading.Thread(target=worker, args=(uids[n::n_threads],))
+                   for n in range(n_threads)]
+
+        t1 = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        t2 = perf_counter()
+
+        samples.sort()
+        self.stdout.write("{:>6}: {} swipes / {} threads in {:.2f} s = {:.0f} swipes/s "
+                          "p50={:.2f} ms p99={:.2f} ms errors={}".format(
+                              name, len(samples), n_threads, t2 - t1,
+                              len(samples) / (t2 - t1),
+                              percentile(samples, 50) * 1000,
+                              percentile(samples, 99) * 1000,
+                              len(errors)))
@@ -0,0 +1,44 @@
+"""
+Delete old AccessChange rows
+
+Gatekeepers that last synced before the oldest remaining row get the full snapshot from
+views.access_changes instead of a delta, so the journal only needs to go back as far as
+the least frequently synced door.
+
+Usage: python manage.py compact_access_journal [--keep-days 30]
+"""
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Max
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from members.models import AccessChange, AccessRulesVersion
+
+
+class Command(BaseCommand):
+    help = "Delete the AccessChange rows older than a number of days"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-days', type=int, default=30)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options['keep_days'])
+
+        with transaction.atomic():
+            #rows sharing a number are deleted together, a partial change is no use
+            seq = (AccessChange.objects.filter(timestamp__lt=cutoff)
+                   .aggregate(seq=Max('seq'))['seq'])
+            if seq is None:
+                self.stdout.write("nothing to compact")
+                return
+
+            #record the new limit first so that no door is sent a delta with holes
+            AccessRulesVersion.objects.get_or_create(pk=1)
+            AccessRulesVersion.objects.filter(pk=1).update(
+                compacted=Greatest(F('compacted'), seq))
+            deleted, _ = AccessChange.objects.filter(seq__lte=seq).delete()
+
+        self.stdout.write("{} changes up to version {} deleted".format(deleted, seq))
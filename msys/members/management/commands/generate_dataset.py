@@ -0,0 +1,292 @@
+"""
+Fill the database with a synthetic population for scale testing
+
+Creates members of several MemberTypes with their memberships (some expired), promotions,
+access cards, access groups with TimeBlocks and a history of AccessEvent rows. Everything
+is drawn from a random.Random seeded with --seed, so the same options give the same
+data on an empty database, and written with bulk_create().
+
+The distributions are given as value=weight lists, e.g. --cards-per-member 1=80,2=15,0=5
+gives 80% of the members one card, 15% two cards and 5% none.
+
+Usage: python manage.py generate_dataset [--members 1000] [--logs 10000] [--seed 1]
+
+Do not run this against a production database: the rows are added to whatever is there.
+"""
+import datetime
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from members.models import Member, MemberType, Membership, Promotion, Promo_item, Promo_sub
+from members.models import AccessCard, AccessGroup, TimeBlock, AccessEvent
+from members.schedule import mask_has_access
+from members.signals import rules_reloaded
+from members.uid import uid_key
+
+
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Jamie', 'Robin',
+               'Charlie', 'Dominique', 'Camille', 'Noa', 'Eli', 'Sasha', 'Andrea', 'Kim']
+LAST_NAMES = ['Tremblay', 'Gagnon', 'Roy', 'Smith', 'Nguyen', 'Cote', 'Bouchard', 'Brown',
+              'Gauthier', 'Morin', 'Lavoie', 'Wilson', 'Fortin', 'Garcia', 'Pelletier', 'Li']
+CITIES = ['Montreal', 'Laval', 'Longueuil', 'Dorval', 'Verdun', 'Brossard']
+
+
+def parse_distribution(text, convert=int):
+    """
+    Parse a value=weight list such as "1=80,2=15,0=5"
+
+    Returns (values, weights) ready for random.choices(). Raises CommandError if the
+    text is malformed.
+    """
+    values = []
+    weights = []
+    try:
+        for item in text.split(','):
+            value, weight = item.split('=')
+            values.append(convert(value.strip()))
+            weights.append(float(weight))
+    except ValueError:
+        raise CommandError("bad distribution [{}], expected value=weight,...".format(text))
+    if not values or sum(weights) <= 0:
+        raise CommandError("bad distribution [{}], the weights add up to 0".format(text))
+    return values, weights
+
+def new_pks(model, after):
+    """The pks of the rows bulk_create() just added (it does not set them on SQLite)"""
+    return list(model.objects.filter(pk__gt=after).order_by('pk').values_list('pk', flat=True))
+
+def last_pk(model):
+    return model.objects.aggregate(pk=Max('pk'))['pk'] or 0
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic population of members, cards, groups and access logs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000)
+        parser.add_argument('--logs', type=int, default=10000,
+                            help="number of AccessEvent rows")
+        parser.add_argument('--log-days', type=int, default=365,
+                            help="the AccessEvent rows are spread over this many days")
+        parser.add_argument('--groups', type=int, default=20)
+        parser.add_argument('--promotions', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--types', default='Member=85,Staff=10,Guest=5',
+                            help="MemberType names and weights")
+        parser.add_argument('--cards-per-member', default='1=80,2=15,0=5')
+        parser.add_argument('--groups-per-card', default='1=60,2=30,3=10')
+        parser.add_argument('--memberships-per-member', default='1=50,2=25,3=15,0=10')
+        parser.add_argument('--expired', type=float, default=0.3,
+                            help="fraction of members whose last membership has expired")
+        parser.add_argument('--promo-ratio', type=float, default=0.1,
+                            help="fraction of members holding a promotional item")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.today = datetime.date.today()
+
+        type_dist = parse_distribution(options['types'], str)
+        card_dist = parse_distribution(options['cards_per_member'])
+        group_dist = parse_distribution(options['groups_per_card'])
+        ship_dist = parse_distribution(options['memberships_per_member'])
+
+        with transaction.atomic():
+            member_ids = self.make_members(options['members'], type_dist)
+            membership_ids = self.make_memberships(member_ids, ship_dist, options['expired'])
+            self.make_promotions(options['promotions'], member_ids, membership_ids,
+                                 options['promo_ratio'])
+            group_masks = self.make_groups(options['groups'])
+            cards = self.make_cards(member_ids, card_dist, group_dist, group_masks)
+            self.make_logs(options['logs'], options['log_days'], cards)
+
+            #none of the above went through the signals
+            rules_reloaded()
+
+    def make_members(self, count, type_dist):
+        """Create count members, returns their pks"""
+        rng = self.rng
+        names, weights = type_dist
+        types = {name: MemberType.objects.get_or_create(name=name)[0] for name in names}
+        type_list = [types[name] for name in names]
+
+        number = (Member.objects.aggregate(number=Max('number'))['number'] or 0) + 1
+        after = last_pk(Member)
+        members = []
+        for n in range(count):
+            first_seen = self.today - datetime.timedelta(days=rng.randrange(5 * 365))
+            last_seen = first_seen + datetime.timedelta(
+                days=rng.randint(0, (self.today - first_seen).days))
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = rng.choice(LAST_NAMES)
+            members.append(Member(
+                number=number + n,
+                type=rng.choices(type_list, weights)[0],
+                first_name=first_name,
+                last_name=last_name,
+                birth_date=datetime.date(rng.randint(1950, 2005), rng.randint(1, 12),
+                                         rng.randint(1, 28)),
+                first_seen_date=first_seen,
+                last_seen_date=last_seen,
+                address="{} rue {}".format(rng.randint(1, 9999), rng.choice(LAST_NAMES)),
+                city=rng.choice(CITIES),
+                postal_code="H{}{} {}{}{}".format(rng.randint(0, 9), rng.choice('ABCEGHJ'),
+                                                  rng.randint(0, 9), rng.choice('KLMNPRS'),
+                                                  rng.randint(0, 9)),
+                phone_number="514{:07d}".format(rng.randrange(10 ** 7)),
+                email="{}.{}.{}@example.com".format(first_name, last_name, number + n).lower(),
+                emergency_contact="{} {}".format(rng.choice(FIRST_NAMES),
+                                                 rng.choice(LAST_NAMES)),
+                emergency_phone_number="438{:07d}".format(rng.randrange(10 ** 7))))
+
+        Member.objects.bulk_create(members)
+        member_ids = new_pks(Member, after)
+        self.stdout.write("{} members".format(len(member_ids)))
+        return member_ids
+
+    def make_memberships(self, member_ids, ship_dist, expired):
+        """
+        Give each member back to back memberships ending in the future, or in the past
+        for the given fraction of them. Returns {member pk: [membership pks]}.
+        """
+        rng = self.rng
+        values, weights = ship_dist
+        after = last_pk(Membership)
+        memberships = []
+        owners = []
+        for member_id in member_ids:
+            if rng.random() < expired:
+                end = self.today - datetime.timedelta(days=rng.randint(1, 365))
+            else:
+                end = self.today + datetime.timedelta(days=rng.randint(1, 365))
+            for n in range(rng.choices(values, weights)[0]):
+                start = end - datetime.timedelta(days=rng.choice([30, 90, 365]))
+                memberships.append(Membership(member_id=member_id, start_date=start,
+                                              expire_date=end))
+                owners.append(member_id)
+                end = start
+
+        Membership.objects.bulk_create(memberships)
+        membership_ids = {}
+        for member_id, membership_id in zip(owners, new_pks(Membership, after)):
+            membership_ids.setdefault(member_id, []).append(membership_id)
+        self.stdout.write("{} memberships".format(len(memberships)))
+        return membership_ids
+
+    def make_promotions(self, count, member_ids, membership_ids, ratio):
+        """Create promotions and hand their items out to a fraction of the members"""
+        rng = self.rng
+        after = last_pk(Promotion)
+        Promotion.objects.bulk_create([
+            Promotion(name="Promotion {}".format(n + 1), quantity=rng.choice([10, 50, 100]))
+            for n in range(count)])
+        promo_ids = new_pks(Promotion, after)
+        if not promo_ids:
+            return
+
+        items = []
+        subs = []
+        for member_id in member_ids:
+            if rng.random() >= ratio:
+                continue
+            promo_id = rng.choice(promo_ids)
+            total = rng.choice([1, 5, 10])
+            items.append(Promo_item(promo_id=promo_id, member_id=member_id,
+                                    used=rng.randint(0, total), total=total))
+            if member_id in membership_ids:
+                subs.append(Promo_sub(promo_id=promo_id,
+                                      membership_id=membership_ids[member_id][-1]))
+
+        Promo_item.objects.bulk_create(items)
+        Promo_sub.objects.bulk_create(subs)
+        self.stdout.write("{} promotions, {} promo items".format(len(promo_ids), len(items)))
+
+    def make_groups(self, count):
+        """Create access groups with one to seven TimeBlocks each, returns {pk: mask}"""
+        rng = self.rng
+        after = last_pk(AccessGroup)
+        AccessGroup.objects.bulk_create([AccessGroup(name="Generated group {}".format(n + 1))
+                                         for n in range(count)])
+        group_ids = new_pks(AccessGroup, after)
+
+        days = [code for code, _ in TimeBlock.DAY_CHOICES]
+        blocks = []
+        for group_id in group_ids:
+            for day in rng.sample(days, rng.randint(1, 7)):
+                start = rng.randint(0, 20)
+                end = rng.randint(start + 1, 23)
+                blocks.append(TimeBlock(group_id=group_id, day=day, start=datetime.time(start),
+                                        end=datetime.time(end, 59)))
+        TimeBlock.objects.bulk_create(blocks)
+
+        masks = AccessGroup.compile_schedules(group_ids)
+        self.stdout.write("{} groups, {} time blocks".format(len(group_ids), len(blocks)))
+        return masks
+
+    def make_cards(self, member_ids, card_dist, group_dist, group_masks):
+        """
+        Create the cards of every member and put them in groups
+
+        Returns a list of (uid, card pk, member pk, weekly mask) for make_logs().
+        """
+        rng = self.rng
+        values, weights = card_dist
+        taken = set(AccessCard.objects.exclude(key=None).values_list('key', flat=True))
+        after = last_pk(AccessCard)
+
+        cards = []
+        for member_id in member_ids:
+            for n in range(rng.choices(values, weights)[0]):
+                while True:
+                    uid = '{:08x}'.format(rng.getrandbits(32))
+                    key = uid_key(uid)
+                    if key not in taken:
+                        break
+                taken.add(key)
+                cards.append(AccessCard(member_id=member_id, unique_id=uid, key=key))
+        AccessCard.objects.bulk_create(cards)
+        card_ids = new_pks(AccessCard, after)
+
+        group_ids = sorted(group_masks)
+        values, weights = group_dist
+        through = AccessGroup.card.through
+        links = []
+        result = []
+        for card, card_id in zip(cards, card_ids):
+            mask = 0
+            if group_ids:
+                n_groups = min(rng.choices(values, weights)[0], len(group_ids))
+                for group_id in rng.sample(group_ids, n_groups):
+                    links.append(through(accesscard_id=card_id, accessgroup_id=group_id))
+                    mask |= group_masks[group_id]
+            result.append((card.unique_id, card_id, card.member_id, mask))
+        through.objects.bulk_create(links)
+
+        self.stdout.write("{} cards, {} group memberships".format(len(cards), len(links)))
+        return result
+
+    def make_logs(self, count, days, cards):
+        """Create count AccessEvent rows, decided from the generated schedules"""
+        rng = self.rng
+        now = timezone.now()
+        events = []
+        for n in range(count):
+            stamp = now - datetime.timedelta(seconds=rng.randrange(max(days, 1) * 86400))
+            if cards and rng.random() < 0.95:
+                uid, card_id, member_id, mask = rng.choice(cards)
+                local = timezone.localtime(stamp)
+                granted = mask_has_access(mask, local.date(), local.time())
+                reason = AccessEvent.REASON_OK if granted else AccessEvent.REASON_NO_ACCESS
+                events.append(AccessEvent(timestamp=stamp, uid=uid, card_id=card_id,
+                                          member_id=member_id, granted=granted,
+                                          reason=reason))
+            else:
+                events.append(AccessEvent(timestamp=stamp,
+                                          uid='{:08x}'.format(rng.getrandbits(32)),
+                                          granted=False, reason=AccessEvent.REASON_NOT_FOUND))
+
+        AccessEvent.objects.bulk_create(events)
+        self.stdout.write("{} access events".format(len(events)))
@@ -0,0 +1,136 @@
+"""
+One-time import of the free text access logs into AccessEvent
+
+Parses every LogAccessRequest and LogCardLogin row written by older versions of msys and
+creates the matching structured AccessEvent. Each imported row remembers where it came
+from (AccessEvent.event_id) so running the command again does not create duplicates.
+The legacy tables are left untouched.
+
+Usage: python manage.py import_access_logs
+"""
+import datetime
+import re
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from members.models import AccessCard, AccessEvent, LogAccessRequest, LogCardLogin, Member
+
+
+ACCESS_PATTERNS = [
+    (re.compile(r'^Denied access for ID: (?P<uid>\S*) \[card not found\]$'),
+     False, AccessEvent.REASON_NOT_FOUND),
+    (re.compile(r'^Granted access for card (?P<uid>\S+) \(.*\)$'),
+     True, AccessEvent.REASON_OK),
+    (re.compile(r'^Denied access for card: (?P<uid>\S+) \(.*\) \[no access at this time\]$'),
+     False, AccessEvent.REASON_NO_ACCESS),
+]
+
+LOGIN_PATTERNS = [
+    (re.compile(r'^Member: .* \[ID: (?P<member>\d+)\] logged in with the card: '
+                r'(?P<numeric>\d+) \[ID: (?P<card>\d+)\]$'),
+     True, AccessEvent.REASON_OK),
+    (re.compile(r'^Member: .* \[ID: (?P<member>\d+)\] access denied with card: '
+                r'(?P<numeric>\d+) \[ID: (?P<card>\d+)\]'),
+     False, AccessEvent.REASON_NO_MEMBERSHIP),
+]
+
+BATCH_SIZE = 500
+
+
+def parse(text, patterns):
+    """
+    Match a legacy log line against a list of patterns
+
+    Returns (groupdict, granted, reason) or None if nothing matched.
+    """
+    for pattern, granted, reason in patterns:
+        match = pattern.match(text.strip())
+        if match:
+            return match.groupdict(), granted, reason
+    return None
+
+def to_timestamp(date, time):
+    """Legacy rows store the local date and time separately"""
+    naive = datetime.datetime.combine(date, time)
+    return timezone.make_aware(naive, is_dst=False)
+
+
+class Command(BaseCommand):
+    help = "Import the free text LogAccessRequest and LogCardLogin rows into AccessEvent"
+
+    def handle(self, *args, **options):
+        #one query each instead of one per log line
+        self.cards_by_uid = {}
+        self.cards_by_pk = {}
+        for pk, uid, member_id in AccessCard.objects.values_list('pk', 'unique_id', 'member_id'):
+            self.cards_by_uid.setdefault(uid, (pk, member_id))
+            self.cards_by_pk[pk] = (uid, member_id)
+        self.member_ids = set(Member.objects.values_list('pk', flat=True))
+
+        self.import_rows(LogAccessRequest, 'access-log', self.access_event)
+        self.import_rows(LogCardLogin, 'card-login', self.login_event)
+
+    def import_rows(self, model, prefix, convert):
+        """Convert every row of a legacy log model and store them in batches"""
+        batch = []
+        total = 0
+        unparsed = 0
+
+        for log in model.objects.order_by('pk').iterator():
+            event = convert(log)
+            if event.reason == AccessEvent.REASON_UNKNOWN:
+                unparsed += 1
+            event.timestamp = to_timestamp(log.date, log.time)
+            event.event_id = '{}:{}'.format(prefix, log.pk)
+            batch.append(event)
+
+            if len(batch) >= BATCH_SIZE:
+                AccessEvent.objects.bulk_create(batch, ignore_conflicts=True)
+                total += len(batch)
+                batch = []
+
+        AccessEvent.objects.bulk_create(batch, ignore_conflicts=True)
+        total += len(batch)
+
+        self.stdout.write("{}: {} rows processed, {} could not be parsed".format(
+            model.__name__, total, unparsed))
+
+    def access_event(self, log):
+        """Build an AccessEvent from a LogAccessRequest"""
+        parsed = parse(log.text, ACCESS_PATTERNS)
+        if parsed is None:
+            granted = log.text.startswith('Granted')
+            return AccessEvent(uid='', granted=granted, reason=AccessEvent.REASON_UNKNOWN)
+
+        fields, granted, reason = parsed
+        uid = fields['uid']
+        card_id, member_id = self.cards_by_uid.get(uid, (None, None))
+        return AccessEvent(uid=uid, card_id=card_id, member_id=member_id,
+                           granted=granted, reason=reason)
+
+    def login_event(self, log):
+        """Build an AccessEvent from a LogCardLogin"""
+        door = AccessEvent.CARD_LOGIN_DOOR
+        parsed = parse(log.text, LOGIN_PATTERNS)
+        if parsed is None:
+            return AccessEvent(uid='', granted=False, reason=AccessEvent.REASON_UNKNOWN,
+                               door=door)
+
+        fields, granted, reason = parsed
+        card_id = int(fields['card'])
+        member_id = int(fields['member'])
+
+        if card_id in self.cards_by_pk:
+            uid = self.cards_by_pk[card_id][0]
+        else:
+            #the card is gone, rebuild the uid from its numeric form
+            uid = '{:x}'.format(int(fields['numeric']))
+            uid = uid.zfill(len(uid) + len(uid) % 2)
+            card_id = None
+
+        if member_id not in self.member_ids:
+            member_id = None
+
+        return AccessEvent(uid=uid, card_id=card_id, member_id=member_id,
+                           granted=granted, reason=reason, door=door)
@@ -0,0 +1,165 @@
+"""
+Microbenchmarks of the model and view hot paths
+
+Fills a throw-away test database with generate_dataset and times each case over a fixed
+sample of cards or members, --repeat times. For every case the median and best time per
+call are reported with the number of SQL queries per call.
+
+With --output the results are saved as JSON, to be compared with a stored baseline
+(see benchmarks/ and bench_compare):
+
+    python manage.py microbench --output /tmp/bench.json
+    python manage.py bench_compare benchmarks/baseline.json /tmp/bench.json
+
+Usage: python manage.py microbench [--members 500] [--sample 50] [--repeat 5] [--seed 1]
+                                   [--output results.json]
+"""
+import contextlib
+import datetime
+import io
+import json
+import platform
+import random
+import statistics
+from time import perf_counter
+from unittest import mock
+
+import django
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from members import views
+from members.log_sink import sink
+from members.models import AccessCard, Member
+
+
+class Case:
+    """A function to time and the items to call it with, one call per item"""
+
+    def __init__(self, name, func, items):
+        self.name = name
+        self.func = func
+        self.items = items
+
+def build_cases(sample, rng):
+    """The cases to run against whatever is in the database"""
+    cards = list(AccessCard.objects.order_by('pk'))
+    cards = rng.sample(cards, min(sample, len(cards)))
+    members = list(Member.objects.order_by('pk'))
+    members = rng.sample(members, min(sample, len(members)))
+    when = datetime.datetime(2018, 1, 1, 12)
+
+    factory = RequestFactory()
+    user = User(username='bench', is_active=True)
+
+    def weekly_access(card):
+        return views.weekly_access(factory.post('/members/weekly_access/',
+                                                {'id': card.unique_id}))
+
+    def card_table(card):
+        request = factory.get('/members/cards/details/{}/'.format(card.pk), {'table': '1'})
+        request.user = user
+        return views.cardDetails(request, card.pk)
+
+    def report(item):
+        import maintenance
+        #no Stripe, no output
+        unpaid = mock.Mock(**{'to_dict.return_value': {'data': []}})
+        with mock.patch('stripe.Subscription.list', return_value=unpaid), \
+             contextlib.redirect_stdout(io.StringIO()):
+            maintenance.Maintenence().do_report()
+
+    return [
+        Case('card_has_access_at_time',
+             lambda card: card.has_access_at_time(when.date(), when.time()), cards),
+        Case('card_numeric', lambda card: card.numeric(), cards),
+        Case('member_has_active_membership', lambda member: member.has_active_membership(),
+             members),
+        Case('weekly_access', weekly_access, cards),
+        Case('card_details_table', card_table, cards[:10]),
+        Case('maintenance_do_report', report, [None]),
+    ]
+
+def run_case(case, repeat):
+    """
+    Time a case. The first pass counts the queries (and warms the caches up), the
+    next repeat passes are timed.
+
+    Returns a dict of median_us, min_us and queries, all per call.
+    """
+    with CaptureQueriesContext(connection) as queries:
+        for item in case.items:
+            case.func(item)
+
+    per_call = []
+    for n in range(repeat):
+        t1 = perf_counter()
+        for item in case.items:
+            case.func(item)
+        t2 = perf_counter()
+        per_call.append((t2 - t1) / len(case.items))
+
+    return {'median_us': statistics.median(per_call) * 1e6,
+            'min_us': min(per_call) * 1e6,
+            'queries': len(queries) / len(case.items)}
+
+
+class Command(BaseCommand):
+    help = "Time the model and view hot paths on generated data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=500)
+        parser.add_argument('--sample', type=int, default=50,
+                            help="number of cards / members each case is run with")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--case', action='append',
+                            help="only run the named case (may be repeated)")
+        parser.add_argument('--output', help="save the results to this JSON file")
+
+    def handle(self, *args, **options):
+        #never touch the real database
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            call_command('generate_dataset', members=options['members'], logs=0,
+                         seed=options['seed'], stdout=io.StringIO())
+            results = self.run(options)
+        finally:
+            sink.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                json.dump(results, out, indent=2, sort_keys=True)
+            self.stdout.write("results saved to {}".format(options['output']))
+
+    def run(self, options):
+        """Run the cases, print and return the results"""
+        rng = random.Random(options['seed'])
+        results = {'meta': {'members': options['members'],
+                            'sample': options['sample'],
+                            'repeat': options['repeat'],
+                            'seed': options['seed'],
+                            'python': platform.python_version(),
+                            'django': django.get_version(),
+                            'date': datetime.datetime.now().isoformat(timespec='seconds')},
+                   'cases': {}}
+
+        for case in build_cases(options['sample'], rng):
+            if options['case'] and case.name not in options['case']:
+                continue
+            result = run_case(case, options['repeat'])
+            results['cases'][case.name] = result
+            self.stdout.write("{:>30}: median={:10.1f} us min={:10.1f} us "
+                              "queries/call={:.1f}".format(case.name, result['median_us'],
+                                                           result['min_us'],
+                                                           result['queries']))
+        return results
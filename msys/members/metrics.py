@@ -0,0 +1,140 @@
+"""
+Metrics
+
+Latency histograms for the views the gatekeepers talk to, served in the Prometheus text
+format by views.metrics.
+
+StageTimingMiddleware times the whole request ("total") of the views listed in
+TIMED_VIEWS, for the method they do their work with: a GET of weekly_access/ is only a
+gatekeeper's keep-warm ping and would skew the numbers. Inside those views,
+`with stage('lookup'):` times one step of the work. Stages timed outside of a timed view
+are ignored.
+
+The numbers are kept in memory, so each server process reports its own.
+"""
+import threading
+from time import perf_counter
+
+
+#url names of the views that are timed -> the method that is timed
+TIMED_VIEWS = {'auth': 'POST', 'authBatch': 'POST', 'weekly_access': 'POST',
+               'loginCard': 'GET'}
+
+#upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """Cumulative latency histogram, safe to update from several threads"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """Record one measurement"""
+        n = 0
+        while n < len(self.buckets) and seconds > self.buckets[n]:
+            n += 1
+        with self._lock:
+            self.counts[n] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def cumulative(self):
+        """Returns [(upper bound, count)...], the last bound being '+Inf'"""
+        with self._lock:
+            counts = list(self.counts)
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_local = threading.local()
+
+def observe(view, stage_name, seconds):
+    """Record a measurement for a stage of a view"""
+    key = (view, stage_name)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(key, Histogram())
+    histogram.observe(seconds)
+
+def reset():
+    """Forget every measurement"""
+    with _histograms_lock:
+        _histograms.clear()
+
+
+class stage:
+    """
+    Context manager timing one stage of the current view
+
+        with stage('lookup'):
+            cards = access_index.lookup(uID)
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        view = getattr(_local, 'view', None)
+        if view is not None:
+            observe(view, self.name, perf_counter() - self.start)
+        return False
+
+
+class StageTimingMiddleware:
+    """Times the views listed in TIMED_VIEWS and lets their stages know which view they are in"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = perf_counter()
+        _local.view = None
+        try:
+            return self.get_response(request)
+        finally:
+            view = _local.view
+            _local.view = None
+            if view is not None:
+                observe(view, 'total', perf_counter() - start)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        if TIMED_VIEWS.get(url_name) == request.method:
+            _local.view = url_name
+        return None
+
+
+def render_prometheus():
+    """Returns every histogram in the Prometheus text exposition format"""
+    name = 'msys_request_stage_seconds'
+    lines = ['# HELP {} Time spent in each stage of the device facing views.'.format(name),
+             '# TYPE {} histogram'.format(name)]
+
+    with _histograms_lock:
+        histograms = sorted(_histograms.items())
+
+    for (view, stage_name), histogram in histograms:
+        labels = 'view="{}",stage="{}"'.format(view, stage_name)
+        for bound, count in histogram.cumulative():
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, count))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, repr(histogram.sum)))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+
+    return '\n'.join(lines) + '\n'
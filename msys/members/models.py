@@ -6,13 +6,19 @@ The classes defined here are essential to Django's ORM magic
 """
 
 import datetime
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
 from django.forms import ModelForm
 from django.forms import Select, SelectMultiple, TextInput
 from django.forms import DateInput, NumberInput, TimeInput
 from django.forms import CheckboxSelectMultiple, Textarea
 
 from .stripe_handler import director
+from .log_sink import sink as log_sink
+from .uid import normalize_uid, uid_key, key_to_numeric, validate_uid
+from .schedule import DAY_CODES, block_mask, mask_has_access, mask_to_bytes, mask_from_bytes
 
 class MemberType(models.Model):
     """
@@ -367,6 +373,50 @@ class Promo_sub(models.Model):
         ret = "{} <-> {}".format(self.promo, self.membership)
         return ret
 
+class AccessCardQuerySet(models.QuerySet):
+    """
+    Lets access be decided for many cards at once in SQL
+
+    The TimeBlocks are matched at minute resolution so that the answer agrees with
+    AccessCard.has_access_at_time (see schedule.py).
+    """
+
+    def _blocks_at(self, when):
+        minute = when.time().replace(second=0, microsecond=0)
+        return TimeBlock.objects.filter(group__card=OuterRef('pk'),
+                                        day=DAY_CODES[when.weekday()],
+                                        start__lte=minute,
+                                        end__gte=minute)
+
+    def annotate_access_at(self, when, name='has_access'):
+        """
+        Annotate each card with a boolean telling if it grants access at a datetime
+
+        Params:
+        when -- a datetime.datetime object representing the moment to check
+        name -- the name of the annotation
+        """
+        return self.annotate(**{name: Exists(self._blocks_at(when))})
+
+    def with_access_at(self, when):
+        """Only the cards that grant access at the given datetime"""
+        return self.annotate_access_at(when).filter(has_access=True)
+
+    def without_access_at(self, when):
+        """Only the cards that do not grant access at the given datetime"""
+        return self.annotate_access_at(when).filter(has_access=False)
+
+    def by_uid(self, raw_uid):
+        """
+        The cards matching a uid, in whatever form it was given
+
+        Uses the unique index on AccessCard.key. Invalid uids match nothing.
+        """
+        try:
+            return self.filter(key=uid_key(raw_uid))
+        except ValueError:
+            return self.none()
+
 class AccessCard(models.Model):
     """
     Class representing the card (RFID or unique token) that Members may have
@@ -376,23 +426,58 @@ class AccessCard(models.Model):
     AccessCards can be associated with AccessGroups for providing access at groups of times.
     """
     member = models.ForeignKey(Member, models.PROTECT)
-    unique_id = models.CharField(max_length=30)
+    unique_id = models.CharField(max_length=30, validators=[validate_uid])
+
+    #integer form of unique_id (see uid.py), filled in by save()
+    #existing rows can be filled in with: manage.py backfill_card_keys
+    key = models.BigIntegerField(unique=True, null=True, blank=True, editable=False)
+
+    objects = AccessCardQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        try:
+            self.unique_id = normalize_uid(self.unique_id)
+            self.key = uid_key(self.unique_id)
+        except ValueError:
+            #keep whatever we were given, it simply can not be looked up by key
+            self.key = None
+        super().save(*args, **kwargs)
+
+    def validate_unique(self, exclude=None):
+        """
+        Also refuse a uid already used by another card, in whatever form it was given
+
+        key is not a form field, so ModelForms (the admin) would not check it and saving
+        would fail on the unique index instead.
+        """
+        super().validate_unique(exclude)
+        if exclude and 'unique_id' in exclude:
+            return
+        if AccessCard.objects.by_uid(self.unique_id).exclude(pk=self.pk).exists():
+            raise ValidationError({'unique_id': "A card with that ID already exists"})
 
     def numeric(self):
         """Returns a numeric representation of the unique id associated with the object"""
-        byte_list = self.unique_id.split()
-        num = 0
-        for b_byte in byte_list:
-            num = num << 8
-            num = num + int(b_byte, base=16)
-
-        return num
+        if self.key is not None:
+            return key_to_numeric(self.key)
+        return int(normalize_uid(self.unique_id), 16)
 
     def has_access_now(self):
         """Simplified wrapper for has_access_at_time(...)"""
         return self.has_access_at_time(datetime.datetime.now().date(),
                                        datetime.datetime.now().time())
 
+    def weekly_mask(self):
+        """
+        Get the combined weekly access mask of all AccessGroups linked to this card
+
+        See schedule.py for the format.
+        """
+        mask = 0
+        for agroup in self.accessgroup_set.all():
+            mask |= agroup.weekly_mask()
+        return mask
+
     def has_access_at_time(self, date, time):
         """
         Check if this card grants access at a given date and time
@@ -403,27 +488,7 @@ class AccessCard(models.Model):
 
         TODO: consider simplifying the parameters
         """
-        day2day = {'mon': 0,
-                   'tues': 1,
-                   'wed': 2,
-                   'thurs': 3,
-                   'fri': 4,
-                   'sat': 5,
-                   'sun': 6
-                  }#Todo: this code should not be replicated in more than one place!!
-        #get a list of AGs linked to this card
-        ag_set = self.accessgroup_set.all()
-        for agroup in ag_set:
-            #now get the TBs linked to the AG
-            tb_set = TimeBlock.objects.filter(group=agroup)
-            for tblock in tb_set:
-                if date.weekday() == day2day[tblock.day] and time >= tblock.start and time <= tblock.end:
-                    return True
-                else:
-                    continue
-        return False
-
-
+        return mask_has_access(self.weekly_mask(), date, time)
 
     def __str__(self):
         ret = self.unique_id
@@ -437,6 +502,45 @@ class AccessGroup(models.Model):
     name = models.CharField(max_length=200)
     card = models.ManyToManyField(AccessCard, null=True, blank=True)
 
+    #precompiled weekly mask of all the TimeBlocks in this group (see schedule.py)
+    schedule = models.BinaryField(null=True, blank=True, editable=False)
+
+    @classmethod
+    def compile_schedules(cls, group_ids):
+        """
+        Rebuild and store the weekly mask of several groups from their TimeBlocks
+
+        Only one query is used to fetch the TimeBlocks, no matter how many groups.
+
+        Returns a dict of group id -> weekly mask
+        """
+        masks = dict.fromkeys(group_ids, 0)
+        blocks = TimeBlock.objects.filter(group__in=group_ids)
+        for day, start, end, group_id in blocks.values_list('day', 'start', 'end', 'group_id'):
+            masks[group_id] |= block_mask(day, start, end)
+
+        for group_id, mask in masks.items():
+            #update() rather than save() so that no signals are sent
+            cls.objects.filter(pk=group_id).update(schedule=mask_to_bytes(mask))
+
+        return masks
+
+    def compile_schedule(self):
+        """Rebuild and store the weekly mask of this group. Returns the new mask."""
+        mask = AccessGroup.compile_schedules([self.pk])[self.pk]
+        self.schedule = mask_to_bytes(mask)
+        return mask
+
+    def weekly_mask(self):
+        """
+        Get the weekly access mask of this group
+
+        The mask is compiled and stored the first time it is needed.
+        """
+        if self.schedule is None:
+            return self.compile_schedule()
+        return mask_from_bytes(self.schedule)
+
     def __str__(self):
         return str(self.name)
 
@@ -466,6 +570,91 @@ class TimeBlock(models.Model):
     def __str__(self):
         return '{} from {} to {}'.format(self.day, self.start, self.end)
 
+class AccessRulesVersion(models.Model):
+    """
+    Counter bumped every time the access rules (cards, groups, blocks) change
+
+    There is only ever one row. Gatekeepers use the number to tell whether their copy of
+    the access table is still current (see views.access_snapshot) and AccessChange rows
+    are numbered with it.
+    """
+    number = models.PositiveIntegerField(default=0)
+
+    #AccessChange rows up to this number have been deleted (see compact_access_journal)
+    compacted = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def bump(cls):
+        """
+        Increment the version and return the new number
+
+        The row stays locked until the transaction commits, so numbers are handed out
+        in the order the changes become visible. Call it in the transaction that makes
+        the change (see signals.rules_changed), not in autocommit mode.
+        """
+        with transaction.atomic():
+            if not cls.objects.filter(pk=1).update(number=models.F('number') + 1):
+                version, created = cls.objects.get_or_create(pk=1, defaults={'number': 1})
+                if not created:
+                    cls.objects.filter(pk=1).update(number=models.F('number') + 1)
+            return cls.current()
+
+    @classmethod
+    def current(cls):
+        """Returns the current version number"""
+        number = cls.objects.filter(pk=1).values_list('number', flat=True).first()
+        return number or 0
+
+    @classmethod
+    def compacted_up_to(cls):
+        """Returns the highest version whose AccessChange rows may have been deleted"""
+        number = cls.objects.filter(pk=1).values_list('compacted', flat=True).first()
+        return number or 0
+
+    def __str__(self):
+        return 'Access rules version {}'.format(self.number)
+
+class AccessChange(models.Model):
+    """
+    Journal of the changes made to the access rules
+
+    One row is written (see signals.py) for every card, group membership or time block
+    that is created, changed or deleted, numbered with the AccessRulesVersion of the
+    change. Gatekeepers use it to fetch only what changed since their last sync
+    (see views.access_changes).
+    """
+    TABLE_CARD = 'card'
+    TABLE_MEMBERSHIP = 'membership'
+    TABLE_BLOCK = 'block'
+    TABLE_CHOICES = (
+        (TABLE_CARD, 'AccessCard'),
+        (TABLE_MEMBERSHIP, 'AccessGroup membership'),
+        (TABLE_BLOCK, 'TimeBlock'),
+    )
+
+    ACTION_INSERT = 'insert'
+    ACTION_UPDATE = 'update'
+    ACTION_DELETE = 'delete'
+    ACTION_CHOICES = (
+        (ACTION_INSERT, 'Insert'),
+        (ACTION_UPDATE, 'Update'),
+        (ACTION_DELETE, 'Delete'),
+    )
+
+    seq = models.PositiveIntegerField(db_index=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+    table = models.CharField(max_length=16, choices=TABLE_CHOICES)
+    action = models.CharField(max_length=8, choices=ACTION_CHOICES)
+    object_id = models.IntegerField()
+
+    #the card uid affected by card and membership changes, the group of the others
+    uid = models.CharField(max_length=50, blank=True, default='')
+    group_id = models.IntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return '#{} {} {} {} [{}]'.format(self.seq, self.action, self.table, self.object_id,
+                                          self.uid or 'group {}'.format(self.group_id))
+
 class AccessBlock(models.Model):
     """
     OBSOLETE -- See AccessGroup and TimeBlock
@@ -496,6 +685,8 @@ class AccessBlock(models.Model):
         return ret
 
 ############### Logs #############
+#
+# log_now() only queues the row, it is written shortly after by the log sink (see log_sink.py)
 
 class LogEvent(models.Model):
     """
@@ -514,7 +705,7 @@ class LogEvent(models.Model):
         log.time = datetime.datetime.now().time()
 
         log.text = txt
-        log.save()
+        log_sink.put(log)
 
     def __str__(self):
         ret = "{} {} || {}".format(self.date, self.time, self.text)
@@ -537,7 +728,7 @@ class LogAccessRequest(models.Model):
         log.time = datetime.datetime.now().time()
 
         log.text = txt
-        log.save()
+        log_sink.put(log)
 
     def __str__(self):
         ret = "{} {} || {}".format(self.date, self.time, self.text)
@@ -558,13 +749,76 @@ class LogCardLogin(models.Model):
         log.time = datetime.datetime.now().time()
 
         log.text = txt
-        log.save()
+        log_sink.put(log)
     
     def __str__(self):
         ret = "{} {} || {}".format(self.date, self.time, self.text)
         return ret
 
 
+class AccessEvent(models.Model):
+    """
+    Structured record of an access request (a door swipe or a card login)
+
+    Replaces the free text of LogAccessRequest and LogCardLogin so that the history of a
+    card, a member or a door can be found through an index instead of a text search.
+    Rows written by older versions can be imported with: manage.py import_access_logs
+    """
+    REASON_OK = 'ok'
+    REASON_NOT_FOUND = 'not_found'
+    REASON_NO_ACCESS = 'no_access'
+    REASON_NO_MEMBERSHIP = 'no_membership'
+    REASON_UNKNOWN = 'unknown'
+    REASON_CHOICES = (
+        (REASON_OK, 'Access granted'),
+        (REASON_NOT_FOUND, 'Card not found'),
+        (REASON_NO_ACCESS, 'No access at this time'),
+        (REASON_NO_MEMBERSHIP, 'No active membership'),
+        (REASON_UNKNOWN, 'Unknown'),
+    )
+
+    #door id used for the logins made through the card login page
+    CARD_LOGIN_DOOR = 'card-login'
+
+    timestamp = models.DateTimeField(db_index=True)
+    uid = models.CharField(max_length=30, db_index=True)
+    card = models.ForeignKey(AccessCard, models.SET_NULL, null=True, blank=True)
+    member = models.ForeignKey(Member, models.SET_NULL, null=True, blank=True)
+    granted = models.BooleanField()
+    reason = models.CharField(max_length=16, choices=REASON_CHOICES)
+    door = models.CharField(max_length=64, blank=True, default='', db_index=True)
+
+    #unique id given by whoever produced the event, so that it is never stored twice
+    event_id = models.CharField(max_length=64, null=True, blank=True, unique=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['card', 'timestamp']),
+            models.Index(fields=['member', 'timestamp']),
+        ]
+
+    @staticmethod
+    def log_now(uid, granted, reason, card_id=None, member_id=None, door=''):
+        """Queue a new event that happened just now (see log_sink.py)"""
+        event = AccessEvent(timestamp=timezone.now(),
+                            uid=uid,
+                            card_id=card_id,
+                            member_id=member_id,
+                            granted=granted,
+                            reason=reason,
+                            door=door)
+        log_sink.put(event)
+
+    def __str__(self):
+        local = timezone.localtime(self.timestamp)
+        ret = "{} {} || {} {} ({})".format(local.date(), local.time(),
+                                           'Granted' if self.granted else 'Denied',
+                                           self.uid, self.get_reason_display())
+        if self.door:
+            ret += " @ " + self.door
+        return ret
+
+
 ############### Reports #############
 
 class IncidentReport(models.Model):
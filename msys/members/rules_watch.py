@@ -0,0 +1,73 @@
+"""
+Rules Watch
+
+Lets requests sleep until the access rules change (see views.access_wait).
+
+Changes made by this process wake the sleepers as soon as their transaction commits
+(see signals.py). Changes made by other processes are noticed by polling
+AccessRulesVersion, at most once every ACCESS_WAIT_POLL_INTERVAL seconds no matter how
+many requests are waiting.
+"""
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+
+class RulesWatch:
+    """
+    Shared view of the AccessRulesVersion for long polling requests
+    """
+
+    POLL_INTERVAL = 1.0 # seconds
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._version = 0
+        self._polled_at = None
+
+    def notify(self):
+        """The rules changed: make the next waiter read the version and wake everyone"""
+        with self._cond:
+            self._polled_at = None
+            self._cond.notify_all()
+
+    def wait(self, since, timeout):
+        """
+        Wait until the version is greater than since or timeout seconds have passed
+
+        Returns the latest known version.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            version = self._current()
+            remaining = deadline - monotonic()
+            if version > since or remaining <= 0:
+                return version
+
+            with self._cond:
+                if self._polled_at is not None:
+                    self._cond.wait(min(remaining, self._poll_interval()))
+
+    def _poll_interval(self):
+        return getattr(settings, 'ACCESS_WAIT_POLL_INTERVAL', self.POLL_INTERVAL)
+
+    def _current(self):
+        from .models import AccessRulesVersion
+
+        with self._cond:
+            now = monotonic()
+            if self._polled_at is not None and now - self._polled_at < self._poll_interval():
+                return self._version
+            #claim the poll so that the other waiters keep sleeping
+            self._polled_at = now
+
+        version = AccessRulesVersion.current()
+        with self._cond:
+            if version != self._version:
+                self._version = version
+                self._cond.notify_all()
+        return version
+
+
+watch = RulesWatch()
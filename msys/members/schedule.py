@@ -0,0 +1,114 @@
+"""
+Schedule
+
+Helpers for turning TimeBlocks into a compact weekly bitmap.
+
+A week is represented as a plain integer where bit n is set when access is granted during
+the n-th minute of the week (Monday 00:00 being minute 0). Checking access at a given
+moment is then a single shift and bit test, no matter how many TimeBlocks were involved.
+"""
+import datetime
+
+DAY_INDEX = {'mon': 0,
+             'tues': 1,
+             'wed': 2,
+             'thurs': 3,
+             'fri': 4,
+             'sat': 5,
+             'sun': 6
+            }
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+DAY_CODES = sorted(DAY_INDEX, key=DAY_INDEX.get)
+
+#size of a serialized weekly mask
+SCHEDULE_BYTES = MINUTES_PER_WEEK // 8
+
+
+def minute_of_day(time):
+    """Returns the number of whole minutes since midnight for a datetime.time"""
+    return time.hour * 60 + time.minute
+
+def minute_of_week(date, time):
+    """Returns the bit position in a weekly mask for the given date and time"""
+    return date.weekday() * MINUTES_PER_DAY + minute_of_day(time)
+
+def block_mask(day, start, end):
+    """
+    Build the weekly mask for a single block of time
+
+    A minute is considered part of the block when its first second lies between start and
+    end (inclusive). Blocks are expected to be drawn on whole minutes, which is what the
+    admin forms produce.
+
+    Params:
+    day -- one of the TimeBlock day codes ('mon', 'tues', ...)
+    start -- a datetime.time object for the beginning of the block
+    end -- a datetime.time object for the end of the block
+    """
+    first = minute_of_day(start)
+    if start.second or start.microsecond:
+        first += 1
+    last = minute_of_day(end)
+
+    if first > last:
+        return 0
+
+    width = last - first + 1
+    return ((1 << width) - 1) << (DAY_INDEX[day] * MINUTES_PER_DAY + first)
+
+def mask_has_access(mask, date, time):
+    """Check if a weekly mask grants access at a given date and time"""
+    return bool((mask >> minute_of_week(date, time)) & 1)
+
+
+def mask_to_bytes(mask):
+    """Serialize a weekly mask for storage"""
+    return mask.to_bytes(SCHEDULE_BYTES, 'little')
+
+def mask_from_bytes(data):
+    """Deserialize a weekly mask created by mask_to_bytes()"""
+    return int.from_bytes(bytes(data), 'little')
+
+def day_bounds(mask):
+    """
+    Get the earliest and latest minutes of access for each day of the week
+
+    Returns a dict of day code -> (start, end) where start and end are datetime.time
+    objects. The end time is the last second of the last minute of access. Days without
+    any access are left out.
+    """
+    bounds = {}
+    day_bits = (1 << MINUTES_PER_DAY) - 1
+    for day in DAY_CODES:
+        bits = (mask >> (DAY_INDEX[day] * MINUTES_PER_DAY)) & day_bits
+        if bits:
+            first = (bits & -bits).bit_length() - 1
+            last = bits.bit_length() - 1
+            bounds[day] = (datetime.time(first // 60, first % 60),
+                           datetime.time(last // 60, last % 60, 59))
+    return bounds
+
+def day_intervals(mask):
+    """
+    Get every stretch of access for each day of the week
+
+    Returns a dict of day code -> [(start, end), ...] in chronological order, with
+    datetime.time objects as in day_bounds(). Unlike day_bounds(), gaps between blocks
+    are kept. Days without any access are left out.
+    """
+    intervals = {}
+    day_bits = (1 << MINUTES_PER_DAY) - 1
+    for day in DAY_CODES:
+        bits = (mask >> (DAY_INDEX[day] * MINUTES_PER_DAY)) & day_bits
+        while bits:
+            first = (bits & -bits).bit_length() - 1
+            run = bits >> first
+            length = (run ^ (run + 1)).bit_length() - 1
+            last = first + length - 1
+            intervals.setdefault(day, []).append((datetime.time(first // 60, first % 60),
+                                                  datetime.time(last // 60, last % 60, 59)))
+            bits &= ~(((1 << length) - 1) << first)
+    return intervals
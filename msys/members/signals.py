@@ -0,0 +1,172 @@
+"""
+Signals
+
+Receivers that keep derived data (such as the compiled access index and the AccessChange
+journal) in step with the ORM. They are connected in MembersConfig.ready().
+"""
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .access_index import index
+from .rules_watch import watch
+from .models import Member, AccessCard, AccessGroup, TimeBlock, AccessRulesVersion, AccessChange
+from .uid import normalize_uid
+
+
+def invalidate_index():
+    """
+    Invalidate the access index now and again once the transaction commits
+
+    A rebuild running before the commit would still have read the old rows.
+    """
+    index.invalidate()
+    transaction.on_commit(index.invalidate)
+
+def rules_changed(changes=()):
+    """
+    Bump the access rules version, journal the given AccessChange rows under it,
+    invalidate the access index and wake the gatekeepers waiting for a change
+
+    The version and its journal rows are committed together: post_save is sent outside
+    of any transaction, and a sync reading the new version before its rows would never
+    see the change.
+    """
+    with transaction.atomic():
+        seq = AccessRulesVersion.bump()
+        for change in changes:
+            change.seq = seq
+        AccessChange.objects.bulk_create(changes)
+        invalidate_index()
+        transaction.on_commit(watch.notify)
+
+def rules_reloaded():
+    """
+    Like rules_changed(), for bulk loads that bypass the signals and the journal
+
+    Marks the journal as compacted up to the new version so that every gatekeeper is
+    sent the full snapshot on its next sync.
+    """
+    with transaction.atomic():
+        seq = AccessRulesVersion.bump()
+        AccessRulesVersion.objects.filter(pk=1).update(compacted=seq)
+        invalidate_index()
+        transaction.on_commit(watch.notify)
+
+def card_change(action, card_id, uid, group_id=None):
+    """Build an AccessChange for a card, or for one of its group memberships"""
+    try:
+        uid = normalize_uid(uid)
+    except ValueError:
+        pass
+
+    table = AccessChange.TABLE_CARD if group_id is None else AccessChange.TABLE_MEMBERSHIP
+    return AccessChange(table=table, action=action, object_id=card_id, uid=uid,
+                        group_id=group_id)
+
+
+@receiver(post_save, sender=Member)
+def member_changed(sender, **kwargs):
+    """Member names are part of the compiled index (for the logs), but not of the rules"""
+    invalidate_index()
+
+@receiver(post_save, sender=AccessGroup)
+def access_group_saved(sender, **kwargs):
+    """Renaming a group does not change anyone's access, but the version moves on anyway"""
+    rules_changed()
+
+@receiver(pre_save, sender=AccessCard)
+def access_card_saving(sender, instance, **kwargs):
+    """Remember the uid a card had in case it is being changed"""
+    instance._old_uid = None
+    if instance.pk is not None:
+        instance._old_uid = (AccessCard.objects.filter(pk=instance.pk)
+                             .values_list('unique_id', flat=True).first())
+
+@receiver(post_save, sender=AccessCard)
+def access_card_saved(sender, instance, created, **kwargs):
+    """Journal a new or changed card"""
+    if created:
+        changes = [card_change(AccessChange.ACTION_INSERT, instance.pk, instance.unique_id)]
+    else:
+        changes = [card_change(AccessChange.ACTION_UPDATE, instance.pk, instance.unique_id)]
+        old_uid = getattr(instance, '_old_uid', None)
+        if old_uid is not None and old_uid != instance.unique_id:
+            changes.append(card_change(AccessChange.ACTION_DELETE, instance.pk, old_uid))
+    rules_changed(changes)
+
+@receiver(post_delete, sender=AccessCard)
+def access_card_deleted(sender, instance, **kwargs):
+    """Journal a deleted card. Its group memberships go with it."""
+    rules_changed([card_change(AccessChange.ACTION_DELETE, instance.pk, instance.unique_id)])
+
+@receiver(pre_delete, sender=AccessGroup)
+def access_group_deleting(sender, instance, **kwargs):
+    """Remember the cards of a group being deleted: no m2m_changed is sent for them"""
+    instance._old_cards = list(instance.card.values_list('pk', 'unique_id'))
+
+@receiver(post_delete, sender=AccessGroup)
+def access_group_deleted(sender, instance, **kwargs):
+    """Journal the memberships that went away with a deleted group"""
+    rules_changed([card_change(AccessChange.ACTION_DELETE, card_id, uid, instance.pk)
+                   for card_id, uid in getattr(instance, '_old_cards', [])])
+
+@receiver(m2m_changed, sender=AccessGroup.card.through)
+def access_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Journal cards being added to or removed from groups"""
+    if action == 'pre_clear':
+        #the cleared rows are gone by the time post_clear is sent
+        if reverse:
+            instance._old_links = [(instance.pk, instance.unique_id, group_id) for group_id
+                                   in instance.accessgroup_set.values_list('pk', flat=True)]
+        else:
+            instance._old_links = [(card_id, uid, instance.pk) for card_id, uid
+                                   in instance.card.values_list('pk', 'unique_id')]
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        links = getattr(instance, '_old_links', [])
+    elif reverse:
+        links = [(instance.pk, instance.unique_id, group_id) for group_id in pk_set]
+    else:
+        cards = AccessCard.objects.filter(pk__in=pk_set).values_list('pk', 'unique_id')
+        links = [(card_id, uid, instance.pk) for card_id, uid in cards]
+
+    if action == 'post_add':
+        change_action = AccessChange.ACTION_INSERT
+    else:
+        change_action = AccessChange.ACTION_DELETE
+    rules_changed([card_change(change_action, card_id, uid, group_id)
+                   for card_id, uid, group_id in links])
+
+@receiver(pre_save, sender=TimeBlock)
+def time_block_moving(sender, instance, **kwargs):
+    """Remember which group a TimeBlock belonged to in case it is being moved"""
+    instance._old_group_id = None
+    if instance.pk is not None:
+        instance._old_group_id = (TimeBlock.objects.filter(pk=instance.pk)
+                                  .values_list('group_id', flat=True).first())
+
+@receiver(post_save, sender=TimeBlock)
+@receiver(post_delete, sender=TimeBlock)
+def time_blocks_changed(sender, instance, **kwargs):
+    """Recompile the schedule of the affected AccessGroups and journal the change"""
+    if kwargs.get('created'):
+        action = AccessChange.ACTION_INSERT
+    elif 'created' in kwargs:
+        action = AccessChange.ACTION_UPDATE
+    else:
+        action = AccessChange.ACTION_DELETE
+
+    group_ids = {instance.group_id}
+    old_group_id = getattr(instance, '_old_group_id', None)
+    if old_group_id is not None:
+        group_ids.add(old_group_id)
+
+    AccessGroup.compile_schedules(group_ids)
+    rules_changed([AccessChange(table=AccessChange.TABLE_BLOCK, action=action,
+                                object_id=instance.pk, group_id=group_id)
+                   for group_id in sorted(group_ids)])
@@ -1,3 +1,782 @@
-from django.test import TestCase
+import datetime
+import json
+import random
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import DatabaseError, transaction
+from django.forms import modelform_factory
+from django.core.management import call_command, CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from members.access_index import index
+from members.models import Member, MemberType, AccessCard, AccessGroup, TimeBlock
+from members.models import AccessRulesVersion, AccessChange, Membership
+from members.log_sink import sink as log_sink
+from members.rules_watch import watch as rules_watch
+from members import metrics
+from members.models import AccessEvent, LogAccessRequest, LogCardLogin, LogEvent
+from members.schedule import block_mask, mask_has_access, day_bounds, day_intervals
+from members.uid import normalize_uid, uid_key
+from members.management.commands.bench_compare import compare
+from members.management.commands.microbench import build_cases, run_case
+
+# 2018-01-01 was a Monday
+MONDAY = datetime.date(2018, 1, 1)
+TUESDAY = datetime.date(2018, 1, 2)
+
+
+def make_member(first_name="Test", last_name="Member"):
+    mtype, _ = MemberType.objects.get_or_create(name="Member")
+    today = datetime.date.today()
+    return Member.objects.create(number=1, type=mtype,
+                                 first_name=first_name, last_name=last_name,
+                                 birth_date=today, first_seen_date=today, last_seen_date=today,
+                                 address="", city="", postal_code="", phone_number="",
+                                 email="", emergency_contact="", emergency_phone_number="")
+
+
+class ScheduleTests(TestCase):
+
+    def test_block_mask(self):
+        mask = block_mask('mon', datetime.time(9), datetime.time(17))
+        self.assertTrue(mask_has_access(mask, MONDAY, datetime.time(9)))
+        self.assertTrue(mask_has_access(mask, MONDAY, datetime.time(17)))
+        self.assertFalse(mask_has_access(mask, MONDAY, datetime.time(8, 59)))
+        self.assertFalse(mask_has_access(mask, MONDAY, datetime.time(17, 1)))
+        self.assertFalse(mask_has_access(mask, TUESDAY, datetime.time(12)))
+
+    def test_whole_day(self):
+        mask = block_mask('sun', datetime.time.min, datetime.time.max)
+        self.assertTrue(mask_has_access(mask, datetime.date(2018, 1, 7), datetime.time(23, 59, 59)))
+
+    def test_day_intervals(self):
+        mask = (block_mask('mon', datetime.time(6), datetime.time(8)) |
+                block_mask('mon', datetime.time(12), datetime.time(13, 30)) |
+                block_mask('sun', datetime.time.min, datetime.time.max))
+        t = datetime.time
+        self.assertEqual(day_intervals(mask), {
+            'mon': [(t(6), t(8, 0, 59)), (t(12), t(13, 30, 59))],
+            'sun': [(t(0), t(23, 59, 59))]})
+        self.assertEqual(day_bounds(mask)['mon'], (t(6), t(13, 30, 59)))
+
+
+class UidTests(TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize_uid('DE AD BE EF'), 'deadbeef')
+        self.assertEqual(normalize_uid('1 2 ab'), '0102ab')
+        self.assertEqual(normalize_uid(' deadbeef '), 'deadbeef')
+        for bad in ['', ' ', 'xyz', '0x12', '12_34']:
+            self.assertRaises(ValueError, normalize_uid, bad)
+
+    def test_key(self):
+        self.assertEqual(uid_key('de ad be ef'), 0xdeadbeef)
+        self.assertEqual(uid_key('ffffffffffffffff'), -1)
+        self.assertRaises(ValueError, uid_key, '01' * 9)
+
+    def test_card_key(self):
+        card = AccessCard.objects.create(member=make_member(), unique_id='DE AD BE EF')
+        self.assertEqual(card.unique_id, 'deadbeef')
+        self.assertEqual(card.numeric(), 0xdeadbeef)
+        self.assertEqual(AccessCard.objects.by_uid('DEADBEEF').get(), card)
+        self.assertFalse(AccessCard.objects.by_uid('not a uid').exists())
+
+    def test_unique_form(self):
+        member = make_member()
+        AccessCard.objects.create(member=member, unique_id='deadbeef')
+        CardForm = modelform_factory(AccessCard, fields=['member', 'unique_id'])
+
+        form = CardForm({'member': member.pk, 'unique_id': 'DE AD BE EF'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('unique_id', form.errors)
+        self.assertTrue(CardForm({'member': member.pk, 'unique_id': 'cafebabe'}).is_valid())
+
+        card = AccessCard.objects.get()
+        self.assertTrue(CardForm({'member': member.pk, 'unique_id': 'DEADBEEF'},
+                                 instance=card).is_valid())
+
+    def test_unique_views(self):
+        User.objects.create_user('staff', password='pass')
+        self.client.login(username='staff', password='pass')
+        member = make_member()
+        card = AccessCard.objects.create(member=member, unique_id='deadbeef')
+
+        resp = self.client.post('/members/cards/add/', {'member': member.pk,
+                                                         'unique_id': 'de ad be ef'})
+        self.assertContains(resp, "A card with that ID already exists")
+        self.assertEqual(AccessCard.objects.count(), 1)
+
+        #a card keeps its own uid
+        resp = self.client.post('/members/cards/edit/{}/'.format(card.pk),
+                                {'member': member.pk, 'unique_id': 'DE AD BE EF'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotContains(resp, "A card with that ID already exists")
+
+    def test_backfill(self):
+        member = make_member()
+        for uid in ['DEADBEEF', 'de ad be ef', 'cafebabe', 'bogus']:
+            AccessCard.objects.create(member=member, unique_id='0')
+            AccessCard.objects.filter(unique_id='0').update(unique_id=uid, key=None)
+
+        call_command('backfill_card_keys', stdout=StringIO())
+        keys = dict(AccessCard.objects.values_list('unique_id', 'key'))
+        self.assertEqual(keys, {'deadbeef': 0xdeadbeef, 'de ad be ef': None,
+                                'cafebabe': 0xcafebabe, 'bogus': None})
+
+
+class AccessIndexTests(TestCase):
+
+    def setUp(self):
+        #the index outlives the per-test transaction rollback
+        index.invalidate()
+        self.member = make_member()
+        self.card = AccessCard.objects.create(member=self.member, unique_id='deadbeef')
+        self.group = AccessGroup.objects.create(name="Weekdays")
+        self.group.card.add(self.card)
+        TimeBlock.objects.create(group=self.group, day='mon',
+                                 start=datetime.time(9), end=datetime.time(17))
+
+    def test_lookup(self):
+        entries = index.lookup('deadbeef')
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(str(entries[0]), str(self.card))
+        self.assertEqual(index.lookup('cafebabe'), ())
+        self.assertEqual(index.lookup('DE AD BE EF'), entries)
+
+    def test_matches_orm(self):
+        for hour in range(24):
+            t = datetime.time(hour)
+            self.assertEqual(index.has_access_at_time('deadbeef', MONDAY, t),
+                             self.card.has_access_at_time(MONDAY, t))
+
+    def test_timeblock_signal(self):
+        self.assertFalse(index.has_access_at_time('deadbeef', TUESDAY, datetime.time(12)))
+        TimeBlock.objects.create(group=self.group, day='tues')
+        self.assertTrue(index.has_access_at_time('deadbeef', TUESDAY, datetime.time(12)))
+
+    def test_group_signal(self):
+        self.assertTrue(index.has_access_at_time('deadbeef', MONDAY, datetime.time(12)))
+        self.card.accessgroup_set.clear()
+        self.assertFalse(index.has_access_at_time('deadbeef', MONDAY, datetime.time(12)))
+
+    def test_card_signal(self):
+        self.card.unique_id = 'cafebabe'
+        self.card.save()
+        self.assertEqual(index.lookup('deadbeef'), ())
+        self.assertTrue(index.has_access_at_time('cafebabe', MONDAY, datetime.time(12)))
+
+
+class AccessGroupScheduleTests(TestCase):
+
+    def setUp(self):
+        self.group = AccessGroup.objects.create(name="Weekdays")
+        self.block = TimeBlock.objects.create(group=self.group, day='mon',
+                                              start=datetime.time(9), end=datetime.time(17))
+
+    def test_schedule_compiled(self):
+        self.group.refresh_from_db()
+        self.assertIsNotNone(self.group.schedule)
+        self.assertEqual(self.group.weekly_mask(),
+                         block_mask('mon', datetime.time(9), datetime.time(17)))
+
+    def test_schedule_follows_blocks(self):
+        other = AccessGroup.objects.create(name="Other")
+        self.block.group = other
+        self.block.save()
+        self.group.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.group.weekly_mask(), 0)
+        self.assertNotEqual(other.weekly_mask(), 0)
+
+        self.block.delete()
+        other.refresh_from_db()
+        self.assertEqual(other.weekly_mask(), 0)
+
+    def test_weekly_access(self):
+        card = AccessCard.objects.create(member=make_member(), unique_id='deadbeef')
+        self.group.card.add(card)
+        TimeBlock.objects.create(group=self.group, day='mon',
+                                 start=datetime.time(8), end=datetime.time(10))
+
+        resp = self.client.post('/members/weekly_access/', {'id': 'deadbeef'})
+        self.assertEqual(resp.json(), {'mon': {'start': '08:00:00', 'end': '17:00:59'}})
+
+
+class AccessCardQuerySetTests(TestCase):
+
+    def setUp(self):
+        member = make_member()
+        self.early = AccessCard.objects.create(member=member, unique_id='0001')
+        self.late = AccessCard.objects.create(member=member, unique_id='0002')
+        self.nobody = AccessCard.objects.create(member=member, unique_id='0003')
+
+        early_group = AccessGroup.objects.create(name="Early")
+        early_group.card.add(self.early)
+        TimeBlock.objects.create(group=early_group, day='mon',
+                                 start=datetime.time(6), end=datetime.time(12))
+        late_group = AccessGroup.objects.create(name="Late")
+        late_group.card.add(self.early, self.late)
+        TimeBlock.objects.create(group=late_group, day='mon',
+                                 start=datetime.time(12, 30), end=datetime.time(22))
+
+    def test_with_access_at(self):
+        when = datetime.datetime.combine(MONDAY, datetime.time(13))
+        with self.assertNumQueries(1):
+            cards = set(AccessCard.objects.with_access_at(when))
+        self.assertEqual(cards, {self.early, self.late})
+        self.assertEqual(set(AccessCard.objects.without_access_at(when)), {self.nobody})
+
+    def test_card_list(self):
+        User.objects.create_user('staff', password='pass')
+        self.client.login(username='staff', password='pass')
+        resp = self.client.get('/members/cards/')
+        self.assertContains(resp, 'Access Now')
+
+    def test_matches_has_access_at_time(self):
+        for hour in range(24):
+            for minute in (0, 15, 30, 59):
+                when = datetime.datetime.combine(MONDAY, datetime.time(hour, minute, 30))
+                for card in AccessCard.objects.annotate_access_at(when):
+                    self.assertEqual(card.has_access,
+                                     card.has_access_at_time(when.date(), when.time()))
+
+
+class LogSinkTests(TestCase):
+
+    @override_settings(LOG_SINK_ASYNC=True, LOG_SINK_BATCH_SIZE=1000,
+                       LOG_SINK_FLUSH_INTERVAL=3600)
+    def test_queued_until_flush(self):
+        for n in range(3):
+            LogAccessRequest.log_now("swipe {}".format(n))
+            LogEvent.log_now("edit {}".format(n))
+        self.assertEqual(LogAccessRequest.objects.count(), 0)
+
+        log_sink.flush()
+        self.assertEqual(LogAccessRequest.objects.count(), 3)
+        self.assertEqual(LogEvent.objects.count(), 3)
+        self.assertEqual(log_sink.pending(), 0)
+
+    @override_settings(LOG_SINK_ASYNC=True, LOG_SINK_BATCH_SIZE=1000,
+                       LOG_SINK_FLUSH_INTERVAL=3600)
+    def test_bad_row_dropped(self):
+        now = timezone.now()
+        AccessEvent.objects.create(timestamp=now, uid='deadbeef', granted=True,
+                                   reason=AccessEvent.REASON_OK, event_id='taken')
+        for event_id in ['a', 'taken', 'b']:
+            log_sink.put(AccessEvent(timestamp=now, uid='deadbeef', granted=True,
+                                     reason=AccessEvent.REASON_OK, event_id=event_id))
+        LogEvent.log_now("edit")
+
+        with redirect_stdout(StringIO()) as out:
+            log_sink.flush()
+        self.assertIn("dropping", out.getvalue())
+        self.assertEqual(sorted(AccessEvent.objects.values_list('event_id', flat=True)),
+                         ['a', 'b', 'taken'])
+        self.assertEqual(LogEvent.objects.count(), 1)
+        self.assertEqual(log_sink.pending(), 0)
+
+
+@override_settings(LOG_SINK_ASYNC=False)
+class AuthViewTests(TestCase):
+
+    def setUp(self):
+        index.invalidate()
+
+    def test_unknown_card(self):
+        resp = self.client.post('/members/auth/', {'id': 'cafebabe', 'door': 'front'})
+        self.assertEqual(resp.content, b'Denied')
+
+        event = AccessEvent.objects.get()
+        self.assertEqual(event.uid, 'cafebabe')
+        self.assertFalse(event.granted)
+        self.assertEqual(event.reason, AccessEvent.REASON_NOT_FOUND)
+        self.assertEqual(event.door, 'front')
+
+    def test_granted(self):
+        card = AccessCard.objects.create(member=make_member(), unique_id='deadbeef')
+        group = AccessGroup.objects.create(name="Always")
+        group.card.add(card)
+        for day, _ in TimeBlock.DAY_CHOICES:
+            TimeBlock.objects.create(group=group, day=day)
+
+        resp = self.client.post('/members/auth/', {'id': 'deadbeef'})
+        self.assertEqual(resp.content, b'Granted')
+
+        event = AccessEvent.objects.get()
+        self.assertEqual(event.card, card)
+        self.assertEqual(event.member, card.member)
+        self.assertTrue(event.granted)
+
+    def test_revoked_elsewhere(self):
+        card = AccessCard.objects.create(member=make_member(), unique_id='deadbeef')
+        group = AccessGroup.objects.create(name="Always")
+        group.card.add(card)
+        for day, _ in TimeBlock.DAY_CHOICES:
+            TimeBlock.objects.create(group=group, day=day)
+        self.assertEqual(self.client.post('/members/auth/', {'id': 'deadbeef'}).content,
+                         b'Granted')
+
+        #a queryset delete sends no m2m_changed, as if another process had made the change
+        AccessRulesVersion.bump()
+        AccessGroup.card.through.objects.all().delete()
+
+        self.assertEqual(self.client.post('/members/auth/', {'id': 'deadbeef'}).content,
+                         b'Denied')
+        self.assertEqual(self.client.post('/members/weekly_access/', {'id': 'deadbeef'}).json(),
+                         {})
+
+
+@override_settings(LOG_SINK_ASYNC=False)
+class AuthBatchTests(TestCase):
+
+    def setUp(self):
+        index.invalidate()
+        card = AccessCard.objects.create(member=make_member(), unique_id='deadbeef')
+        group = AccessGroup.objects.create(name="Monday mornings")
+        group.card.add(card)
+        TimeBlock.objects.create(group=group, day='mon',
+                                 start=datetime.time(6), end=datetime.time(12))
+
+    def post(self, entries):
+        return self.client.post('/members/auth/batch/', json.dumps(entries),
+                                content_type='application/json')
+
+    def test_batch(self):
+        monday_9am = timezone.make_aware(datetime.datetime(2018, 1, 1, 9)).timestamp()
+        monday_1pm = timezone.make_aware(datetime.datetime(2018, 1, 1, 13)).timestamp()
+
+        index.lookup('deadbeef')
+        #the version check and the log
+        with self.assertNumQueries(2):
+            resp = self.post([['deadbeef', monday_9am, 'front'],
+                              ['deadbeef', monday_1pm, 'front'],
+                              ['cafebabe', None],
+                              ['DE AD BE EF', monday_9am]] * 25)
+
+        results = resp.json()['results']
+        self.assertEqual(len(results), 100)
+        self.assertEqual([r['decision'] for r in results[:4]],
+                         ['Granted', 'Denied', 'Denied', 'Granted'])
+        self.assertEqual(results[2]['reason'], AccessEvent.REASON_NOT_FOUND)
+        self.assertEqual(AccessEvent.objects.count(), 100)
+        self.assertEqual(AccessEvent.objects.filter(door='front').count(), 50)
+
+    def test_bad_batch(self):
+        self.assertEqual(self.post({'id': 'deadbeef'}).status_code, 400)
+        self.assertEqual(self.post([['deadbeef', 'noon']]).status_code, 400)
+        self.assertEqual(self.post([{'id': 'deadbeef'}]).status_code, 400)
+        self.assertEqual(self.post(['deadbeef']).status_code, 400)
+        self.assertEqual(self.client.get('/members/auth/batch/').status_code, 405)
+
+
+@override_settings(LOG_SINK_ASYNC=False)
+class AccessEventsTests(TestCase):
+
+    def setUp(self):
+        index.invalidate()
+        self.card = AccessCard.objects.create(member=make_member(), unique_id='deadbeef')
+        group = AccessGroup.objects.create(name="Monday mornings")
+        group.card.add(self.card)
+        TimeBlock.objects.create(group=group, day='mon',
+                                 start=datetime.time(6), end=datetime.time(12))
+        self.monday_9am = timezone.make_aware(datetime.datetime(2018, 1, 1, 9)).timestamp()
+
+    def post(self, events):
+        return self.client.post('/members/access/events/', json.dumps(events),
+                                content_type='application/json')
+
+    def test_ingest(self):
+        events = [{'event_id': 'front:1', 'uid': 'deadbeef', 'timestamp': self.monday_9am,
+                   'granted': True, 'door': 'front'},
+                  #let in from the cache while the card was revoked
+                  {'event_id': 'front:2', 'uid': 'cafebabe', 'timestamp': self.monday_9am,
+                   'granted': True, 'door': 'front'}]
+        resp = self.post(events)
+        self.assertEqual(resp.json(), {'stored': 2, 'duplicates': 0})
+
+        event = AccessEvent.objects.get(event_id='front:1')
+        self.assertEqual(event.card, self.card)
+        self.assertEqual(event.member, self.card.member)
+        self.assertEqual(event.reason, AccessEvent.REASON_OK)
+        self.assertEqual(event.timestamp.timestamp(), self.monday_9am)
+        unknown = AccessEvent.objects.get(event_id='front:2')
+        self.assertTrue(unknown.granted)
+        self.assertEqual(unknown.reason, AccessEvent.REASON_NOT_FOUND)
+
+        #the answer got lost, the gatekeeper sends them again with a new one
+        events.append(dict(events[0], event_id='front:3'))
+        resp = self.post(events)
+        self.assertEqual(resp.json(), {'stored': 1, 'duplicates': 2})
+        self.assertEqual(AccessEvent.objects.count(), 3)
+
+    def test_bad_events(self):
+        self.assertEqual(self.post({'event_id': 'front:1'}).status_code, 400)
+        self.assertEqual(self.post([{'event_id': 'front:1', 'uid': 'deadbeef'}]).status_code,
+                         400)
+        self.assertEqual(self.post([{'event_id': '', 'uid': 'deadbeef', 'granted': True,
+                                     'timestamp': self.monday_9am}]).status_code, 400)
+        self.assertEqual(AccessEvent.objects.count(), 0)
+
+    def test_auth_then_upload(self):
+        resp = self.client.post('/members/auth/', {'id': 'deadbeef', 'event': 'front:1'})
+        self.assertIn(resp.content, [b'Granted', b'Denied'])
+        self.assertEqual(AccessEvent.objects.get().event_id, 'front:1')
+
+        #the gatekeeper uploads the same decision later
+        resp = self.post([{'event_id': 'front:1', 'uid': 'deadbeef', 'granted': True,
+                           'timestamp': self.monday_9am}])
+        self.assertEqual(resp.json(), {'stored': 0, 'duplicates': 1})
+        self.assertEqual(AccessEvent.objects.count(), 1)
+
+
+class AccessSnapshotTests(TestCase):
+
+    def setUp(self):
+        index.invalidate()
+        self.group = AccessGroup.objects.create(name="Monday mornings")
+        TimeBlock.objects.create(group=self.group, day='mon',
+                                 start=datetime.time(6), end=datetime.time(12))
+        for uid in ['deadbeef', 'cafebabe']:
+            card = AccessCard.objects.create(member=make_member(), unique_id=uid)
+            self.group.card.add(card)
+        AccessCard.objects.create(member=make_member(), unique_id='0badf00d')
+
+    def test_snapshot(self):
+        resp = self.client.get('/members/access/snapshot/')
+        self.assertEqual(resp.status_code, 200)
+        data = resp.json()
+        self.assertEqual(data['version'], AccessRulesVersion.current())
+        self.assertEqual(resp['ETag'], '"{}"'.format(data['version']))
+
+        self.assertEqual(data['cards']['deadbeef'], data['cards']['cafebabe'])
+        self.assertEqual(len(data['schedules']), 2)
+        monday = data['schedules'][data['cards']['deadbeef']]
+        self.assertEqual(monday, {'mon': [['06:00:00', '12:00:59']]})
+        self.assertEqual(data['schedules'][data['cards']['0badf00d']], {})
+
+    def test_not_modified(self):
+        etag = self.client.get('/members/access/snapshot/')['ETag']
+
+        index.lookup('deadbeef')
+        with self.assertNumQueries(1):
+            resp = self.client.get('/members/access/snapshot/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, b'')
+
+        AccessCard.objects.get(unique_id='0badf00d').delete()
+        resp = self.client.get('/members/access/snapshot/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertNotIn('0badf00d', resp.json()['cards'])
+
+    def test_page_not_modified(self):
+        etag = self.client.get('/members/access/snapshot/', {'limit': 2})['ETag']
+        resp = self.client.get('/members/access/snapshot/', {'limit': 2},
+                               HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+        #never seen by the client: not the same document as the first page or the whole
+        for params in [{'limit': 2, 'after': 'cafebabe'}, {}]:
+            resp = self.client.get('/members/access/snapshot/', params,
+                                   HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(resp.status_code, 200)
+
+    def test_pages(self):
+        resp = self.client.get('/members/access/snapshot/', {'limit': 2})
+        first = resp.json()
+        self.assertEqual(sorted(first['cards']), ['0badf00d', 'cafebabe'])
+        self.assertEqual(first['next'], 'cafebabe')
+
+        resp = self.client.get('/members/access/snapshot/', {'after': 'cafebabe', 'limit': 2})
+        last = resp.json()
+        self.assertEqual(list(last['cards']), ['deadbeef'])
+        self.assertIsNone(last['next'])
+        self.assertEqual(last['schedules'], [{'mon': [['06:00:00', '12:00:59']]}])
+
+        resp = self.client.get('/members/access/snapshot/', {'limit': 'many'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_other_process_change(self):
+        version = index.version()
+        #a queryset delete sends no m2m_changed, as if another process had made the change
+        AccessRulesVersion.bump()
+        AccessGroup.card.through.objects.all().delete()
+
+        resp = self.client.get('/members/access/snapshot/')
+        self.assertEqual(resp.json()['version'], version + 1)
+        self.assertEqual(len(resp.json()['schedules']), 1)
+
+
+class AccessChangesTests(TestCase):
+
+    def setUp(self):
+        index.invalidate()
+        self.group = AccessGroup.objects.create(name="Monday mornings")
+        TimeBlock.objects.create(group=self.group, day='mon',
+                                 start=datetime.time(6), end=datetime.time(12))
+        self.card = AccessCard.objects.create(member=make_member(), unique_id='deadbeef')
+        self.other = AccessCard.objects.create(member=make_member(), unique_id='cafebabe')
+        self.group.card.add(self.card, self.other)
+
+    def changes(self, since):
+        return self.client.get('/members/access/changes/', {'since': since}).json()
+
+    def journal(self, since):
+        return list(AccessChange.objects.filter(seq__gt=since).order_by('pk')
+                    .values_list('table', 'action', 'uid'))
+
+    def test_journal(self):
+        since = AccessRulesVersion.current()
+        self.card.unique_id = '0badf00d'
+        self.card.save()
+        self.group.card.remove(self.other)
+        self.other.accessgroup_set.add(self.group)
+        self.group.card.clear()
+        self.other.delete()
+
+        self.assertEqual(self.journal(since), [
+            ('card', 'update', '0badf00d'),
+            ('card', 'delete', 'deadbeef'),
+            ('membership', 'delete', 'cafebabe'),
+            ('membership', 'insert', 'cafebabe'),
+            ('membership', 'delete', '0badf00d'),
+            ('membership', 'delete', 'cafebabe'),
+            ('card', 'delete', 'cafebabe'),
+        ])
+        self.assertEqual(AccessChange.objects.filter(seq__gt=since)
+                         .values('seq').distinct().count(), 5)
+
+    def test_delta(self):
+        since = AccessRulesVersion.current()
+        self.assertEqual(self.changes(since)['cards'], {})
+
+        self.card.unique_id = '0badf00d'
+        self.card.save()
+        data = self.changes(since)
+        self.assertFalse(data['full'])
+        self.assertEqual(data['version'], AccessRulesVersion.current())
+        self.assertEqual(list(data['cards']), ['0badf00d'])
+        self.assertEqual(data['removed'], ['deadbeef'])
+
+        since = data['version']
+        TimeBlock.objects.create(group=self.group, day='tues',
+                                 start=datetime.time(6), end=datetime.time(12))
+        data = self.changes(since)
+        self.assertEqual(sorted(data['cards']), ['0badf00d', 'cafebabe'])
+        self.assertEqual(sorted(data['schedules'][0]), ['mon', 'tues'])
+        self.assertEqual(data['removed'], [])
+
+    def test_version_with_journal(self):
+        #a version is never visible without its journal rows
+        since = AccessRulesVersion.current()
+        with mock.patch.object(AccessChange.objects, 'bulk_create',
+                               side_effect=DatabaseError("disk full")):
+            with self.assertRaises(DatabaseError):
+                self.card.save()
+        self.assertEqual(AccessRulesVersion.current(), since)
+
+    def test_compacted(self):
+        since = AccessRulesVersion.current()
+        AccessCard.objects.create(member=make_member(), unique_id='0badf00d')
+        AccessChange.objects.update(timestamp=timezone.now() - datetime.timedelta(days=60))
+        TimeBlock.objects.create(group=self.group, day='tues')
+
+        call_command('compact_access_journal', stdout=StringIO())
+        self.assertEqual(AccessChange.objects.count(), 1)
+        self.assertEqual(AccessRulesVersion.compacted_up_to(), since + 1)
+
+        self.assertTrue(self.changes(since)['full'])
+        self.assertEqual(len(self.changes(since)['cards']), 3)
+        self.assertFalse(self.changes(since + 1)['full'])
+        self.assertTrue(self.changes(0)['full'])
+
+
+@override_settings(ACCESS_WAIT_POLL_INTERVAL=0.01)
+class AccessWaitTests(TestCase):
+
+    def setUp(self):
+        AccessGroup.objects.create(name="Monday mornings")
+        rules_watch.notify()
+
+    def wait(self, **params):
+        return self.client.get('/members/access/wait/', params)
+
+    def test_changed(self):
+        version = AccessRulesVersion.current()
+        resp = self.wait(since=version - 1)
+        self.assertEqual(resp.json(), {'version': version, 'changed': True})
+
+    def test_timeout(self):
+        version = AccessRulesVersion.current()
+        t1 = time.monotonic()
+        resp = self.wait(since=version, timeout=0.1)
+        self.assertGreaterEqual(time.monotonic() - t1, 0.1)
+        self.assertEqual(resp.json(), {'version': version, 'changed': False})
+
+    def test_bad_request(self):
+        self.assertEqual(self.wait(since='latest').status_code, 400)
+
+
+@override_settings(LOG_SINK_ASYNC=False)
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        index.invalidate()
+        metrics.reset()
+        AccessCard.objects.create(member=make_member(), unique_id='deadbeef')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(buckets=(0.01, 0.1))
+        for seconds in [0.005, 0.05, 0.05, 5]:
+            histogram.observe(seconds)
+        self.assertEqual(histogram.cumulative(), [(0.01, 1), (0.1, 3), ('+Inf', 4)])
+        self.assertEqual(histogram.count, 4)
+
+    def test_endpoint(self):
+        self.client.post('/members/auth/', {'id': 'deadbeef'})
+        self.client.post('/members/auth/', {'id': 'cafebabe'})
+        self.client.post('/members/weekly_access/', {'id': 'deadbeef'})
+        #keep-warm pings
+        self.client.get('/members/weekly_access/')
+        self.client.get('/members/access/snapshot/')
+
+        text = self.client.get('/members/metrics/').content.decode()
+        self.assertIn('# TYPE msys_request_stage_seconds histogram', text)
+        for view, stage, count in [('auth', 'total', 2), ('auth', 'lookup', 2),
+                                   ('auth', 'schedule', 1), ('auth', 'log', 2),
+                                   ('weekly_access', 'schedule', 1)]:
+            self.assertIn('msys_request_stage_seconds_count{{view="{}",stage="{}"}} {}\n'
+                          .format(view, stage, count), text)
+        self.assertIn('view="auth",stage="total",le="+Inf"} 2', text)
+        self.assertIn('view="weekly_access",stage="total",le="+Inf"} 1', text)
+
+    def test_card_login(self):
+        User.objects.create_user('staff', password='pass')
+        self.client.login(username='staff', password='pass')
+        self.client.get('/members/cards/login/cafebabe/')
+        text = self.client.get('/members/metrics/').content.decode()
+        self.assertIn('view="loginCard",stage="total",le="+Inf"} 1', text)
+        self.assertNotIn('accessSnapshot', text)
+
+
+class GenerateDatasetTests(TestCase):
+
+    def generate(self, **options):
+        call_command('generate_dataset', stdout=StringIO(), **options)
+
+    def test_generate(self):
+        index.invalidate()
+        version = AccessRulesVersion.current()
+        self.generate(members=50, logs=200, groups=4, seed=3, cards_per_member='1=1',
+                      memberships_per_member='2=1', expired=0.5)
+
+        self.assertEqual(Member.objects.count(), 50)
+        self.assertEqual(AccessCard.objects.count(), 50)
+        self.assertEqual(Membership.objects.count(), 100)
+        self.assertEqual(AccessEvent.objects.count(), 200)
+        self.assertEqual(AccessGroup.objects.exclude(schedule=None).count(), 4)
+        active = sum(m.has_active_membership() for m in Member.objects.all())
+        self.assertTrue(10 < active < 40)
+
+        #the doors are sent the full snapshot
+        self.assertGreater(AccessRulesVersion.compacted_up_to(), version)
+        card = AccessCard.objects.first()
+        self.assertEqual(index.lookup(card.unique_id)[0].pk, card.pk)
+
+    def test_seed(self):
+        def uids():
+            with transaction.atomic():
+                self.generate(members=20, logs=10, seed=5)
+                result = sorted(AccessCard.objects.values_list('unique_id', flat=True))
+                transaction.set_rollback(True)
+            return result
+
+        self.assertEqual(uids(), uids())
+
+    def test_bad_distribution(self):
+        with self.assertRaises(CommandError):
+            self.generate(members=1, cards_per_member='one')
+
+
+class MicrobenchTests(TestCase):
+
+    def test_cases(self):
+        call_command('generate_dataset', members=20, logs=0, stdout=StringIO())
+        for case in build_cases(5, random.Random(1)):
+            result = run_case(case, 1)
+            self.assertGreater(result['median_us'], 0, case.name)
+
+    def test_compare(self):
+        def results(**cases):
+            return {'cases': {name: {'median_us': us, 'queries': queries}
+                              for name, (us, queries) in cases.items()}}
+
+        baseline = results(fast=(100, 1), same=(100, 1), slow=(100, 1), chatty=(100, 1))
+        new = results(fast=(50, 1), same=(110, 1), slow=(200, 1), chatty=(100, 2))
+        flagged = [row[0] for row in compare(baseline, new, 0.25) if row[4]]
+        self.assertEqual(flagged, ['chatty', 'slow'])
+
+
+class ImportAccessLogsTests(TestCase):
+
+    def test_import(self):
+        member = make_member("Jane", "Doe")
+        card = AccessCard.objects.create(member=member, unique_id='deadbeef')
+        date = datetime.date(2018, 1, 1)
+        for text in ["Granted access for card deadbeef (Jane Doe)",
+                     "Denied access for card: deadbeef (Jane Doe) [no access at this time]",
+                     "Denied access for ID: cafebabe [card not found]",
+                     "something else entirely"]:
+            LogAccessRequest.objects.create(date=date, time=datetime.time(12), text=text)
+        LogCardLogin.objects.create(
+            date=date, time=datetime.time(13),
+            text="Member: Jane [ID: {}] logged in with the card: 3735928559 [ID: {}]".format(
+                member.pk, card.pk))
+
+        call_command('import_access_logs', stdout=StringIO())
+        #running it again must not duplicate anything
+        call_command('import_access_logs', stdout=StringIO())
+
+        events = AccessEvent.objects.order_by('pk')
+        self.assertEqual([(e.uid, e.granted, e.reason) for e in events],
+                         [('deadbeef', True, AccessEvent.REASON_OK),
+                          ('deadbeef', False, AccessEvent.REASON_NO_ACCESS),
+                          ('cafebabe', False, AccessEvent.REASON_NOT_FOUND),
+                          ('', False, AccessEvent.REASON_UNKNOWN),
+                          ('deadbeef', True, AccessEvent.REASON_OK)])
+        self.assertEqual(AccessEvent.objects.filter(member=member).count(), 3)
+        self.assertEqual(events.last().door, AccessEvent.CARD_LOGIN_DOOR)
+
+    def test_access_log_filter(self):
+        User.objects.create_user('staff', password='pass')
+        self.client.login(username='staff', password='pass')
+        member = make_member()
+        AccessEvent.objects.create(timestamp=timezone.now(), uid='deadbeef', member=member,
+                                   granted=True, reason=AccessEvent.REASON_OK)
+        AccessEvent.objects.create(timestamp=timezone.now(), uid='cafebabe',
+                                   granted=False, reason=AccessEvent.REASON_NOT_FOUND)
+
+        resp = self.client.get('/members/logs/access/', {'member': member.pk})
+        self.assertContains(resp, 'deadbeef')
+        self.assertNotContains(resp, 'cafebabe')
+
+        #bad ids are ignored rather than passed to the database
+        for bad in ['abc', '1.5', '9' * 30]:
+            resp = self.client.get('/members/logs/access/', {'card': bad})
+            self.assertContains(resp, 'cafebabe')
+
+    def test_access_log_door_link(self):
+        User.objects.create_user('staff', password='pass')
+        self.client.login(username='staff', password='pass')
+        AccessEvent.objects.create(timestamp=timezone.now(), uid='deadbeef', granted=True,
+                                   reason=AccessEvent.REASON_OK, door='front & back')
+
+        resp = self.client.get('/members/logs/access/')
+        self.assertContains(resp, '?door=front%20%26%20back')
+        resp = self.client.get('/members/logs/access/', {'door': 'front & back'})
+        self.assertContains(resp, 'deadbeef')
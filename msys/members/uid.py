@@ -0,0 +1,51 @@
+"""
+UID
+
+Every card uid coming from a reader, a URL or a form goes through normalize_uid() so that
+the same card is always spelled the same way, and through uid_key() to get the integer
+used to look it up (AccessCard.key).
+"""
+from django.core.exceptions import ValidationError
+
+
+def normalize_uid(raw):
+    """
+    Returns the canonical text form of a card uid: lowercase hex without spaces
+
+    Space separated bytes ("de ad be ef", "1 2") are zero padded to two digits each.
+    Raises ValueError if the uid is empty or not hexadecimal.
+    """
+    tokens = str(raw).split()
+    if len(tokens) > 1:
+        tokens = [token.zfill(2) for token in tokens]
+    text = ''.join(tokens).lower()
+
+    #int() would also accept things like '0x' and '_'
+    if not text or any(c not in '0123456789abcdef' for c in text):
+        raise ValueError("invalid card uid: [{}]".format(raw))
+    return text
+
+def uid_key(raw):
+    """
+    Returns the 64-bit integer key of a card uid
+
+    The unsigned value of the uid is folded into the signed range of a database BIGINT.
+    Raises ValueError if the uid is invalid or longer than 8 bytes.
+    """
+    num = int(normalize_uid(raw), 16)
+    if num >= 1 << 64:
+        raise ValueError("card uid does not fit in 64 bits: [{}]".format(raw))
+    if num >= 1 << 63:
+        num -= 1 << 64
+    return num
+
+def key_to_numeric(key):
+    """Returns the unsigned value of a key made by uid_key()"""
+    return key % (1 << 64)
+
+def validate_uid(value):
+    """Model field validator for card uids"""
+    try:
+        uid_key(value)
+    except ValueError as err:
+        raise ValidationError(str(err))
@@ -50,6 +50,12 @@ urlpatterns = [
     url(r'^logout/$', views.user_logout, name='userLogout'),
     url(r'latency/$', views.latency, name='latency'),
     url(r'^weekly_access/$', views.weekly_access, name='weekly_access'),
+    path('access/snapshot/', views.access_snapshot, name='accessSnapshot'),
+    path('access/changes/', views.access_changes, name='accessChanges'),
+    path('access/wait/', views.access_wait, name='accessWait'),
+    path('access/events/', views.access_events, name='accessEvents'),
     url(r'^auth/$', views.auth, name='auth'),
+    path('auth/batch/', views.auth_batch, name='authBatch'),
+    path('metrics/', views.metrics_view, name='metrics'),
     path('update/caches/', views.updateAllCaches, name='updateAllCaches'),
 ]
@@ -4,13 +4,20 @@ Views
 This is where the main logic happens behind the scenes.
 
 """
+import bisect
 import datetime
+import hashlib
+import json
+from collections import OrderedDict
 from members.models import *
 from members.forms import *
 from django.core.mail import send_mail
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.shortcuts import get_object_or_404, render
 from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.http import HttpResponseBadRequest
+from django.utils import timezone
+from django.views.decorators.http import require_POST, require_safe, condition
 from django.contrib.auth import authenticate, login, logout
 from django.views.decorators.csrf import csrf_exempt
 from django.template.loader import render_to_string
@@ -18,6 +25,12 @@ from django.conf import settings
 from time import sleep
 
 from .stripe_handler import director
+from .access_index import index as access_index
+from .log_sink import sink as log_sink
+from .schedule import day_bounds, day_intervals, mask_has_access
+from .uid import normalize_uid
+from .rules_watch import watch as rules_watch
+from . import metrics
 
 import stripe
 
@@ -83,6 +96,7 @@ def memberDetails(request, member_id):
     mem = get_object_or_404(Member, pk=member_id)
 
     cards = AccessCard.objects.filter(member=mem)
+    events = AccessEvent.objects.filter(member=mem).order_by('-timestamp')[:10]
 
     stripe_info = None
     subs = None
@@ -112,6 +126,7 @@ def memberDetails(request, member_id):
                   'members/member_details.html',
                   {'member': mem,
                    'access_cards': cards,
+                   'access_events': events,
                    'stripe_info': stripe_info,
                    'subs': subs,
                    'logged_in': True}
@@ -126,8 +141,7 @@ def memberDetailsByRFID(request, rfid):
 
     rfid -- a unique id related to a Member via AccessCard object
     """
-    rfid = rfid.replace(' ', '').lower()
-    card = get_object_or_404(AccessCard, unique_id=rfid)
+    card = get_object_or_404(AccessCard.objects.by_uid(rfid))
     mem = card.member
 
     cards = AccessCard.objects.filter(member=mem)
@@ -463,7 +477,8 @@ def redeemPromoItem(request, pi_id):
 @login_required
 def cards(request):
     """Render list of AccessCard objects"""
-    card_list = AccessCard.objects.all()
+    card_list = (AccessCard.objects.select_related('member')
+                 .annotate_access_at(datetime.datetime.now()))
     return render(request, 'members/access_cards.html', {'card_list': card_list,
                                                          'logged_in': True})
 
@@ -474,13 +489,12 @@ def confirmCard(request, card_rfid):
 
     Will also present the option to create a new card
     """
-    card_rfid = card_rfid.replace(' ', '').lower()
-
     try:
-        card = AccessCard.objects.get(unique_id=card_rfid)
+        card = AccessCard.objects.by_uid(card_rfid).get()
 
         return request, card
     except AccessCard.DoesNotExist:
+        card_rfid = card_rfid.replace(' ', '').lower()
         data = {'unique_id': card_rfid}
         c_form = CardForm(initial=data)
 
@@ -502,16 +516,19 @@ def loginCard(request, card_rfid):
     msg = ' '
 
     #Confirm card exists
-    request, card = confirmCard(request, card_rfid)
+    with metrics.stage('lookup'):
+        request, card = confirmCard(request, card_rfid)
     if(card == 0):
         return request
     member = get_object_or_404(Member, id=card.member.id)
 
     print(member.has_cache)
     
-    member_cache = member.get_cache
-    
-    memberships = member.get_membership_cache
+    #the member's Stripe caches, nothing to do with the access schedule
+    with metrics.stage('membership'):
+        member_cache = member.get_cache
+
+        memberships = member.get_membership_cache
 
     if(len(memberships)>0):
         pass_status = True
@@ -532,11 +549,12 @@ def loginCard(request, card_rfid):
 
     #Create log
     if(pass_status):
-        log_info = "Member: {} [ID: {}] logged in with the card: {} [ID: {}]".format(member.first_name, member.id, card.numeric(), card.id)
-        LogCardLogin.log_now(log_info)
+        reason = AccessEvent.REASON_OK
     else:
-        log_info = "Member: {} [ID: {}] access denied with card: {} [ID: {}] ({})".format(member.first_name, member.id, card.numeric(), card.id, msg)
-        LogCardLogin.log_now(log_info)
+        reason = AccessEvent.REASON_NO_MEMBERSHIP
+    with metrics.stage('log'):
+        AccessEvent.log_now(card.unique_id, pass_status, reason, card.pk, member.pk,
+                            AccessEvent.CARD_LOGIN_DOOR)
 
     return render(request, 'members/card_login.html', context)
 
@@ -565,11 +583,13 @@ def cardDetails(request, card_id):
     Optionally the user can request (via POST) to have a visual aid generated.
     The visual aid is a table of times over the next 7 days (hour-by-hour). The
     table will show the user which times the card provides access and which
-    times it does not. This may be a slow and expensive opteration.
+    times it does not. The card's weekly mask is computed once and
+    each cell of the table is a single bit test.
     """
     card = get_object_or_404(AccessCard, pk=card_id)
 
     group_list = card.accessgroup_set.all()
+    events = AccessEvent.objects.filter(card=card).order_by('-timestamp')[:10]
 
     t_cal = None
 
@@ -620,6 +640,9 @@ def cardDetails(request, card_id):
                 t_cal[0].append(day.strftime("%A %b %d"))
                 day_n += 1
 
+            #the card's groups are only fetched once, each cell is then a bit test
+            mask = card.weekly_mask()
+
             #now append the rows by hour with the first col being the title
             time_h = 0
             for row in t_cal[1:]:
@@ -628,7 +651,7 @@ def cardDetails(request, card_id):
                 row.append(time_str)
                 for n_day in range(7):
                     cell_dt = base_dt + datetime.timedelta(days=n_day, hours=time_h)
-                    row.append(card.has_access_at_time(cell_dt.date(), cell_dt.time()))
+                    row.append(mask_has_access(mask, cell_dt.date(), cell_dt.time()))
                 time_h += 1
         #end GET handler
 
@@ -636,6 +659,7 @@ def cardDetails(request, card_id):
                   'members/card_details.html',
                   {'card': card,
                    'groups': group_list,
+                   'access_events': events,
                    't_cal': t_cal,
                    'logged_in': True})
 
@@ -694,17 +718,17 @@ def editCard(request, card_id):
     Edit details of AccessCard
     """
     if request.method == 'POST':
-        card_form = CardForm(request.POST)
+        card = get_object_or_404(AccessCard, pk=card_id)
+        old_card = str(card)
+        #bound to the card so that it is not taken for a duplicate of itself
+        card_form = CardForm(request.POST, instance=card)
         if card_form.is_valid():
-            edited_card = card_form.save(commit=False)
-            actual_card = get_object_or_404(AccessCard, pk=card_id)
-            #commented out to allow modification of the ID
-            #edited_card.unique_id = actual_card.unique_id
-            edited_card.pk = actual_card.pk
-            edited_card.save()
+            #the form refuses a uid already used by another card (see
+            #AccessCard.validate_unique)
+            edited_card = card_form.save()
 
             log_str = "{} changed card: {} -> {}".format(request.user.username,
-                                                         actual_card,
+                                                         old_card,
                                                          edited_card)
             LogEvent.log_now(log_str)
 
@@ -727,19 +751,9 @@ def addCard(request):
     if request.method == 'POST':
         c_form = CardForm(request.POST)
         if c_form.is_valid():
-            newCard = c_form.save(commit=False)
-            #find out if we already have a card with the same ID
-            sameCards = AccessCard.objects.filter(unique_id=newCard.unique_id)
-            if len(sameCards) > 0:
-                #already exists
-                msg_err = "A card with that ID already exists"
-                return render(request, 'members/add_card.html',
-                              {'card_form': c_form,
-                               'msg_err': msg_err,
-                               'logged_in': True })
-
-            newCard.unique_id = newCard.unique_id.replace(' ', '').lower()
-            newCard.save()
+            #the form refuses a uid we already have (see AccessCard.validate_unique),
+            #save() normalizes it
+            newCard = c_form.save()
 
             log_str = "{} created a new card: {}".format(request.user.username, newCard)
             LogEvent.log_now(log_str)
@@ -797,8 +811,22 @@ def event_log(request):
 def access_log(request):
     """
     Display log entries
+
+    The list can be narrowed down with the card, member (ids) and door GET parameters,
+    ids that are not numbers are ignored.
     """
-    logs = LogAccessRequest.objects.all().order_by('-pk')
+    logs = AccessEvent.objects.select_related('card', 'member').order_by('-timestamp')
+
+    filters = {}
+    for key in ['card', 'member']:
+        value = request.GET.get(key, '')
+        #not too long for the database either
+        if value.isdecimal() and len(value) < 19:
+            filters[key] = int(value)
+    if request.GET.get('door'):
+        filters['door'] = request.GET['door']
+    logs = logs.filter(**filters)
+
     paginator = Paginator(logs, 25)
 
     page = request.GET.get('page')
@@ -810,6 +838,7 @@ def access_log(request):
         log_list = paginator.page(paginator.num_pages)
 
     return render(request, 'members/access_log.html', {'log_list': log_list,
+                                                       'filters': filters,
                                                        'logged_in': True})
 
 @login_required
@@ -817,7 +846,7 @@ def logins_log(request):
     """
     Display log entries
     """
-    logs = LogCardLogin.objects.all().order_by('-pk')
+    logs = AccessEvent.objects.filter(door=AccessEvent.CARD_LOGIN_DOOR).order_by('-timestamp')
     paginator = Paginator(logs, 25)
 
     page = request.GET.get('page')
@@ -974,24 +1003,240 @@ def weekly_access(request):
         if 'id' in request.POST:
             uID = request.POST['id']
 
-            cards = AccessCard.objects.filter(unique_id=uID)
-            for the_card in cards:
-                access_groups = AccessGroup.objects.filter(card=the_card)
-                for the_group in access_groups:
-                    time_blocks = TimeBlock.objects.filter(group=the_group)
-                    for block in time_blocks:
-                        if block.day in data:
-                            temp = data[block.day]
-                            temp['start'] = min(block.start, temp['start'])
-                            temp['end'] = max(block.end, temp['end'])
-                            data[block.day] = temp
-                        else:
-                            data[block.day] = {'start': block.start, 'end': block.end}
+            with metrics.stage('lookup'):
+                #see check_access
+                access_index.refresh_if_stale()
+                cards = access_index.lookup(uID)
+
+            with metrics.stage('schedule'):
+                mask = 0
+                for the_card in cards:
+                    mask |= the_card.mask
+
+                for day, (start, end) in day_bounds(mask).items():
+                    data[day] = {'start': start, 'end': end}
 
             return JsonResponse(data)
 
     return HttpResponse("Nope", content_type="text/plain")
 
+def access_document(version, masks):
+    """
+    Build the document describing the weekly access of the cards in masks
+
+    Cards sharing a schedule point to the same entry of "schedules". Each entry lists the
+    [start, end] stretches of access of every day. Unlike the answer of weekly_access,
+    the gaps between blocks are kept.
+    """
+    schedules = []
+    schedule_ids = {}
+    cards = {}
+    for uid, mask in sorted(masks.items()):
+        if mask not in schedule_ids:
+            schedule_ids[mask] = len(schedules)
+            schedules.append({day: [[start.isoformat(), end.isoformat()]
+                                    for start, end in intervals]
+                              for day, intervals in day_intervals(mask).items()})
+        cards[uid] = schedule_ids[mask]
+
+    return {'version': version, 'schedules': schedules, 'cards': cards}
+
+_snapshot_cache = (None, None) # (masks it was made from, serialized document)
+_sorted_uids_cache = (None, None) # (masks it was made from, sorted uids)
+
+ACCESS_SNAPSHOT_PAGE_MAX = 5000
+
+def snapshot_etag(request):
+    """
+    ETag of the access snapshot: the version of the access rules it was built from
+
+    A page is only the one the client already has if it asks for the same page, so its
+    tag also depends on the page parameters.
+    """
+    access_index.refresh_if_stale()
+    etag = str(access_index.version())
+    if 'limit' in request.GET or 'after' in request.GET:
+        page = hashlib.sha1(request.GET.urlencode().encode('utf-8')).hexdigest()[:16]
+        etag += '-' + page
+    return etag
+
+def sorted_uids(masks):
+    """The uids of a snapshot in order, kept until the access index is rebuilt"""
+    global _sorted_uids_cache
+
+    cached_masks, uids = _sorted_uids_cache
+    if cached_masks is not masks:
+        uids = sorted(masks)
+        _sorted_uids_cache = (masks, uids)
+    return uids
+
+@csrf_exempt
+@require_safe
+@condition(etag_func=snapshot_etag)
+def access_snapshot(request):
+    """
+    Deliver the weekly access of every card in one document
+
+    Gatekeepers poll this with If-None-Match and get an empty 304 until the access rules
+    change. See access_document() for the format:
+
+        {"version": 12,
+         "schedules": [{"mon": [["09:00:00", "12:00:59"], ["13:00:00", "17:00:59"]]},
+                       ...],
+         "cards": {"deadbeef": 0, "cafebabe": 0, ...}}
+
+    The document is only serialized again after the access index is rebuilt.
+
+    With the "limit" GET parameter (at most ACCESS_SNAPSHOT_PAGE_MAX) the cards are sent
+    a page at a time, in uid order, starting after the "after" uid. The page holds the
+    uid to pass as "after" for the next page in "next", null on the last one. The pages
+    may come from different versions if the rules change in the meantime; the gatekeeper
+    should then catch up with access_changes since the version of the first page.
+    """
+    global _snapshot_cache
+
+    version, masks = access_index.snapshot()
+    if 'limit' in request.GET or 'after' in request.GET:
+        try:
+            limit = int(request.GET.get('limit', ACCESS_SNAPSHOT_PAGE_MAX))
+        except ValueError:
+            return HttpResponseBadRequest("Bad limit", content_type="text/plain")
+        limit = max(1, min(limit, ACCESS_SNAPSHOT_PAGE_MAX))
+
+        uids = sorted_uids(masks)
+        start = bisect.bisect_right(uids, request.GET.get('after', ''))
+        page = uids[start:start + limit]
+        data = access_document(version, {uid: masks[uid] for uid in page})
+        data['next'] = page[-1] if start + limit < len(uids) else None
+        return JsonResponse(data)
+
+    cached_masks, body = _snapshot_cache
+    if cached_masks is not masks:
+        body = json.dumps(access_document(version, masks))
+        _snapshot_cache = (masks, body)
+
+    return HttpResponse(body, content_type="application/json")
+
+@csrf_exempt
+@require_safe
+def access_changes(request):
+    """
+    Deliver the weekly access of the cards changed since a given version
+
+    The version comes from the "since" GET parameter and is the "version" of the last
+    snapshot or changes document the gatekeeper applied. The answer is an access_document()
+    holding only the changed cards, plus the uids of the cards that no longer exist:
+
+        {"version": 14, "full": false, "schedules": [...], "cards": {...},
+         "removed": ["0badf00d"]}
+
+    When the journal no longer goes back that far (see compact_access_journal), or since
+    is missing, the whole snapshot is sent instead with "full": true and the gatekeeper
+    should replace its table rather than update it.
+    """
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return HttpResponseBadRequest("Bad since", content_type="text/plain")
+
+    access_index.refresh_if_stale()
+    version, masks = access_index.snapshot()
+
+    if since <= 0 or since > version or since < AccessRulesVersion.compacted_up_to():
+        data = access_document(version, masks)
+        data.update(full=True, removed=[])
+        return JsonResponse(data)
+
+    uids = set()
+    group_ids = set()
+    for uid, group_id in AccessChange.objects.filter(seq__gt=since).values_list('uid',
+                                                                               'group_id'):
+        if uid:
+            uids.add(uid)
+        else:
+            group_ids.add(group_id)
+
+    #a TimeBlock change affects every card currently in its group
+    if group_ids:
+        links = AccessGroup.card.through.objects.filter(accessgroup_id__in=group_ids)
+        for uid in links.values_list('accesscard__unique_id', flat=True):
+            try:
+                uids.add(normalize_uid(uid))
+            except ValueError:
+                pass
+
+    data = access_document(version, {uid: masks[uid] for uid in uids if uid in masks})
+    data.update(full=False, removed=sorted(uid for uid in uids if uid not in masks))
+    return JsonResponse(data)
+
+ACCESS_WAIT_MAX = 55 # seconds, stay below the usual proxy timeouts
+
+@csrf_exempt
+@require_safe
+def access_wait(request):
+    """
+    Long poll for changes to the access rules
+
+    Answers as soon as the version of the access rules is greater than the "since" GET
+    parameter, or after "timeout" seconds (default and maximum ACCESS_WAIT_MAX):
+
+        {"version": 14, "changed": true}
+
+    Gatekeepers keep one of these open at all times and fetch access_changes when
+    "changed" is true, so a revoked card stops working within seconds without having
+    to poll the snapshot in a tight loop.
+    """
+    try:
+        since = int(request.GET.get('since', 0))
+        timeout = float(request.GET.get('timeout', ACCESS_WAIT_MAX))
+    except ValueError:
+        return HttpResponseBadRequest("Bad since or timeout", content_type="text/plain")
+    timeout = max(0, min(timeout, ACCESS_WAIT_MAX))
+
+    version = rules_watch.wait(since, timeout)
+    return JsonResponse({'version': version, 'changed': version > since})
+
+def check_access(uID, stamp, door='', refresh=True):
+    """
+    Decide on an access request using the compiled access index
+
+    Params:
+    uID -- the card uid that was presented
+    stamp -- an aware datetime.datetime of when it was presented
+    door -- optional id of the door (or client) asking
+    refresh -- check that no other process changed the access rules first (one query),
+               callers deciding many requests at once do it themselves
+
+    Returns (granted, events) where events is the list of unsaved AccessEvent objects
+    that describe the decision.
+    """
+    local = timezone.localtime(stamp)
+
+    #the compiled index answers without touching the database, but a card revoked
+    #by another worker or from the shell must not keep opening the door
+    with metrics.stage('lookup'):
+        if refresh:
+            access_index.refresh_if_stale()
+        cards = access_index.lookup(uID)
+    if len(cards) < 1:
+        #we didnt find any cards matching the ID
+        return False, [AccessEvent(timestamp=stamp, uid=uID, granted=False,
+                                   reason=AccessEvent.REASON_NOT_FOUND, door=door)]
+
+    #one or more cards found
+    events = []
+    with metrics.stage('schedule'):
+        for card in cards:
+            granted = card.has_access_at_time(local.date(), local.time())
+            reason = AccessEvent.REASON_OK if granted else AccessEvent.REASON_NO_ACCESS
+            events.append(AccessEvent(timestamp=stamp, uid=uID, card_id=card.pk,
+                                      member_id=card.member_id, granted=granted,
+                                      reason=reason, door=door))
+            if granted:
+                return True, events
+
+    return False, events
+
 @csrf_exempt
 def auth(request):
     """
@@ -1003,28 +1248,151 @@ def auth(request):
         if 'id' in request.POST:
             uID = request.POST['id']
 
-            cards = AccessCard.objects.filter(unique_id=uID)
-            if len(cards) < 1:
-                #we didnt find any cards matching the ID
-                log_str = "Denied access for ID: {} [card not found]".format(uID)
-                LogAccessRequest.log_now(log_str)
-                #return HttpResponse("Denied", content_type="text/plain")
-            else:
-                #one or more cards found
-                granted = False
-                for card in cards:
-                    if card.has_access_now():
-                        log_str = "Granted access for card {}".format(card)
-                        LogAccessRequest.log_now(log_str)
-                        return HttpResponse("Granted", content_type="text/plain")
-                    else:
-                        log_str = "Denied access for card: {} [no access at this time]".format(card)
-                        LogAccessRequest.log_now(log_str)
+            #optional id of the door (or client) asking
+            door = request.POST.get('door', '')
 
+            granted, events = check_access(uID, timezone.now(), door)
+            #the gatekeeper uploads the decision later under the same "event" id, it is
+            #then skipped as a duplicate (see access_events)
+            event_id = request.POST.get('event', '')
+            if 0 < len(event_id) <= 64:
+                events[-1].event_id = event_id
+            with metrics.stage('log'):
+                log_sink.put_many(events)
+            if granted:
+                return HttpResponse("Granted", content_type="text/plain")
 
     response = HttpResponse("Denied", content_type="text/plain")
     return response
 
+AUTH_BATCH_MAX = 1000
+
+@csrf_exempt
+@require_POST
+def auth_batch(request):
+    """
+    Authenticate many access requests at once
+
+    Meant for controllers driving several readers or replaying swipes queued while
+    offline. The body is a JSON list of [id, timestamp, door] entries where timestamp is
+    in seconds since the epoch (null meaning now) and door may be left out:
+
+        [["deadbeef", 1514808000, "front"], ["cafebabe", null, "back"]]
+
+    The answer has one result per entry, in the same order:
+
+        {"results": [{"id": "deadbeef", "decision": "Granted", "reason": "ok"}, ...]}
+
+    Every decision is made from the access index and all of them are logged together,
+    so the number of queries does not depend on the size of the batch.
+    """
+    try:
+        entries = json.loads(request.body.decode('utf-8'))
+        if not isinstance(entries, list):
+            raise ValueError("expected a list")
+        if len(entries) > AUTH_BATCH_MAX:
+            raise ValueError("at most {} entries per batch".format(AUTH_BATCH_MAX))
+
+        swipes = []
+        for entry in entries:
+            if not isinstance(entry, list):
+                raise ValueError("expected [id, timestamp, door], got {}".format(entry))
+            uID = str(entry[0])
+            ts = entry[1] if len(entry) > 1 else None
+            door = str(entry[2]) if len(entry) > 2 and entry[2] is not None else ''
+            if ts is None:
+                stamp = timezone.now()
+            else:
+                stamp = datetime.datetime.fromtimestamp(float(ts), datetime.timezone.utc)
+            swipes.append((uID, stamp, door))
+    except (ValueError, TypeError, IndexError, OverflowError) as err:
+        return HttpResponseBadRequest("Bad batch: {}".format(err), content_type="text/plain")
+
+    results = []
+    all_events = []
+    access_index.refresh_if_stale()
+    for uID, stamp, door in swipes:
+        granted, events = check_access(uID, stamp, door, refresh=False)
+        all_events.extend(events)
+        results.append({'id': uID,
+                        'decision': "Granted" if granted else "Denied",
+                        'reason': events[-1].reason})
+
+    with metrics.stage('log'):
+        log_sink.put_many(all_events)
+    return JsonResponse({'results': results})
+
+ACCESS_EVENTS_MAX = 1000
+
+@csrf_exempt
+@require_POST
+def access_events(request):
+    """
+    Store the access decisions made by a gatekeeper
+
+    Gatekeepers keep every decision in a local queue, including the ones made from
+    their cache while the server was unreachable, and upload it here. The body is a
+    JSON list of events, each with an id unique to the gatekeeper that made it:
+
+        [{"event_id": "3f2b...", "uid": "deadbeef", "timestamp": 1514808000.5,
+          "granted": true, "door": "front"}, ...]
+
+    Events whose event_id is already stored are skipped, so a batch can be sent again
+    when the answer was lost, and the decisions auth logged with the same id are not
+    stored twice:
+
+        {"stored": 10, "duplicates": 2}
+
+    The card, member and reason are filled in from the access index, as the server sees
+    them now; "granted" is what the gatekeeper did.
+    """
+    try:
+        entries = json.loads(request.body.decode('utf-8'))
+        if not isinstance(entries, list):
+            raise ValueError("expected a list")
+        if len(entries) > ACCESS_EVENTS_MAX:
+            raise ValueError("at most {} events per batch".format(ACCESS_EVENTS_MAX))
+
+        received = OrderedDict()
+        for entry in entries:
+            event_id = str(entry['event_id'])
+            if not event_id or len(event_id) > 64:
+                raise ValueError("bad event_id [{}]".format(event_id))
+            stamp = datetime.datetime.fromtimestamp(float(entry['timestamp']),
+                                                    datetime.timezone.utc)
+            received[event_id] = (str(entry['uid'])[:30], stamp, bool(entry['granted']),
+                                  str(entry.get('door') or '')[:64])
+    except (ValueError, TypeError, KeyError, OverflowError) as err:
+        return HttpResponseBadRequest("Bad events: {}".format(err), content_type="text/plain")
+
+    stored = set(AccessEvent.objects.filter(event_id__in=list(received))
+                 .values_list('event_id', flat=True))
+
+    new_events = []
+    access_index.refresh_if_stale()
+    for event_id, (uID, stamp, granted, door) in received.items():
+        if event_id in stored:
+            continue
+        event = check_access(uID, stamp, door, refresh=False)[1][-1]
+        event.granted = granted
+        event.event_id = event_id
+        new_events.append(event)
+
+    #another upload of the same events may have been stored in the meantime
+    AccessEvent.objects.bulk_create(new_events, ignore_conflicts=True)
+    return JsonResponse({'stored': len(new_events),
+                         'duplicates': len(entries) - len(new_events)})
+
+@require_safe
+def metrics_view(request):
+    """
+    Expose the latency of the device facing views to Prometheus
+
+    See metrics.py. Every server process reports its own numbers.
+    """
+    return HttpResponse(metrics.render_prometheus(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @login_required
 def updateAllCaches(request):
     """
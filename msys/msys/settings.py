@@ -45,6 +45,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = [
+    'members.metrics.StageTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -113,6 +114,22 @@ USE_L10N = True
 USE_TZ = True
 
 
+# Log sink (see members/log_sink.py)
+# Log rows are queued and written in batches by a background thread
+
+LOG_SINK_ASYNC = True
+
+LOG_SINK_BATCH_SIZE = 100
+
+LOG_SINK_FLUSH_INTERVAL = 1.0
+
+
+# Long polling for access rule changes (see members/rules_watch.py)
+# Changes made by other server processes are noticed within this many seconds
+
+ACCESS_WAIT_POLL_INTERVAL = 1.0
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.8/howto/static-files/
 